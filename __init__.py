@@ -39,6 +39,7 @@ class EGGAnimationProperty(bpy.types.PropertyGroup):
     from_frame = IntProperty(name="From", default=1)
     to_frame = IntProperty(name="To", default=2)
     fps = IntProperty(name="FPS", default=24)
+    rate = IntProperty(name="Rate", description="Samples per second in the exported animation. 0 - one sample per frame", default=0, min=0)
 
     def __get_idx(self):
         return list(bpy.context.scene.yabee_settings.opt_anim_list.anim_collection).index(self)
@@ -53,7 +54,7 @@ class EGGAnimList(bpy.types.PropertyGroup):
     def get_anim_dict(self):
         d = {}
         for anim in self.anim_collection:
-            d[anim.name] = (anim.from_frame, anim.to_frame, anim.fps)
+            d[anim.name] = (anim.from_frame, anim.to_frame, anim.fps, anim.rate)
         return d
 
 
@@ -105,6 +106,18 @@ class YABEEProperty(bpy.types.PropertyGroup):
             default=False,
             )
 
+    opt_action_map = StringProperty(
+            name="Action map",
+            description="Explicit action to armature binding: \"Action:Armature; Action2:Armature1,Armature2\". Other actions are bound by the animated bone names",
+            default='',
+            )
+
+    opt_action_rate = IntProperty(
+            name="Sample rate",
+            description="Samples per second in the animations from actions. 0 - one sample per frame",
+            default=0, min=0,
+            )
+
     opt_separate_anim_files = BoolProperty(
             name="Separate animation files",
             description="Write an animation data into the separate files",
@@ -159,6 +172,108 @@ class YABEEProperty(bpy.types.PropertyGroup):
             default=False,
             )
 
+    opt_weld_vertices = BoolProperty(
+            name="Weld vertices",
+            description="Merge polygon corners with identical attributes into the shared vertices",
+            default=False,
+            )
+
+    opt_compress = BoolProperty(
+            name="Compress (.pz)",
+            description="Write zlib compressed .egg.pz files",
+            default=False,
+            )
+
+    opt_compress_level = IntProperty(
+            name="Compression level",
+            description="zlib compression level: 1 - fastest, 9 - smallest",
+            default=6, min=1, max=9,
+            )
+
+    opt_max_influences = IntProperty(
+            name="Max influences",
+            description="Maximum number of joints per vertex (4 for the hardware skinning). 0 - no limit",
+            default=0, min=0, max=16,
+            )
+
+    opt_weight_steps = IntProperty(
+            name="Weight steps",
+            description="Quantize joint weights to 1/steps, which reduces the number of the membership blocks. 0 - no quantization",
+            default=0, min=0, max=65535,
+            )
+
+    opt_anim_prune = BoolProperty(
+            name="Prune animation channels",
+            description="Write constant animation channels once and skip channels, which keep the default value for the whole animation",
+            default=False,
+            )
+
+    opt_anim_tolerance = FloatProperty(
+            name="Tolerance",
+            description="Quantize animation values to the multiple of the tolerance. 0 - no quantization",
+            default=0.0, min=0.0, max=1.0, precision=5,
+            )
+
+    opt_texture_atlas = BoolProperty(
+            name="Texture atlas",
+            description="Pack the small per-face UV images into the atlas pages to reduce the number of the textures and draw calls",
+            default=False,
+            )
+
+    opt_atlas_size = IntProperty(
+            name="Atlas size",
+            description="Size of the atlas page in pixels",
+            default=2048, min=256, max=8192,
+            )
+
+    opt_atlas_padding = IntProperty(
+            name="Padding",
+            description="Border around the each image in the atlas page, filled by the edge pixels. The each doubling keeps one more mipmap level from the bleeding of the neighbours",
+            default=8, min=1, max=64,
+            )
+
+    opt_bake_atlas = BoolProperty(
+            name="Bake to atlas",
+            description="Bake all objects into the one shared image per bake type instead of the image per object",
+            default=False,
+            )
+
+    opt_use_cache = BoolProperty(
+            name="Use fragment cache",
+            description="Reuse the EGG data of the unchanged objects from the previous export. Cache is stored in the .yabee_cache directory near the EGG file",
+            default=False,
+            )
+
+    opt_precision_xyz = IntProperty(
+            name="Position",
+            description="Number of digits after the point for the positions and matrices",
+            default=6, min=1, max=9,
+            )
+
+    opt_precision_normal = IntProperty(
+            name="Normal",
+            description="Number of digits after the point for the normals and tangents",
+            default=6, min=1, max=9,
+            )
+
+    opt_precision_uv = IntProperty(
+            name="UV",
+            description="Number of digits after the point for the texture coordinates",
+            default=6, min=1, max=9,
+            )
+
+    opt_precision_weight = IntProperty(
+            name="Weight",
+            description="Number of digits after the point for the vertex weights",
+            default=6, min=1, max=9,
+            )
+
+    opt_precision_anim = IntProperty(
+            name="Animation",
+            description="Number of digits after the point for the animation channels",
+            default=6, min=1, max=9,
+            )
+
     opt_anim_list = PointerProperty(type=EGGAnimList)
 
     first_run = BoolProperty(default = True)
@@ -170,7 +285,10 @@ class YABEEProperty(bpy.types.PropertyGroup):
 
         layout.row().label('Animation:')
         layout.row().prop(self, 'opt_anims_from_actions')
-        if not self.opt_anims_from_actions:
+        if self.opt_anims_from_actions:
+            layout.row().prop(self, 'opt_action_map')
+            layout.row().prop(self, 'opt_action_rate')
+        else:
             row = layout.row()
             row.template_list("UI_UL_list", "anim_collection",
                               self.opt_anim_list,
@@ -189,12 +307,30 @@ class YABEEProperty(bpy.types.PropertyGroup):
                 row.prop(p, 'from_frame')
                 row.prop(p, 'to_frame')
                 row.prop(p, 'fps')
+                row.prop(p, 'rate')
 
         layout.separator()
 
         layout.row().label('Options:')
         layout.row().prop(self, 'opt_anim_only')
         layout.row().prop(self, 'opt_separate_anim_files')
+        row = layout.row()
+        row.prop(self, 'opt_anim_prune')
+        if self.opt_anim_prune:
+            row.prop(self, 'opt_anim_tolerance')
+        row = layout.row()
+        row.prop(self, 'opt_compress')
+        if self.opt_compress:
+            row.prop(self, 'opt_compress_level')
+        box = layout.box()
+        box.row().label('Precision (digits after the point):')
+        row = box.row(align = True)
+        row.prop(self, 'opt_precision_xyz')
+        row.prop(self, 'opt_precision_normal')
+        row.prop(self, 'opt_precision_uv')
+        row = box.row(align = True)
+        row.prop(self, 'opt_precision_weight')
+        row.prop(self, 'opt_precision_anim')
         if not self.opt_anim_only:
             layout.row().prop(self, 'opt_tbs_proc')
             box = layout.box()
@@ -207,10 +343,17 @@ class YABEEProperty(bpy.types.PropertyGroup):
             if self.opt_tex_proc != 'RAW':
                 self.opt_bake_AO.draw(box.row(align = True), "AO")
                 self.opt_bake_shadow.draw(box.row(align = True), "Shadow")
+                box.row().prop(self, 'opt_bake_atlas')
             #else:
             #    layout.row().prop(self, 'opt_tex_proc')
             #if self.opt_tex_proc == 'SIMPLE':
             #    box.row().prop(self, 'opt_export_uv_as_texture')
+            if self.opt_tex_proc in ('SIMPLE', 'RAW'):
+                row = box.row()
+                row.prop(self, 'opt_texture_atlas')
+                if self.opt_texture_atlas:
+                    row.prop(self, 'opt_atlas_size')
+                    row.prop(self, 'opt_atlas_padding')
             if self.opt_copy_tex_files or self.opt_tex_proc == 'BAKE':
                 box = layout.box()
                 if self.opt_tex_proc in ('SIMPLE', 'RAW'):
@@ -222,6 +365,11 @@ class YABEEProperty(bpy.types.PropertyGroup):
             layout.row().prop(self, 'opt_apply_modifiers')
             layout.row().prop(self, 'opt_pview')
             layout.row().prop(self, 'opt_use_loop_normals')
+            layout.row().prop(self, 'opt_weld_vertices')
+            row = layout.row()
+            row.prop(self, 'opt_max_influences')
+            row.prop(self, 'opt_weight_steps')
+            layout.row().prop(self, 'opt_use_cache')
 
             layout.row().prop(self, 'opt_export_pbs')
             layout.row().prop(self, 'opt_force_export_vertex_colors')
@@ -245,6 +393,21 @@ class YABEEProperty(bpy.types.PropertyGroup):
                 d[name] = (opt.res_x, opt.res_y, opt.export)
         return d
 
+    def get_action_map(self):
+        d = {}
+        for item in self.opt_action_map.split(';'):
+            if ':' in item:
+                action, arms = item.split(':', 1)
+                d[action.strip()] = [a.strip() for a in arms.split(',') if a.strip()]
+        return d
+
+    def get_precision_dict(self):
+        return {'xyz': self.opt_precision_xyz,
+                'normal': self.opt_precision_normal,
+                'uv': self.opt_precision_uv,
+                'weight': self.opt_precision_weight,
+                'anim': self.opt_precision_anim}
+
     def check_warns(self, context):
         warns = []
         if len(context.selected_objects) == 0:
@@ -286,6 +449,25 @@ class YABEEProperty(bpy.types.PropertyGroup):
         self.opt_use_loop_normals = False
         self.opt_export_pbs = False
         self.opt_force_export_vertex_colors = False
+        self.opt_weld_vertices = False
+        self.opt_compress = False
+        self.opt_compress_level = 6
+        self.opt_max_influences = 0
+        self.opt_weight_steps = 0
+        self.opt_use_cache = False
+        self.opt_texture_atlas = False
+        self.opt_bake_atlas = False
+        self.opt_atlas_size = 2048
+        self.opt_atlas_padding = 8
+        self.opt_anim_prune = False
+        self.opt_action_map = ''
+        self.opt_action_rate = 0
+        self.opt_anim_tolerance = 0.0
+        self.opt_precision_xyz = 6
+        self.opt_precision_normal = 6
+        self.opt_precision_uv = 6
+        self.opt_precision_weight = 6
+        self.opt_precision_anim = 6
         while self.opt_anim_list.anim_collection[:]:
             bpy.ops.export.egg_anim_remove('INVOKE_DEFAULT')
         self.first_run = False
@@ -378,7 +560,7 @@ class ExportPanda3DEGG(bpy.types.Operator, ExportHelper):
     filename_ext = ".egg"
 
     filter_glob = StringProperty(
-            default="*.egg",
+            default="*.egg;*.egg.pz",
             options={'HIDDEN'},
             )
 
@@ -391,7 +573,10 @@ class ExportPanda3DEGG(bpy.types.Operator, ExportHelper):
         import imp
         imp.reload(egg_writer)
         sett = context.scene.yabee_settings
-        errors = egg_writer.write_out(self.filepath,
+        filepath = self.filepath
+        if sett.opt_compress and not filepath.lower().endswith('.pz'):
+            filepath += '.pz'
+        errors = egg_writer.write_out(filepath,
                             sett.opt_anim_list.get_anim_dict(),
                             sett.opt_anims_from_actions,
                             sett.opt_export_uv_as_texture,
@@ -407,7 +592,20 @@ class ExportPanda3DEGG(bpy.types.Operator, ExportHelper):
                             sett.opt_pview,
                             sett.opt_use_loop_normals,
                             sett.opt_export_pbs,
-                            sett.opt_force_export_vertex_colors,)
+                            sett.opt_force_export_vertex_colors,
+                            weld_vertices = sett.opt_weld_vertices,
+                            compress_level = sett.opt_compress_level,
+                            precision = sett.get_precision_dict(),
+                            use_cache = sett.opt_use_cache,
+                            max_influences = sett.opt_max_influences,
+                            weight_steps = sett.opt_weight_steps,
+                            anim_prune = sett.opt_anim_prune,
+                            anim_tolerance = sett.opt_anim_tolerance,
+                            action_map = sett.get_action_map(),
+                            action_rate = sett.opt_action_rate,
+                            atlas_size = sett.opt_atlas_size if sett.opt_texture_atlas else 0,
+                            atlas_padding = sett.opt_atlas_padding,
+                            bake_atlas = sett.opt_bake_atlas)
         if not errors:
             return {'FINISHED'}
         else:
@@ -422,6 +620,12 @@ class ExportPanda3DEGG(bpy.types.Operator, ExportHelper):
             return {'CANCELLED'}
 
 
+    def check(self, context):
+        # ExportHelper would append ".egg" to the "file.egg.pz"
+        if self.filepath.lower().endswith('.egg.pz'):
+            return False
+        return ExportHelper.check(self, context)
+
     def invoke(self, context, evt):
         if context.scene.yabee_settings.first_run:
             context.scene.yabee_settings.reset_defaults()
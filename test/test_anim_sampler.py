@@ -0,0 +1,101 @@
+""" Part of the YABEE
+    Tests of the TimelineSampler: the data, evaluated from the F-curves,
+    should match the data, recorded by the frame_set(). Run inside
+    Blender:
+
+        blender --background --factory-startup --python test/test_anim_sampler.py
+"""
+
+import os, sys, unittest
+try:
+    import bpy
+except ImportError:
+    bpy = None
+
+if bpy:
+    import numpy as np
+    from mathutils import Quaternion
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from yabee_libs.anim_sampler import TimelineSampler
+
+FRAMES = list(range(1, 11))
+
+
+def sample(add, obj, get, fast):
+    """ Sample the object by the fast path or by the frame_set().
+    """
+    sampler = TimelineSampler(FRAMES)
+    add(sampler, obj)
+    if not fast:
+        sampler.can_evaluate_armature = lambda arm: False
+        sampler.can_evaluate_shape_keys = lambda obj: False
+    sampler.sample()
+    return get(sampler, obj)
+
+
+@unittest.skipIf(bpy is None, 'needs Blender')
+class TestConnectedBone(unittest.TestCase):
+
+    def setUp(self):
+        bpy.ops.wm.read_factory_settings(use_empty = True)
+        scene = bpy.context.scene
+        arm_data = bpy.data.armatures.new('Arm')
+        self.arm = bpy.data.objects.new('Arm', arm_data)
+        scene.objects.link(self.arm)
+        scene.objects.active = self.arm
+        bpy.ops.object.mode_set(mode = 'EDIT')
+        root = arm_data.edit_bones.new('root')
+        root.head, root.tail = (0, 0, 0), (0, 0, 1)
+        child = arm_data.edit_bones.new('child')
+        child.head, child.tail = (0, 0, 1), (0, 1, 2)
+        child.parent = root
+        child.use_connect = True
+        bpy.ops.object.mode_set(mode = 'OBJECT')
+        self.arm.animation_data_create()
+        self.arm.animation_data.action = bpy.data.actions.new('Act')
+        for frame, loc, angle in ((1, (0, 0, 0), 0.0), (10, (0.5, 1, -0.3), 0.8)):
+            for pbone in self.arm.pose.bones:
+                pbone.location = loc
+                pbone.rotation_quaternion = Quaternion((0, 0, 1), angle)
+                pbone.keyframe_insert('location', frame = frame)
+                pbone.keyframe_insert('rotation_quaternion', frame = frame)
+
+    def test_location_keys(self):
+        self.assertTrue(TimelineSampler(FRAMES).can_evaluate_armature(self.arm))
+        add = TimelineSampler.add_armature
+        get = lambda sampler, arm: sampler.get_pose_matrices(arm, FRAMES)
+        np.testing.assert_allclose(sample(add, self.arm, get, True),
+                                   sample(add, self.arm, get, False),
+                                   atol = 1e-4)
+
+
+@unittest.skipIf(bpy is None, 'needs Blender')
+class TestShapeKeySlider(unittest.TestCase):
+
+    def setUp(self):
+        bpy.ops.wm.read_factory_settings(use_empty = True)
+        mesh = bpy.data.meshes.new('Mesh')
+        mesh.from_pydata([(0, 0, 0), (1, 0, 0), (0, 1, 0)], [], [(0, 1, 2)])
+        self.obj = bpy.data.objects.new('Mesh', mesh)
+        bpy.context.scene.objects.link(self.obj)
+        self.obj.shape_key_add('Basis')
+        key = self.obj.shape_key_add('Key')
+        key.slider_min, key.slider_max = -0.5, 1.0
+        fc = mesh.shape_keys.animation_data_create()
+        fc.action = bpy.data.actions.new('KeyAct')
+        curve = fc.action.fcurves.new('key_blocks["Key"].value')
+        curve.keyframe_points.insert(1, -2.0)
+        curve.keyframe_points.insert(10, 3.0)
+
+    def test_slider_range(self):
+        add = TimelineSampler.add_shape_keys
+        get = lambda sampler, obj: sampler.get_shape_values(obj, FRAMES)
+        fast = sample(add, self.obj, get, True)
+        self.assertTrue((fast[:, 1] >= -0.5).all() and (fast[:, 1] <= 1.0).all())
+        np.testing.assert_allclose(fast, sample(add, self.obj, get, False),
+                                   atol = 1e-5)
+
+
+if __name__ == '__main__':
+    result = unittest.main(argv = [sys.argv[0]], exit = False).result
+    sys.exit(not result.wasSuccessful())
@@ -4,7 +4,7 @@
 #: file name to write
 FILE_PATH = './exp_test/test.egg'
 
-#: { 'animation_name' : (start_frame, end_frame, frame_rate) }
+#: { 'animation_name' : (start_frame, end_frame, frame_rate[, sample_rate]) }
 ANIMATIONS = {'anim1':(0,10,5),
               }
 ANIMS_FROM_ACTIONS = False
@@ -82,7 +82,7 @@ if __name__ == '__main__':
     imp.reload(io_scene_egg.yabee_libs.egg_writer)
     egg_writer = io_scene_egg.yabee_libs.egg_writer
 
-    egg_write.write_out(FILE_PATH,
+    egg_writer.write_out(FILE_PATH,
                         ANIMATIONS, ANIMS_FROM_ACTIONS,
                         EXPORT_UV_IMAGE_AS_TEXTURE,
                         SEPARATE_ANIM_FILE,
@@ -94,4 +94,7 @@ if __name__ == '__main__':
                         BAKE_LAYERS,
                         True, True, True,  # MERGE_ACTOR_MESH, APPLY_MOD, PVIEW
                         False, False, # USE_LOOP_NORMALS, EXPORT_PBS
-                        False) # FORCE_EXPORT_VERTEX_COLORS
+                        False, # FORCE_EXPORT_VERTEX_COLORS
+                        precision = dict.fromkeys(('xyz', 'normal', 'uv',
+                                                   'weight', 'anim'),
+                                                  FLOATING_POINT_ACCURACY))
@@ -0,0 +1,348 @@
+""" Part of the YABEE
+    Sampling of the animated data (pose matrices of the armatures and
+    values of the shape keys) for all frames in one pass over timeline.
+"""
+
+import bpy, re, math
+import numpy as np
+if __name__ != '__main__':
+    from .utils import matrix_to_array, foreach_get_array
+
+#: Pose bone channels, which are evaluated from the F-curves
+POSE_CHANNELS = {'location': 3, 'rotation_quaternion': 4,
+                 'rotation_euler': 3, 'rotation_axis_angle': 4, 'scale': 3}
+
+RE_POSE_PATH = re.compile(r'^pose\.bones\["((?:[^"\\]|\\.)*)"\]\.(\w+)$')
+RE_KEY_PATH = re.compile(r'^key_blocks\["((?:[^"\\]|\\.)*)"\]\.value$')
+
+
+def unescape_name(name):
+    """ Unescape the name from the RNA data path.
+    """
+    return re.sub(r'\\(.)', r'\1', name)
+
+def quaternion_to_matrix(quats):
+    """ Convert the (N, 4) array of (w, x, y, z) quaternions to the
+    (N, 3, 3) array of rotation matrices. Quaternions are normalized.
+    """
+    length = np.sqrt((quats * quats).sum(axis = 1))
+    length[length == 0] = 1.0
+    w, x, y, z = (quats / length.reshape((-1, 1))).T
+    mat = np.empty((len(quats), 3, 3))
+    mat[:, 0, 0] = 1 - 2 * (y * y + z * z)
+    mat[:, 0, 1] = 2 * (x * y - w * z)
+    mat[:, 0, 2] = 2 * (x * z + w * y)
+    mat[:, 1, 0] = 2 * (x * y + w * z)
+    mat[:, 1, 1] = 1 - 2 * (x * x + z * z)
+    mat[:, 1, 2] = 2 * (y * z - w * x)
+    mat[:, 2, 0] = 2 * (x * z - w * y)
+    mat[:, 2, 1] = 2 * (y * z + w * x)
+    mat[:, 2, 2] = 1 - 2 * (x * x + y * y)
+    return mat
+
+def axis_rotation_matrix(axis, angles):
+    """ Return (N, 3, 3) matrices of the rotation around the 'X', 'Y'
+    or 'Z' axis.
+    """
+    c, s = np.cos(angles), np.sin(angles)
+    mat = np.zeros((len(angles), 3, 3))
+    i, j = {'X': (1, 2), 'Y': (2, 0), 'Z': (0, 1)}[axis]
+    k = 3 - i - j
+    mat[:, k, k] = 1
+    mat[:, i, i] = c
+    mat[:, j, j] = c
+    mat[:, i, j] = -s
+    mat[:, j, i] = s
+    return mat
+
+def euler_to_matrix(eulers, order):
+    """ Convert the (N, 3) array of Euler angles (X, Y, Z) with the
+    Blender's rotation order ('XYZ' - X is applied first) to the
+    (N, 3, 3) array of rotation matrices.
+    """
+    mat = None
+    for axis in order:
+        rot = axis_rotation_matrix(axis, eulers[:, 'XYZ'.index(axis)])
+        mat = rot if mat is None else np.einsum('nij,njk->nik', rot, mat)
+    return mat
+
+def axis_angle_to_matrix(axis_angles):
+    """ Convert the (N, 4) array of (angle, x, y, z) to the (N, 3, 3)
+    array of rotation matrices.
+    """
+    angle = axis_angles[:, 0]
+    axis = axis_angles[:, 1:]
+    length = np.sqrt((axis * axis).sum(axis = 1))
+    zero = length == 0
+    length[zero] = 1.0
+    x, y, z = (axis / length.reshape((-1, 1))).T
+    angle = np.where(zero, 0.0, angle)
+    c, s = np.cos(angle), np.sin(angle)
+    t = 1 - c
+    mat = np.empty((len(angle), 3, 3))
+    mat[:, 0, 0] = t * x * x + c
+    mat[:, 0, 1] = t * x * y - s * z
+    mat[:, 0, 2] = t * x * z + s * y
+    mat[:, 1, 0] = t * x * y + s * z
+    mat[:, 1, 1] = t * y * y + c
+    mat[:, 1, 2] = t * y * z - s * x
+    mat[:, 2, 0] = t * x * z - s * y
+    mat[:, 2, 1] = t * y * z + s * x
+    mat[:, 2, 2] = t * z * z + c
+    return mat
+
+def get_action(id_data):
+    """ Return the active action of the ID or None.
+    """
+    if id_data and id_data.animation_data:
+        return id_data.animation_data.action
+    return None
+
+def get_action_targets(action):
+    """ Return names of the pose bones and the shape keys, which are
+    animated by the action.
+
+    @return: tuple of the two sets (bone names, shape key names).
+    """
+    bones, keys = set(), set()
+    for fc in action.fcurves:
+        match = RE_POSE_PATH.match(fc.data_path)
+        if match:
+            bones.add(unescape_name(match.group(1)))
+            continue
+        match = RE_KEY_PATH.match(fc.data_path)
+        if match:
+            keys.add(unescape_name(match.group(1)))
+    return bones, keys
+
+def has_extra_animation(id_data):
+    """ Check if the ID has animation, which isn't described by the
+    active action (drivers, NLA).
+    """
+    anim = id_data and id_data.animation_data
+    return bool(anim and (len(anim.drivers) or len(anim.nla_tracks)))
+
+
+class TimelineSampler:
+    """ Visit each needed frame once and record the animated data of
+    all registered objects together. Animation collectors take
+    their frames from the recorded buffers.
+    """
+
+    def __init__(self, frames):
+        """ @param frames: iterable of the frames to sample.
+        """
+        self.frames = sorted(set(frames))
+        self.frame_index = dict([(f, i) for i, f in enumerate(self.frames)])
+        self.armatures = {}
+        self.shape_keys = {}
+        self.sampled = False
+
+    def add_armature(self, arm):
+        """ Register the armature object for sampling.
+        """
+        if arm.name not in self.armatures:
+            num = len(self.frames)
+            self.armatures[arm.name] = {
+                'object': arm,
+                'pose': np.zeros((num, len(arm.pose.bones), 4, 4), dtype=np.float32),
+                'world': np.zeros((num, 4, 4), dtype=np.float64)}
+        self.sampled = False
+
+    def add_shape_keys(self, obj):
+        """ Register the mesh object with the shape keys for sampling.
+        """
+        if obj.name not in self.shape_keys:
+            key_blocks = obj.data.shape_keys.key_blocks
+            self.shape_keys[obj.name] = {
+                'object': obj,
+                'values': np.zeros((len(self.frames), len(key_blocks)), dtype=np.float32)}
+        self.sampled = False
+
+    def can_evaluate_armature(self, arm):
+        """ Check if the pose of the armature depends on the active
+        action only, so it can be evaluated from the F-curves without
+        the frame changing. Constraints, drivers, NLA, animated parents
+        and not default bone inheritance need the full scene evaluation.
+        """
+        if arm.parent or len(arm.constraints):
+            return False
+        if has_extra_animation(arm) or has_extra_animation(arm.data):
+            return False
+        if get_action(arm.data):
+            return False
+        action = get_action(arm)
+        if action:
+            for fc in action.fcurves:
+                if not fc.mute and not RE_POSE_PATH.match(fc.data_path):
+                    # Object transform or custom properties
+                    return False
+        for pbone in arm.pose.bones:
+            if len(pbone.constraints):
+                return False
+        for bone in arm.data.bones:
+            if not (bone.use_inherit_rotation and bone.use_inherit_scale
+                    and bone.use_local_location):
+                return False
+        return True
+
+    def evaluate_armature(self, data):
+        """ Evaluate the pose matrices from the F-curves of the active
+        action. Pose matrix of the bone is the parent pose matrix *
+        rest offset from the parent * basis (location, rotation, scale).
+        """
+        arm = data['object']
+        pbones = arm.pose.bones
+        frames = np.array(self.frames, dtype = np.float64)
+        num_f, num_b = len(frames), len(pbones)
+        # Not animated channels keep the current values
+        channels = {}
+        for name, size in POSE_CHANNELS.items():
+            current = foreach_get_array(pbones, name, np.float32, size)
+            channels[name] = np.repeat(current.reshape((1, num_b, size)),
+                                       num_f, axis = 0).astype(np.float64)
+        bone_index = dict([(pb.name, i) for i, pb in enumerate(pbones)])
+        action = get_action(arm)
+        if action:
+            for fc in action.fcurves:
+                match = RE_POSE_PATH.match(fc.data_path)
+                if fc.mute or not match or match.group(2) not in POSE_CHANNELS:
+                    continue
+                idx = bone_index.get(unescape_name(match.group(1)))
+                if idx is None or fc.array_index >= POSE_CHANNELS[match.group(2)]:
+                    continue
+                channels[match.group(2)][:, idx, fc.array_index] = \
+                    [fc.evaluate(f) for f in frames]
+        # Basis matrices
+        basis = np.zeros((num_f, num_b, 4, 4))
+        for idx, pbone in enumerate(pbones):
+            mode = pbone.rotation_mode
+            if mode == 'QUATERNION':
+                rot = quaternion_to_matrix(channels['rotation_quaternion'][:, idx])
+            elif mode == 'AXIS_ANGLE':
+                rot = axis_angle_to_matrix(channels['rotation_axis_angle'][:, idx])
+            else:
+                rot = euler_to_matrix(channels['rotation_euler'][:, idx], mode)
+            basis[:, idx, :3, :3] = rot * channels['scale'][:, idx].reshape((num_f, 1, 3))
+            # Blender ignores the location of the connected bones
+            if not pbone.bone.use_connect:
+                basis[:, idx, :3, 3] = channels['location'][:, idx]
+            basis[:, idx, 3, 3] = 1.0
+        # Rest matrices in the armature space
+        rest = foreach_get_array(arm.data.bones, 'matrix_local', np.float32, 16)
+        rest = rest.reshape((-1, 4, 4)).transpose((0, 2, 1)).astype(np.float64)
+        rest_index = dict([(b.name, i) for i, b in enumerate(arm.data.bones)])
+        pose = np.zeros((num_f, num_b, 4, 4))
+        done = [False] * num_b
+        def eval_bone(idx):
+            if done[idx]:
+                return
+            pbone = pbones[idx]
+            offset = rest[rest_index[pbone.name]]
+            if pbone.parent:
+                pidx = bone_index[pbone.parent.name]
+                eval_bone(pidx)
+                offset = np.dot(np.linalg.inv(rest[rest_index[pbone.parent.name]]), offset)
+                parent = np.einsum('fij,jk->fik', pose[:, pidx], offset)
+            else:
+                parent = offset.reshape((1, 4, 4))
+            pose[:, idx] = np.einsum('fij,fjk->fik', parent, basis[:, idx])
+            done[idx] = True
+        for idx in range(num_b):
+            eval_bone(idx)
+        data['pose'][:] = pose
+        data['world'][:] = matrix_to_array(arm.matrix_world)
+
+    def can_evaluate_shape_keys(self, obj):
+        """ Check if the shape keys values depend on the active action
+        of the shape keys only (no drivers, NLA or absolute keys).
+        """
+        key = obj.data.shape_keys
+        if not key.use_relative or has_extra_animation(key):
+            return False
+        action = get_action(key)
+        if action:
+            for fc in action.fcurves:
+                if not fc.mute and not RE_KEY_PATH.match(fc.data_path):
+                    return False
+        return True
+
+    def evaluate_shape_keys(self, data):
+        """ Evaluate the shape keys values from the F-curves. Values are
+        clamped to the slider range of the key, as Blender does.
+        """
+        key = data['object'].data.shape_keys
+        values = data['values']
+        values[:] = foreach_get_array(key.key_blocks, 'value', np.float32)
+        key_index = dict([(kb.name, i) for i, kb in enumerate(key.key_blocks)])
+        action = get_action(key)
+        if action:
+            for fc in action.fcurves:
+                match = RE_KEY_PATH.match(fc.data_path)
+                if fc.mute or not match:
+                    continue
+                idx = key_index.get(unescape_name(match.group(1)))
+                if idx is not None:
+                    kb = key.key_blocks[idx]
+                    values[:, idx] = np.clip([fc.evaluate(f) for f in self.frames],
+                                             kb.slider_min, kb.slider_max)
+
+    def sample(self):
+        """ Record the data for all frames. Data, which depends on the
+        active actions only, is evaluated from the F-curves directly,
+        the rest is recorded by the visiting of the each frame.
+        """
+        scene = bpy.context.scene
+        current_f = scene.frame_current
+        for arm in bpy.data.armatures:
+            arm.pose_position = 'POSE'
+        armatures = []
+        for data in self.armatures.values():
+            if self.can_evaluate_armature(data['object']):
+                self.evaluate_armature(data)
+            else:
+                armatures.append(data)
+        shape_keys = []
+        for data in self.shape_keys.values():
+            if self.can_evaluate_shape_keys(data['object']):
+                self.evaluate_shape_keys(data)
+            else:
+                shape_keys.append(data)
+        if armatures or shape_keys:
+            for i, f in enumerate(self.frames):
+                # Fractional frames of the resampled clips
+                frame = int(math.floor(f))
+                scene.frame_set(frame, subframe = f - frame)
+                for data in armatures:
+                    arm = data['object']
+                    pose = data['pose'][i]
+                    arm.pose.bones.foreach_get('matrix', pose.reshape(-1))
+                    # Matrices are stored by columns
+                    pose[:] = pose.transpose((0, 2, 1)).copy()
+                    data['world'][i] = matrix_to_array(arm.matrix_world)
+                for data in shape_keys:
+                    key_blocks = data['object'].data.shape_keys.key_blocks
+                    key_blocks.foreach_get('value', data['values'][i])
+            scene.frame_set(current_f)
+        self.sampled = True
+
+    def get_indices(self, frames):
+        """ Return indices of the given frames in the buffers.
+        """
+        return np.array([self.frame_index[f] for f in frames], dtype=np.int64)
+
+    def get_pose_matrices(self, arm, frames):
+        """ Return (frames, bones, 4, 4) array of the pose bones matrices
+        (in the armature space) in order of the arm.pose.bones.
+        """
+        return self.armatures[arm.name]['pose'][self.get_indices(frames)]
+
+    def get_world_matrices(self, arm, frames):
+        """ Return (frames, 4, 4) array of the armature world matrices.
+        """
+        return self.armatures[arm.name]['world'][self.get_indices(frames)]
+
+    def get_shape_values(self, obj, frames):
+        """ Return (frames, keys) array of the shape keys values.
+        """
+        return self.shape_keys[obj.name]['values'][self.get_indices(frames)]
@@ -1,13 +1,19 @@
 """ Part of the YABEE
 """
 
-import bpy, os, sys, shutil
+import bpy, bmesh, os, sys, shutil, json
+import numpy as np
 from mathutils import *
 from math import pi
 #import io_scene_egg.yabee_libs
 #from . import yabee_libs
-from .texture_processor import SimpleTextures, TextureBaker, RawTextures, PbrTextures
+from .texture_processor import SimpleTextures, TextureBaker, RawTextures, PbrTextures, \
+                               make_atlas_uvs, remove_atlas_uvs
 from .utils import *
+from .fragment_cache import FragmentCache, hash_data, hash_files
+from .anim_sampler import TimelineSampler, get_action_targets
+from .texture_copier import TextureCopier
+from .texture_atlas import AtlasBuilder
 import subprocess
 import imp
 from traceback import format_tb, print_exc
@@ -16,6 +22,10 @@ from traceback import format_tb, print_exc
 lib_name = '.'.join(__name__.split('.')[:-1])
 imp.reload(sys.modules[lib_name + '.texture_processor'])
 imp.reload(sys.modules[lib_name + '.utils'])
+imp.reload(sys.modules[lib_name + '.fragment_cache'])
+imp.reload(sys.modules[lib_name + '.anim_sampler'])
+imp.reload(sys.modules[lib_name + '.texture_copier'])
+imp.reload(sys.modules[lib_name + '.texture_atlas'])
 
 
 FILE_PATH = None
@@ -34,9 +44,54 @@ PVIEW = True
 EXPORT_PBS = False
 FORCE_EXPORT_VERTEX_COLORS=False
 USE_LOOP_NORMALS = False
-STRF = lambda x: '%.6f' % x
+WELD_VERTICES = False
+WELD_TOLERANCE = 0.000001
+MAX_INFLUENCES = 0
+SKIN_MIN_WEIGHT = 0.0001
+WEIGHT_STEPS = 0
+#: Minimal length of the morph target offset
+SHAPE_KEY_THRESHOLD = 0.000001
+#: {object name: set of the shape key names}, keys without offsets
+STATIC_SHAPE_KEYS = {}
+COMPRESS_LEVEL = 6
+ANIM_PRUNE = False
+#: {action name: armature name or list of names} for ANIMS_FROM_ACTIONS
+ACTION_MAP = None
+#: Sample rate of the animations from actions, 0 - one sample per frame
+ACTION_RATE = 0
+ANIM_TOLERANCE = 0.0
+#: Channels of the joint animation and their default values
+XFM_CHANNELS = 'ijkprhxyz'
+XFM_DEFAULTS = (1, 1, 1, 0, 0, 0, 0, 0, 0)
+#: Default number of digits after the point for the each data channel
+DEFAULT_PRECISION = {'xyz': 6, 'normal': 6, 'uv': 6, 'weight': 6, 'anim': 6}
+PRECISION = DEFAULT_PRECISION
+STRF = make_float_formatter(6)
+STRF_XYZ = STRF
+STRF_NORMAL = STRF
+STRF_UV = STRF
+STRF_WEIGHT = STRF
+STRF_ANIM = STRF
 USED_MATERIALS = None
 USED_TEXTURES = None
+FRAGMENT_CACHE = None
+TEXTURE_COPIER = None
+#: {texture name: name of the written <Texture> with the same image}
+TEXTURE_ALIASES = {}
+#: Size of the texture atlas page, 0 - don't pack the face textures
+ATLAS_SIZE = 0
+#: Border around the each image in the atlas page in pixels
+ATLAS_PADDING = 8
+#: {texture name: (atlas page name, u offset, v offset, u scale, v scale)}
+ATLAS_PLACEMENTS = {}
+#: Bake all objects into the one image per bake type
+BAKE_ATLAS = False
+#: (mesh, layer name) of the atlas UV layers, removed after the export
+ATLAS_UV_LAYERS = []
+#: {object name: temporary mesh with applied modifiers}
+EXPORT_MESHES = {}
+#: {object name: armature object}, parents instead of the real ones
+PARENT_OVERRIDES = {}
 
 
 # const used to pack string array into StringProperty
@@ -67,43 +122,23 @@ class Group:
             else:
                 self._yabee_object = EGGBaseObjectData(self.object)
 
-    def update_joints_data(self, actor_data_list = None):
-        if actor_data_list == None:
+    def update_joints_data(self, joints_index = None):
+        """ Create the joints data for the bones of the hierarchy.
+
+        @param joints_index: dict {(armature name, bone name): [vertex
+        references of the actors]}. Made from the hierarchy if None.
+        """
+        if joints_index is None:
             actor_data_list = []
             hierarchy_to_list(self, actor_data_list, base_filter = EGGActorObjectData)
-            #print(tmp)
+            joints_index = make_joints_index(actor_data_list)
         if not self._yabee_object and self.object \
            and self.object.__class__ == bpy.types.Bone:
-            vref = []
-            for ad in actor_data_list:
-                if self.object.name in ad._yabee_object.joint_vtx_ref.keys():
-                    vref.append(ad._yabee_object.joint_vtx_ref[self.object.name])
+            arm_name = self.arm_owner and self.arm_owner.name
+            vref = joints_index.get((arm_name, self.object.name), [])
             self._yabee_object = EGGJointObjectData(self.object, vref, self.arm_owner)
         for ch in self.children:
-            ch.update_joints_data(actor_data_list)
-
-    def check_parenting(self, p, o, obj_list):
-        # 0 - Not
-        # 1 - Object to object
-        # 2 - Bone to Bone
-        # 3 - Object to Bone
-        if o.__class__ == bpy.types.Bone and not o.parent:
-            return 0
-        if p.__class__ != bpy.types.Bone and o.parent == p \
-           and not (p and p.type == 'ARMATURE' and o.parent_bone):
-            return 1
-        if not p and (str(o.parent) not in map(str,obj_list)):
-            return 1
-        if p and p.__class__ == bpy.types.Bone \
-           and o.__class__ == bpy.types.Bone and o.parent == p:
-            return 2
-        # ACHTUNG!!! Be careful: If we have two armatures with the
-        # same bones name and object, attached to it,
-        # then we can get unexpected results!
-        if o.__class__ != bpy.types.Bone and o.parent_type == 'BONE' \
-           and p and o.parent_bone == p.name:
-            return 3
-        return 0
+            ch.update_joints_data(joints_index)
 
     def make_hierarchy_from_list(self, obj_list):
         """ This function make <Group> hierarchy from the list of
@@ -113,34 +148,35 @@ class Group:
         @param obj_list: tuple or lis of blender's objects.
         """
         try:
-            if self.object and self.object.__class__ != bpy.types.Bone and \
-            self.object.type == 'ARMATURE':
-                obj_list += self.object.data.bones
-                for bone in self.object.data.bones:
-                    if not bone.parent:
-                        try:
-                            gr = self.__class__(bone, self.object)
-                        except:
-                            print_exc()
-                            return ['ERR_MK_OBJ',]
-                        self.children.append(gr)
-                        gr.make_hierarchy_from_list(obj_list)
-            for obj in obj_list:
-                if self.check_parenting(self.object, obj, obj_list) > 0:
+            index = make_hierarchy_index(obj_list)
+        except Exception as exc:
+            print_exc()
+            return ['ERR_MK_HIERARCHY',]
+        return self.make_hierarchy_from_index(index)
+
+    def make_hierarchy_from_index(self, index):
+        """ Make <Group> hierarchy, started from self.object, from the
+        parent to children index.
+
+        @param index: dict {parent: [children]}, see make_hierarchy_index().
+        """
+        try:
+            for obj in index.get(self.object, ()):
+                try:
                     if obj.__class__ == bpy.types.Bone:
-                        try:
-                            gr = self.__class__(obj, self.arm_owner)
-                        except:
-                            print_exc()
-                            return ['ERR_MK_OBJ',]
+                        arm_owner = self.arm_owner
+                        if self.object and self.object.__class__ != bpy.types.Bone:
+                            arm_owner = self.object
+                        gr = self.__class__(obj, arm_owner)
                     else:
-                        try:
-                            gr = self.__class__(obj)
-                        except:
-                            print_exc()
-                            return ['ERR_MK_OBJ',]
-                    self.children.append(gr)
-                    gr.make_hierarchy_from_list(obj_list)
+                        gr = self.__class__(obj)
+                except:
+                    print_exc()
+                    return ['ERR_MK_OBJ',]
+                self.children.append(gr)
+                errors = gr.make_hierarchy_from_index(index)
+                if errors:
+                    return errors
         except Exception as exc:
             #print('\n'.join(format_tb(exc.__traceback__)))
             print_exc()
@@ -184,41 +220,80 @@ class Group:
         return egg_str
 
     def get_full_egg_str(self, level = 0):
-        return ''.join(self.get_full_egg_str_arr(level))
+        return get_egg_str(self.write_egg, level)
 
-    def get_full_egg_str_arr(self,level = 0):
-        """ Create and return representation of the EGG  <Group>
-        with hierarchy, started from self.object. It's start point to
+    def write_egg(self, stream):
+        """ Write representation of the EGG <Group> with hierarchy,
+        started from self.object, to the stream. It's start point to
         generating EGG structure.
 
-        @param level: starting indent level.
-
-        @return: full EGG string of group.
+        @param stream: EGGStream to write to.
         """
-        egg_str = []
         if self.object:
             if self.object.__class__ == bpy.types.Bone:
-                egg_str.append( '%s<Joint> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name)) )
-                #self._yabee_object = EGGJointObjectData(self.object, {}, self.arm_owner)
+                header = '<Joint> %s' % eggSafeName(self.object.yabee_name)
             else:
-                egg_str.append( '%s<Group> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name)) )
-                egg_str.append( self.get_tags_egg_str(level + 1) )
-                if self.object.type == 'MESH' \
-                   and (self.object.data.shape_keys \
-                        and len(self.object.data.shape_keys.key_blocks) > 1):
-                    egg_str.append( '%s<Dart> { 1 }\n' % ('  ' * (level + 1)) )
-                elif self.object.type == 'ARMATURE':
-                    egg_str.append( '%s<Dart> { 1 }\n' % ('  ' * (level + 1)) )
-            if self._yabee_object:
-                for line in self._yabee_object.get_full_egg_str().splitlines():
-                    egg_str.append( '%s%s\n' % ('  ' * (level + 1), line) )
-            for ch in self.children:
-                egg_str.append( ch.get_full_egg_str(level + 1) )
-            egg_str.append( '%s}\n' % ('  ' * level) )
+                header = '<Group> %s' % eggSafeName(self.object.yabee_name)
+            with stream.block(header):
+                self.write_own_egg(stream)
+                for ch in self.children:
+                    ch.write_egg(stream)
         else:
             for ch in self.children:
-                egg_str.append( ch.get_full_egg_str(level + 1) )
-        return egg_str
+                ch.write_egg(stream)
+
+    def write_own_egg(self, stream):
+        """ Write the data of the self.object without children to the
+        stream. If the fragment cache is used, then the data is taken
+        from the cache when possible.
+
+        @param stream: EGGStream to write to.
+        """
+        key = None
+        if FRAGMENT_CACHE is not None:
+            key = self.get_cache_key()
+        if key is None:
+            self.write_object_egg(stream)
+            return
+        text = FRAGMENT_CACHE.get(key)
+        if text is None:
+            text = get_egg_str(self.write_object_egg)
+            FRAGMENT_CACHE.put(key, text)
+        stream.write(text)
+
+    def write_object_egg(self, stream):
+        """ Write tags and the object data of the self.object.
+
+        @param stream: EGGStream to write to.
+        """
+        if self.object.__class__ != bpy.types.Bone:
+            stream.write(self.get_tags_egg_str())
+            if self.object.type == 'MESH' \
+               and (self.object.data.shape_keys \
+                    and len(self.object.data.shape_keys.key_blocks) > 1):
+                stream.line('<Dart> { 1 }')
+            elif self.object.type == 'ARMATURE':
+                stream.line('<Dart> { 1 }')
+        if self._yabee_object:
+            self._yabee_object.write_egg(stream)
+
+    def get_cache_key(self):
+        """ Return the fragment cache key of the data, written by
+        write_object_egg(), or None if the data can't be cached.
+        """
+        obj_data = None
+        if self._yabee_object:
+            obj_data = self._yabee_object.get_hash_data()
+            if obj_data is None:
+                return None
+        if self.object.__class__ == bpy.types.Bone:
+            return FRAGMENT_CACHE.make_key('Bone', self.object.yabee_name,
+                                           obj_data)
+        tags = [(prop.name, prop.type, prop.value)
+                for prop in self.object.game.properties]
+        return FRAGMENT_CACHE.make_key(self.object.type,
+                                       self.object.yabee_name,
+                                       tags, obj_data)
 
 
 class EGGArmature(Group):
@@ -236,27 +311,29 @@ class EGGArmature(Group):
 
         @return: the EGG string with joints hierarchy
         """
-        egg_str = ''
+        return get_egg_str(self.write_egg, level, vrefs, arm_owner)
+
+    def write_egg(self, stream, vrefs, arm_owner):
+        """ Write the EGG <Joint> with hierachy to the stream.
+
+        @param stream: EGGStream to write to.
+        @param vrefs: reference of vertices, linked to bones.
+        @param arm_owner: Armature object - owner of the bones
+        """
         if self.object:
-            #egg_str += '%s<Joint> %s {\n' % ('  ' * level, eggSafeName(self.object.name))
-            egg_str += '%s<Joint> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name))
-            # Get vertices reference by Bone name from globlal armature vref
-            #if self.object.name in list(vrefs.keys()):
-            #    vref = vrefs[self.object.name]
-            if self.object.yabee_name in list(vrefs.keys()):
-                vref = vrefs[self.object.yabee_name]
-            else:
-                vref = {}
-            joint = EGGJointObjectData(self.object, vref, arm_owner)
-            for line in joint.get_full_egg_str().splitlines():
-                egg_str += '%s%s\n' % ('  ' * (level + 1), line)
-            for ch in self.children:
-                egg_str += ch.get_full_egg_str(vrefs, arm_owner, level + 1)
-            egg_str += '%s}\n' % ('  ' * level)
+            with stream.block('<Joint> %s' % eggSafeName(self.object.yabee_name)):
+                # Get vertices reference by Bone name from globlal armature vref
+                if self.object.yabee_name in vrefs:
+                    vref = vrefs[self.object.yabee_name]
+                else:
+                    vref = {}
+                joint = EGGJointObjectData(self.object, vref, arm_owner)
+                joint.write_egg(stream)
+                for ch in self.children:
+                    ch.write_egg(stream, vrefs, arm_owner)
         else:
             for ch in self.children:
-                egg_str += ch.get_full_egg_str(vrefs, arm_owner, level + 1)
-        return egg_str
+                ch.write_egg(stream, vrefs, arm_owner)
 
 
 #-----------------------------------------------------------------------
@@ -268,7 +345,10 @@ class EGGBaseObjectData:
 
     def __init__(self, obj):
         self.obj_ref = obj
-        if obj.parent:
+        parent = get_parent(obj)
+        if parent and parent != obj.parent:
+            self.transform_matrix = parent.matrix_world.inverted() * obj.matrix_world
+        elif parent:
             self.transform_matrix = obj.matrix_local
         else:
             self.transform_matrix = obj.matrix_world
@@ -279,15 +359,28 @@ class EGGBaseObjectData:
         tr_str = ['<Transform> {\n  <Matrix4> {\n',]
         for y in self.transform_matrix.col:
             tr_str.append( '    ' )
-            for x in y[:]:
-                #tr_str += [STRF( x ), ' ']
-                tr_str += [str( x ), ' ']
+            tr_str.append(' '.join(map(STRF_XYZ, y[:])))
             tr_str.append('\n')
         tr_str.append( '  }\n}\n' )
         return ''.join(tr_str)
 
+    def get_hash_data(self):
+        """ Return the data, which defines the EGG text of the object.
+        Used as the fragment cache key. None means that the object
+        can't be cached.
+        """
+        return [self.__class__.__name__, self.transform_matrix]
+
     def get_full_egg_str(self):
-        return self.get_transform_str() + '\n'
+        return get_egg_str(self.write_egg)
+
+    def write_egg(self, stream):
+        """ Write the EGG data of the object to the stream.
+
+        @param stream: EGGStream to write to.
+        """
+        stream.write(self.get_transform_str())
+        stream.line('')
 
 
 class EGGNurbsCurveObjectData(EGGBaseObjectData):
@@ -301,7 +394,7 @@ class EGGNurbsCurveObjectData(EGGBaseObjectData):
                 co = self.obj_ref.matrix_world * vtx.co
                 fixed_co = tuple(map(lambda x: x * co[3], co[:3])) + (co[3],)
                 vertices.append('<Vertex> %i {\n  %s\n}\n' % (idx,
-                                    ' '.join(map(STRF, fixed_co))))
+                                    ' '.join(map(STRF_XYZ, fixed_co))))
                 idx += 1
         return vertices
 
@@ -351,8 +444,20 @@ class EGGNurbsCurveObjectData(EGGBaseObjectData):
                 idx += spline.point_count_u
         return cur_str
 
-    def get_full_egg_str(self):
-        return self.get_transform_str() + self.get_vtx_pool_str() + self.get_curves_str()
+    def get_hash_data(self):
+        data = EGGBaseObjectData.get_hash_data(self)
+        data.append(self.obj_ref.matrix_world)
+        for spline in self.obj_ref.data.splines:
+            data.append((spline.type, spline.resolution_u,
+                         spline.point_count_u, spline.order_u,
+                         spline.use_endpoint_u,
+                         foreach_get_array(spline.points, 'co', np.float32, 4)))
+        return data
+
+    def write_egg(self, stream):
+        stream.write(self.get_transform_str())
+        stream.write(self.get_vtx_pool_str())
+        stream.write(self.get_curves_str())
 
 
 class EGGJointObjectData(EGGBaseObjectData):
@@ -380,11 +485,11 @@ class EGGJointObjectData(EGGBaseObjectData):
             for vpool, data in meshes.items():
                 weightgroups = {}
                 for idx, weight in data:
-                    #wstr = '%s' % STRF(weight)
-                    wstr = '%f' % weight
-                    if wstr not in list(weightgroups.keys()):
-                        weightgroups[wstr] = []
-                    weightgroups[wstr].append(idx)
+                    wstr = STRF_WEIGHT(weight)
+                    if wstr in weightgroups:
+                        weightgroups[wstr].append(idx)
+                    else:
+                        weightgroups[wstr] = [idx]
                 for wgrp, idxs in weightgroups.items():
                     vref_str += '<VertexRef> {\n'
                     vref_str += '  ' + ' '.join(map(str,idxs)) + '\n'
@@ -392,22 +497,12 @@ class EGGJointObjectData(EGGBaseObjectData):
                     vref_str += '  <Ref> { %s }\n}\n' % vpool
         return vref_str
 
-    def get_full_egg_str(self):
-        egg_str = ''
-        egg_str += self.get_transform_str()
-        egg_str += self.get_vref_str()
-        '''
-        for obj in [obj for obj in bpy.context.selected_objects \
-                    if self.obj_ref.yabee_name == obj.parent_bone and self.arm_owner == obj.parent]:
-            gr = Group(None)
-            obj_list = []
-            hierarchy_to_list(obj, obj_list)
-            obj_list = [obj for obj in obj_list if (obj in bpy.context.selected_objects)]
-            gr.make_hierarchy_from_list(obj_list)
-            for line in gr.get_full_egg_str(-1).splitlines():
-                egg_str += line + '\n'
-        '''
-        return  egg_str
+    def get_hash_data(self):
+        return EGGBaseObjectData.get_hash_data(self) + [self.vref]
+
+    def write_egg(self, stream):
+        stream.write(self.get_transform_str())
+        stream.write(self.get_vref_str())
 
 
 #-----------------------------------------------------------------------
@@ -419,6 +514,35 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
     def __init__(self, obj):
         EGGBaseObjectData.__init__(self, obj)
+        self.mesh = get_export_mesh(obj)
+        # Only the raw mesh data is read here. It defines the fragment
+        # cache key, the rest is converted by prepare() on demand.
+        self.prepared = False
+        self.hash_data = None
+        self.pre_extract_arrays()
+        self.pre_check_materials()
+        self.position_matrix = matrix_to_array(self.vertex_matrix)
+        self.pre_check_shape_keys()
+
+        # Store current active UV name
+        self.active_uv = None
+        auv = [uv for uv in self.mesh.uv_textures if uv.active]
+        if auv and self.uses_nodes == False: # if we use nodes we don't want the active-uv name to be empty later on. (we need those to acces from uv-map nodes)
+            self.active_uv = auv[0].name
+
+        # Map of the converted vertex index to the written <Vertex> index.
+        # None means that every polygon corner gets its own <Vertex>.
+        self.vtx_weld_map = None
+        self.vtx_weld_src = None
+
+    def prepare(self):
+        """ Convert the raw arrays to the vertices and polygons data.
+        Called once, when the EGG text of the object is generated,
+        so the objects taken from the fragment cache skip it.
+        """
+        if self.prepared:
+            return
+        self.prepared = True
         self.poly_vtx_ref = self.pre_convert_poly_vtx_ref()
         self.smooth_vtx_list = self.get_smooth_vtx_list()
         self.colors_vtx_ref = self.pre_convert_vtx_color()
@@ -426,20 +550,80 @@ class EGGMeshObjectData(EGGBaseObjectData):
         self.tangent_layers = None
         if CALC_TBS == 'BLENDER':
             self.tangent_layers = self.pre_calc_TBS()
+        if (self.need_orco == True) and (self.uses_nodes == False):
+            self.pre_calc_ORCO()
+        self.pre_transform_arrays()
+        self.vtx_dxyz = self.pre_extract_shape_keys()
+        if WELD_VERTICES:
+            self.vtx_weld_map, self.vtx_weld_src = self.pre_weld_vertices()
 
+
+    #-------------------------------------------------------------------
+    #                           AUXILIARY
+
+    def pre_extract_arrays(self):
+        """ Read the mesh data into the contiguous arrays, one
+        foreach_get call per attribute. All the pre_convert_* and
+        collect_* stages work from these arrays instead of the
+        per element access to the Blender's data. The same arrays
+        make the fragment cache key (see get_hash_data()).
+        """
+        mesh = self.mesh
+        self.vtx_co = foreach_get_array(mesh.vertices, 'co', np.float32, 3)
+        self.vtx_normal = foreach_get_array(mesh.vertices, 'normal', np.float32, 3)
+        self.loop_vidx = foreach_get_array(mesh.loops, 'vertex_index', np.int32)
+        self.poly_loop_start = foreach_get_array(mesh.polygons, 'loop_start', np.int32)
+        self.poly_loop_total = foreach_get_array(mesh.polygons, 'loop_total', np.int32)
+        self.poly_normal = foreach_get_array(mesh.polygons, 'normal', np.float32, 3)
+        self.poly_material = foreach_get_array(mesh.polygons, 'material_index', np.int32)
+        self.poly_smooth = foreach_get_array(mesh.polygons, 'use_smooth', bool)
+
+        # The EGG (converted) vertices are the polygon corners, numbered
+        # polygon by polygon. Map them to the Blender's loops and vertices.
+        self.corner_start = np.cumsum(self.poly_loop_total) - self.poly_loop_total
+        self.corner_poly = np.repeat(np.arange(len(self.poly_loop_total)),
+                                     self.poly_loop_total)
+        self.corner_loop = np.arange(len(self.corner_poly)) \
+                           - self.corner_start[self.corner_poly] \
+                           + self.poly_loop_start[self.corner_poly]
+        self.corner_vidx = self.loop_vidx[self.corner_loop]
+
+        # Custom normals are stored per loop, but written per vertex.
+        self.vtx_loop_normal = None
+        if USE_LOOP_NORMALS and mesh.has_custom_normals:
+            loop_normal = foreach_get_array(mesh.loops, 'normal', np.float32, 3)
+            vtx_loop = np.zeros(len(self.vtx_co), dtype=np.int64)
+            vtx_loop[self.corner_vidx] = self.corner_loop
+            self.vtx_loop_normal = loop_normal[vtx_loop]
+
+        self.loop_uvs = [(uv_layer.name, foreach_get_array(uv_layer.data, 'uv', np.float32, 2))
+                         for uv_layer in mesh.uv_layers]
+        self.loop_color = None
+        if mesh.vertex_colors.active:
+            self.loop_color = foreach_get_array(mesh.vertex_colors.active.data,
+                                                'color', np.float32, 3)
+        self.shape_key_co = []
+        if mesh.shape_keys and len(mesh.shape_keys.key_blocks) > 1:
+            self.shape_key_co = [(key.name, foreach_get_array(key.data, 'co', np.float32, 3))
+                                 for key in mesh.shape_keys.key_blocks[1:]]
+
+    def pre_check_materials(self):
+        """ Check the materials of the polygons for the billboards and
+        the ORCO texture coordinates and set the vertex_matrix.
+        """
         self.billboard_type = None
 
         # Check if we may need to generate ORCO coordinates.
-        uses_nodes = False
-        need_orco = False
-        for f in self.obj_ref.data.polygons:
-            if f.material_index >= len(obj.data.materials):
+        self.uses_nodes = False
+        self.need_orco = False
+        for mat_idx in np.unique(self.poly_material).tolist():
+            if mat_idx >= len(self.mesh.materials):
                 continue
-            material = obj.data.materials[f.material_index]
+            material = self.mesh.materials[mat_idx]
             if not material:
                 continue
             if material.use_nodes:
-                uses_nodes = True
+                self.uses_nodes = True
             if material.game_settings:
                 if material.game_settings.face_orientation == 'BILLBOARD':
                     self.billboard_type = 'axis'
@@ -447,12 +631,9 @@ class EGGMeshObjectData(EGGBaseObjectData):
                     self.billboard_type = 'point'
             for slot in material.texture_slots:
                 if slot and slot.texture_coords == 'ORCO':
-                    need_orco = True
+                    self.need_orco = True
                     break
 
-        if (need_orco == True) and (uses_nodes == False):
-            self.pre_calc_ORCO()
-
         # Billboards use local coordinates in egg, plus we need to rotate since
         # they face down the X axis in Blender.
         if self.billboard_type:
@@ -464,126 +645,240 @@ class EGGMeshObjectData(EGGBaseObjectData):
         else:
             self.vertex_matrix = self.obj_ref.matrix_world
 
-        # Store current active UV name
-        self.active_uv = None
-        auv = [uv for uv in obj.data.uv_textures if uv.active]
-        if auv and uses_nodes == False: # if we use nodes we don't want the active-uv name to be empty later on. (we need those to acces from uv-map nodes)
-            self.active_uv = auv[0].name
-
-
-    #-------------------------------------------------------------------
-    #                           AUXILIARY
+    def pre_transform_arrays(self):
+        """ Transform positions and normals by the vertex_matrix once
+        per object. Normals are transformed by the normal matrix (inverse
+        transpose), which is correct under the non-uniform scale.
+        """
+        self.normal_matrix = get_normal_matrix(self.position_matrix)
+        # Formatted once per Blender's vertex, not per EGG vertex
+        self.vtx_world_co = format_rows(STRF_XYZ,
+                transform_points(self.position_matrix, self.vtx_co))
+        if self.vtx_loop_normal is not None:
+            normals = self.vtx_loop_normal
+        else:
+            normals = self.vtx_normal
+        self.vtx_world_normal = format_rows(STRF_NORMAL,
+                transform_normals(self.normal_matrix, normals))
+        self.poly_world_normal = format_rows(STRF_NORMAL,
+                transform_normals(self.normal_matrix, self.poly_normal))
+
+    def get_shape_key_offsets(self):
+        """ Return the morph target offsets of the shape keys relative
+        to the mesh vertices, one array operation per key. Offsets are
+        transformed by the linear part of the vertex_matrix, because
+        the translation cancels out.
+
+        @return: list of (shape key name, (vertices, 3) array).
+        """
+        linear = self.position_matrix[:3, :3]
+        return [(name, np.dot(co - self.vtx_co, linear.T))
+                for name, co in self.shape_key_co]
+
+    def pre_check_shape_keys(self):
+        """ Find the shape keys, which don't move any vertex, and store
+        them to the STATIC_SHAPE_KEYS. Done for the every object, even if
+        its EGG text is taken from the cache, because the animation
+        skips these keys too.
+        """
+        self.static_shape_keys = set()
+        if not self.shape_key_co:
+            return
+        for name, delta in self.get_shape_key_offsets():
+            if not ((delta * delta).sum(axis = 1) > SHAPE_KEY_THRESHOLD ** 2).any():
+                self.static_shape_keys.add(name)
+        if self.static_shape_keys:
+            print('INFO: %s: shape keys without offsets are skipped: %s' % \
+                  (self.obj_ref.yabee_name, ', '.join(sorted(self.static_shape_keys))))
+        STATIC_SHAPE_KEYS[self.obj_ref.yabee_name] = self.static_shape_keys
+
+    def pre_extract_shape_keys(self):
+        """ Format the morph target offsets of the shape keys. Keys
+        without offsets are skipped (see pre_check_shape_keys()).
+
+        @return: dict {Blender's vertex index: list of <Dxyz> strings}.
+        """
+        vtx_dxyz = {}
+        for key_name, delta in self.get_shape_key_offsets():
+            if key_name in self.static_shape_keys:
+                continue
+            moved = np.nonzero((delta * delta).sum(axis = 1)
+                               > SHAPE_KEY_THRESHOLD ** 2)[0]
+            name = eggSafeName(key_name)
+            for vidx, row in zip(moved.tolist(), format_rows(STRF_XYZ, delta[moved])):
+                vtx_dxyz.setdefault(vidx, []).append('  <Dxyz> %s { %s }' % (name, row))
+        return vtx_dxyz
 
     def get_smooth_vtx_list(self):
         """ Collect the smoothed polygon vertices
         for write normals of the vertices. In the EGG for the smooth
         shading used normals of vertices. For solid - polygons.
         """
-        vtx_list = []
-        for i,f in enumerate(self.obj_ref.data.polygons):
-            if f.use_smooth:
-                for v in self.poly_vtx_ref[i]:
-                    vtx_list.append(v)
-        vtx_list = set(vtx_list)
-
-        if self.obj_ref.data.use_auto_smooth:
-            sharp_edges = [e.key for e in self.obj_ref.data.edges if e.use_edge_sharp]
-            for i,f in enumerate(self.obj_ref.data.polygons):
-                for e in f.edge_keys:
-                    if e in sharp_edges:
-                        for ev in e:
-                            ei = list(f.vertices).index(ev)
-                            iv = self.poly_vtx_ref[i][ei]
-                            if iv in vtx_list:
-                                vtx_list.remove(iv)
-        return vtx_list
+        smooth = self.poly_smooth[self.corner_poly]
+        if self.mesh.use_auto_smooth and len(smooth):
+            # Corners, which lie on the sharp edge of their polygon
+            edges = self.mesh.edges
+            sharp_edges = foreach_get_array(edges, 'use_edge_sharp', bool)
+            loop_edge = foreach_get_array(self.mesh.loops, 'edge_index', np.int32)
+            corner_edge = loop_edge[self.corner_loop]
+            prev_corner = np.arange(len(smooth)) - 1
+            first = self.corner_start[self.corner_poly] == np.arange(len(smooth))
+            prev_corner[first] += self.poly_loop_total[self.corner_poly][first]
+            sharp = sharp_edges[corner_edge] | sharp_edges[corner_edge[prev_corner]]
+            smooth &= ~sharp
+        return set(np.nonzero(smooth)[0].tolist())
 
     def pre_convert_uvs(self):
         """ Blender uses shared vertices, but for the correct working
         UV and shading in the Panda needs to convert they are in the
         individual vertices for each polygon.
         """
-        uv_list = []
-        for uv_layer in self.obj_ref.data.uv_layers:
-            data = []
-            for uv_data in uv_layer.data:
-                u,v = uv_data.uv.to_2d()
-                data.append((u,v))
-            uv_list.append((uv_layer.name, data))
+        uv_list = [(name, data[self.corner_loop]) for name, data in self.loop_uvs]
+        if ATLAS_PLACEMENTS:
+            self.pre_apply_atlas(uv_list)
         return uv_list
 
+    def pre_apply_atlas(self, uv_list):
+        """ Move the UVs of the faces with the packed face textures
+        into the atlas page space.
+
+        @param uv_list: list of (uv layer name, UV of the converted
+        vertices), changed in place.
+        """
+        face_tex = [idx for idx, mat in enumerate(self.mesh.materials)
+                    if mat and mat.use_face_texture]
+        if not face_tex:
+            return
+        use_face = np.in1d(self.poly_material, face_tex)
+        layers = dict([(name, (images, face_image)) for name, images, face_image
+                       in get_face_image_index(self.mesh).layers])
+        for i, (name, data) in enumerate(uv_list):
+            if name not in layers:
+                continue
+            images, face_image = layers[name]
+            data = data.astype(np.float64)
+            for k, img in enumerate(images):
+                placement = ATLAS_PLACEMENTS.get('%s_%s' % (name, img.yabee_name))
+                if not placement:
+                    continue
+                page, u0, v0, su, sv = placement
+                corners = (use_face & (face_image == k))[self.corner_poly]
+                data[corners] = data[corners] * (su, sv) + (u0, v0)
+            uv_list[i] = (name, data)
+
     def pre_convert_poly_vtx_ref(self):
         """ Blender uses shared vertices, but for the correct working
         UV and shading in the Panda needs to convert they are in the
         individual vertices for each polygon.
         """
-        poly_vtx_ref = []
-        idx = 0
-        for face in self.obj_ref.data.polygons:
-            vtxs = []
-            for v in face.vertices:
-                vtxs.append(idx)
-                idx += 1
-            poly_vtx_ref.append(vtxs)
-        return poly_vtx_ref
+        return [range(start, start + total) for start, total
+                in zip(self.corner_start.tolist(), self.poly_loop_total.tolist())]
 
     def pre_convert_vtx_color(self):
-        color_vtx_ref = []
-        if self.obj_ref.data.vertex_colors.active:
-            for col in self.obj_ref.data.vertex_colors.active.data:
-                color_vtx_ref.append(col.color) # We have one color per data color
-            #for fi, face in enumerate(self.obj_ref.data.polygons):
-            #    col = self.obj_ref.data.vertex_colors.active.data[fi]
-            #    col = col.color1[:], col.color2[:], col.color3[:], col.color4[:]
-            #    for vi, v in enumerate(face.vertices):
-            #        color_vtx_ref.append(col[vi])
-        return color_vtx_ref
+        """ Collect vertex colors of the each converted vertex. Also
+        set self.colors_mask - which of the converted vertices should
+        get the <RGBA>.
+        """
+        self.colors_mask = None
+        mesh = self.mesh
+        if self.loop_color is None:
+            return None
+        # Don't write out vertex colors unless a material actually uses it.
+        use_colors = [bool(FORCE_EXPORT_VERTEX_COLORS or (mat and mat.use_vertex_color_paint))
+                      for mat in mesh.materials]
+        use_colors.append(False) # for the polygons without material
+        mat_idx = np.minimum(self.poly_material, len(mesh.materials))
+        self.colors_mask = np.array(use_colors)[mat_idx][self.corner_poly]
+        return self.loop_color[self.corner_loop]
 
     def pre_calc_TBS(self):
         """ Use Blender internal algorythm to generate tangent and
         bitangent (binormal) for each UV layer
         """
         tangent_layers = []
-        for idx, uvl in enumerate(self.obj_ref.data.uv_layers):
-            tangents = []
-            self.obj_ref.data.calc_tangents(uvl.name)
-            for loop in self.obj_ref.data.loops:
-                tangents.append(loop.tangent[:]+loop.bitangent[:])
-            tangent_layers.append(tangents)
+        mesh = self.mesh
+        for idx, uvl in enumerate(mesh.uv_layers):
+            mesh.calc_tangents(uvl.name)
+            tangents = foreach_get_array(mesh.loops, 'tangent', np.float32, 3)
+            bitangents = foreach_get_array(mesh.loops, 'bitangent', np.float32, 3)
+            tangent_layers.append(np.hstack((tangents, bitangents))[self.corner_loop])
         return tangent_layers
 
+    def get_vtx_weld_keys(self):
+        """ Return the keys of all attributes, which will be written
+        for the converted vertices, as the integer array with one row
+        per converted vertex. Vertices with the same key will be merged
+        into the one <Vertex>.
+        """
+        inv_tol = 1.0 / WELD_TOLERANCE
+        q = lambda arr: np.round(np.asarray(arr, dtype=np.float64) * inv_tol).astype(np.int64)
+        num = len(self.corner_vidx)
+        smooth = np.zeros((num, 1), dtype=np.int64)
+        smooth[list(self.smooth_vtx_list)] = 1
+        if self.vtx_loop_normal is not None:
+            normals = self.vtx_loop_normal[self.corner_vidx]
+        else:
+            normals = self.vtx_normal[self.corner_vidx]
+        keys = [q(self.vtx_co[self.corner_vidx]), q(normals) * smooth, smooth]
+        for i, uv in enumerate(self.uvs_list):
+            keys.append(q(uv[1]))
+            if self.tangent_layers and i < len(self.tangent_layers):
+                keys.append(q(self.tangent_layers[i]))
+        if self.colors_vtx_ref is not None:
+            mask = self.colors_mask.reshape((num, 1)).astype(np.int64)
+            keys += [q(self.colors_vtx_ref) * mask, mask]
+        # Morph targets are stored per Blender's vertex, so don't merge
+        # different vertices of the mesh with shape keys.
+        shape_keys = self.mesh.shape_keys
+        if shape_keys and len(shape_keys.key_blocks) > 1:
+            keys.append(self.corner_vidx.reshape((num, 1)))
+        return np.hstack(keys)
+
+    def pre_weld_vertices(self):
+        """ Merge the converted vertices with identical attributes
+        (within WELD_TOLERANCE) to the one <Vertex>.
+
+        @return: tuple of the two lists. First maps the converted
+        vertex index to the written <Vertex> index, second maps
+        the written <Vertex> index to the first converted vertex.
+        """
+        keys = self.get_vtx_weld_keys()
+        weld_map, weld_src = weld_rows(keys)
+        print('INFO: %s: %i vertices welded to %i' % (self.obj_ref.yabee_name,
+                                                    len(weld_map), len(weld_src)))
+        return weld_map.tolist(), weld_src.tolist()
+
+    def is_welded_vtx(self, idx):
+        """ Return True if the converted vertex was merged to
+        the another <Vertex> and shouldn't be written.
+
+        @param idx: the EGG (converted) vertex index.
+        """
+        return self.vtx_weld_map is not None \
+               and self.vtx_weld_src[self.vtx_weld_map[idx]] != idx
+
+    def get_vtx_index(self, idx):
+        """ Return the written <Vertex> index of the converted vertex.
+
+        @param idx: the EGG (converted) vertex index.
+        """
+        if self.vtx_weld_map is None:
+            return idx
+        return self.vtx_weld_map[idx]
+
     def pre_calc_ORCO(self):
         """ Generate texture coordinates for ORCO slots
         """
         print("precalculating orco")
-        # We first have to calculate the min and max vertex position...
-        minmax = None
-        for f in self.obj_ref.data.polygons:
-            for v in f.vertices:
-                pos = self.obj_ref.data.vertices[v].co
-                if minmax is None:
-                    minmax = (list(pos), list(pos))
-                for i in range(3):
-                    minmax[0][i] = min(pos[i], minmax[0][i])
-                    minmax[1][i] = max(pos[i], minmax[1][i])
-
-        if not minmax:
+        if not len(self.corner_vidx):
             return
-
-        inv_dims = [0, 0, 0]
-        for i in (0, 1, 2):
-            delta = (minmax[1][i] - minmax[0][i])
-            if delta > 0: # Prevent divide by zero
-                inv_dims[i] = 1.0 / delta
-
-        data = []
-        for f in self.obj_ref.data.polygons:
-            for v in f.vertices:
-                pos = self.obj_ref.data.vertices[v].co
-                orco = [(pos[i] - minmax[0][i]) * inv_dims[i] for i in (0, 1, 2)]
-                data.append(orco)
-
-        self.uvs_list.append(('ORCO', data))
+        pos = self.vtx_co[self.corner_vidx]
+        # We first have to calculate the min and max vertex position...
+        minimum = pos.min(axis = 0)
+        delta = pos.max(axis = 0) - minimum
+        # Prevent divide by zero
+        inv_dims = np.where(delta > 0, 1.0 / np.where(delta > 0, delta, 1.0), 0.0)
+        self.uvs_list.append(('ORCO', (pos - minimum) * inv_dims))
 
     #-------------------------------------------------------------------
     #                           VERTICES
@@ -596,8 +891,7 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
         @return: list of vertex attributes.
         """
-        co = self.vertex_matrix * self.obj_ref.data.vertices[vidx].co
-        attributes.append('%f %f %f' % co[:])
+        attributes.append('  ' + self.vtx_world_co[vidx])
         return attributes
 
     def collect_vtx_dxyz(self, vidx, attributes):
@@ -608,19 +902,14 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
         @return: list of vertex attributes.
         """
-        if ((self.obj_ref.data.shape_keys) and (len(self.obj_ref.data.shape_keys.key_blocks) > 1)):
-            for i in range(1,len(self.obj_ref.data.shape_keys.key_blocks)):
-                key = self.obj_ref.data.shape_keys.key_blocks[i]
-                vtx = self.obj_ref.data.vertices[vidx]
-                co = key.data[vidx].co * self.vertex_matrix - \
-                     vtx.co * self.vertex_matrix
-                if co.length > 0.000001:
-                    attributes.append('<Dxyz> %s { %f %f %f }\n' % \
-                                      (eggSafeName(key.name), co[0], co[1], co[2]))
+        if vidx in self.vtx_dxyz:
+            attributes.extend(self.vtx_dxyz[vidx])
         return attributes
 
     def collect_vtx_normal(self, v, idx, attributes):
-        """ Add <Normal> to the vertex attributes list.
+        """ Add <Normal> to the vertex attributes list. If the custom
+        normals are used, then it's the loop normal associated with
+        this Blender vertex index.
 
         @param v: Blender vertex index.
         @param idx: the EGG (converted) vertex index.
@@ -629,41 +918,26 @@ class EGGMeshObjectData(EGGBaseObjectData):
         @return: list of vertex attributes.
         """
         if idx in self.smooth_vtx_list:
-            no = self.vertex_matrix.to_euler().to_matrix() * self.obj_ref.data.vertices[v].normal
-            #no = self.obj_ref.data.vertices[v].normal
-            #no = self.obj_ref.data.loops[idx].normal
-            attributes.append('<Normal> { %f %f %f }' % no[:])
+            attributes.append('  <Normal> { %s }' % self.vtx_world_normal[v])
         return attributes
 
-    def collect_vtx_normal_from_loop(self, v, idx, attributes):
-        """ Add <Normal> to the vertex attributes list, using the loop normal associated with this Blender vertex index.
+    def collect_vtx_rgba(self, idx, attributes):
+        """ Add <RGBA> to the vertex attributes list.
 
-        @param v: Blender vertex index.
         @param idx: the EGG (converted) vertex index.
         @param attributes: list of vertex attributes
 
         @return: list of vertex attributes.
         """
-        if idx in self.smooth_vtx_list:
-            no = self.vertex_matrix.to_euler().to_matrix() * self.obj_ref.data.loops[self.map_vertex_to_loop[v]].normal
-            attributes.append('<Normal> { %f %f %f }' % no[:])
-        return attributes
-
-    def collect_vtx_rgba(self, vidx, face, attributes):
-        if self.colors_vtx_ref:
-            # Don't write out vertex colors unless a material actually uses it.
-            if face.material_index < len(self.obj_ref.data.materials):
-                mat = self.obj_ref.data.materials[face.material_index]
-                if FORCE_EXPORT_VERTEX_COLORS or (mat and mat.use_vertex_color_paint):
-                    col = self.colors_vtx_ref[vidx]
-                    attributes.append('<RGBA> { %f %f %f 1.0 }' % col[:])
+        if self.colors_vtx_ref is not None and self.colors_mask[idx]:
+            attributes.append('  <RGBA> { %s 1 }' % ' '.join(map(STRF, self.colors_vtx_ref[idx])))
         return attributes
 
     def collect_vtx_uv(self, vidx, ividx, attributes):
         """ Add <UV> to the vertex attributes list.
 
-        @param vidx: the EGG (converted) vertex index.
-        @param ividx: Blender internal vertex index.
+        @param vidx: Blender internal vertex index.
+        @param ividx: the EGG (converted) vertex index.
         @param attributes: list of vertex attributes
 
         @return: list of vertex attributes.
@@ -672,9 +946,10 @@ class EGGMeshObjectData(EGGBaseObjectData):
             name, data = uv
             if name == self.active_uv and name != 'ORCO': name = ''
             tbs = ''
-            if self.tangent_layers:
-                tbs = '\n    <Tangent> {%f %f %f}\n    <Binormal> {%f %f %f}' % self.tangent_layers[i][ividx]
-            uv_str = '  <UV> %s {\n    %f %f %s\n  }' % (eggSafeName(name), data[ividx][0], data[ividx][1], tbs)
+            if self.tangent_layers and i < len(self.tangent_layers):
+                t = list(map(STRF_NORMAL, self.tangent_layers[i][ividx]))
+                tbs = '\n    <Tangent> {%s}\n    <Binormal> {%s}' % (' '.join(t[:3]), ' '.join(t[3:]))
+            uv_str = '  <UV> %s {\n    %s %s %s\n  }' % (eggSafeName(name), STRF_UV(data[ividx][0]), STRF_UV(data[ividx][1]), tbs)
             attributes.append(uv_str)
 
         return attributes
@@ -686,29 +961,23 @@ class EGGMeshObjectData(EGGBaseObjectData):
         dxyz = self.collect_vtx_dxyz
         rgba = self.collect_vtx_rgba
         uv = self.collect_vtx_uv
-        if USE_LOOP_NORMALS and self.obj_ref.data.has_custom_normals:
-            self.map_vertex_to_loop = {self.obj_ref.data.loops[lidx].vertex_index: lidx
-                for p in self.obj_ref.data.polygons for lidx in p.loop_indices}
-            normal = self.collect_vtx_normal_from_loop
-        else:
-            normal = self.collect_vtx_normal
+        normal = self.collect_vtx_normal
 
         vertices = []
-        idx = 0
-        for f in self.obj_ref.data.polygons:
-            for v in f.vertices:
-                # v - Blender inner vertex index
-                # idx - Vertex index for the EGG
-                attributes = []
-                xyz(v, attributes)
-                dxyz(v, attributes)
-                normal(v, idx, attributes)
-                rgba(idx, f, attributes)
-                uv(v, idx, attributes)
-                str_attr = '\n'.join(attributes)
-                vtx = '\n<Vertex> %i {%s\n}' % (idx, str_attr)
-                vertices.append(vtx)
-                idx += 1
+        for idx, v in enumerate(self.corner_vidx.tolist()):
+            # v - Blender inner vertex index
+            # idx - Vertex index for the EGG
+            if self.is_welded_vtx(idx):
+                continue
+            attributes = []
+            xyz(v, attributes)
+            dxyz(v, attributes)
+            normal(v, idx, attributes)
+            rgba(idx, attributes)
+            uv(v, idx, attributes)
+            str_attr = '\n'.join(attributes)
+            vtx = '<Vertex> %i {\n%s\n}\n' % (self.get_vtx_index(idx), str_attr)
+            vertices.append(vtx)
         return vertices
 
 
@@ -749,8 +1018,8 @@ class EGGMeshObjectData(EGGBaseObjectData):
             # Find the material assigned to that polygon:
             # First, check if that polygon has a material at all
             material = None
-            if face.material_index < len(self.obj_ref.data.materials):
-                material = self.obj_ref.data.materials[face.material_index]
+            if face.material_index < len(self.mesh.materials):
+                material = self.mesh.materials[face.material_index]
             
             
             matIsFancyPBRNode = False
@@ -767,14 +1036,13 @@ class EGGMeshObjectData(EGGBaseObjectData):
                 if material.use_face_texture:
 
                     # Check all assigned uv textures of that object
-                    for uv_tex in self.obj_ref.data.uv_textures:
+                    for uv_name, image in get_face_image_index(self.mesh).get_face_images(face.index):
 
                         # Check if the polygon is assigned to that uv-texture
-                        facedata = uv_tex.data[face.index]
-                        if facedata.image:
+                        if image:
 
                             # If the polygon is assigned, store a reference to that texture
-                            tex_name = '%s_%s' % (uv_tex.name, facedata.image.yabee_name)
+                            tex_name = '%s_%s' % (uv_name, image.yabee_name)
                             if tex_name in USED_TEXTURES and tex_name not in textures:
                                 textures.append(tex_name)
 
@@ -829,19 +1097,24 @@ class EGGMeshObjectData(EGGBaseObjectData):
                 print("WARNING: Object", self.obj_ref.name, "has no material assigned!")
 
             # Store all textures
+            refs = []
             for tex_name in textures:
                 if tex_name in USED_TEXTURES: # Make sure that  we'll have this texture in header #todo:add this back once empties are added for PBR nodes
-                    attributes.append('<TRef> { %s }' % eggSafeName(tex_name))
+                    ref = get_texture_ref(tex_name)
+                    # PBR textures are bound by the order, so keep them all
+                    if ref not in refs or matIsFancyPBRNode:
+                        refs.append(ref)
+                        attributes.append('<TRef> { %s }' % eggSafeName(ref))
 
         else:
-            if self.obj_ref.data.uv_textures:
+            if self.mesh.uv_textures:
                 for btype, params in BAKE_LAYERS.items():
                     if len(params) == 2:
                         params = (params[0], params[0], params[1])
                     if params[2]:
                         attributes.append('<TRef> { %s }' \
-                                    % eggSafeName(self.obj_ref.yabee_name \
-                                    + '_' + btype))
+                                    % eggSafeName(get_texture_ref(self.obj_ref.yabee_name \
+                                    + '_' + btype)))
 
         return attributes
 
@@ -853,8 +1126,8 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
         @return: list of polygon's attributes.
         """
-        if face.material_index < len(self.obj_ref.data.materials):
-            mat = self.obj_ref.data.materials[face.material_index]
+        if face.material_index < len(self.mesh.materials):
+            mat = self.mesh.materials[face.material_index]
             if not mat:
                 return attributes
             attributes.append('<MRef> { %s }' % eggSafeName(mat.yabee_name))
@@ -868,14 +1141,19 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
         @return: list of polygon's attributes.
         """
-        no = self.vertex_matrix.to_euler().to_matrix() * face.normal
-        #attributes.append('<Normal> {%s %s %s}' % (STRF(no[0]), STRF(no[1]), STRF(no[2])))
-        attributes.append('<Normal> {%f %f %f}' % no[:])
+        attributes.append(self.get_poly_normal_str(face.index))
         return attributes
 
+    def get_poly_normal_str(self, idx):
+        """ Return the <Normal> string of the polygon.
+
+        @param idx: polygon index.
+        """
+        return '<Normal> {%s}' % self.poly_world_normal[idx]
+
     def collect_poly_rgba(self, face, attributes):
-        if face.material_index < len(self.obj_ref.data.materials):
-            mat = self.obj_ref.data.materials[face.material_index]
+        if face.material_index < len(self.mesh.materials):
+            mat = self.mesh.materials[face.material_index]
             if not mat:
                 return attributes
             if mat.use_shadeless and not mat.use_vertex_color_paint:
@@ -883,7 +1161,7 @@ class EGGMeshObjectData(EGGBaseObjectData):
                 # polygons...  The .egg loader should automatically convert
                 # this to a per-object color in most cases.  This makes
                 # shadeless materials also work when lighting is disabled.
-                attributes.append('<RGBA> {%f %f %f 1}' % tuple(mat.diffuse_color))
+                attributes.append('<RGBA> {%s 1}' % ' '.join(map(STRF, mat.diffuse_color)))
         return attributes
 
     def collect_poly_bface(self, face, attributes):
@@ -894,11 +1172,11 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
         @return: list of polygon's attributes.
         """
-        if face.material_index < len(self.obj_ref.data.materials):
-            if not self.obj_ref.data.materials[face.material_index]:
+        if face.material_index < len(self.mesh.materials):
+            if not self.mesh.materials[face.material_index]:
                 return attributes
 
-            if not self.obj_ref.data.materials[face.material_index].game_settings.use_backface_culling:
+            if not self.mesh.materials[face.material_index].game_settings.use_backface_culling:
                 attributes.append('<BFace> { 1 }')
         return attributes
 
@@ -910,62 +1188,152 @@ class EGGMeshObjectData(EGGBaseObjectData):
 
         @return: list of polygon's attributes.
         """
-        vr = ' '.join(map(str,self.poly_vtx_ref[face.index]))
-        attributes.append('<VertexRef> { %s <Ref> { %s }}' % (vr, eggSafeName(self.obj_ref.yabee_name)))
+        attributes.append(self.get_poly_vertexref_str(face.index))
         return attributes
 
+    def get_poly_vertexref_str(self, idx):
+        """ Return the <VertexRef> string of the polygon.
+
+        @param idx: polygon index.
+        """
+        vr = ' '.join([str(self.get_vtx_index(v)) for v in self.poly_vtx_ref[idx]])
+        return '<VertexRef> { %s <Ref> { %s }}' % (vr, eggSafeName(self.obj_ref.yabee_name))
+
+    def get_poly_template_keys(self):
+        """ Return the key of the material dependent attributes (<TRef>,
+        <MRef>, <RGBA>, <BFace>) for the each polygon. Polygons with the
+        same key have the same attributes. The key is the material index
+        and, if the material uses the face textures, the face images.
+        """
+        mesh = self.mesh
+        keys = self.poly_material.tolist()
+        if TEXTURE_PROCESSOR not in ('SIMPLE', 'RAW'):
+            return keys
+        face_tex = set([idx for idx, mat in enumerate(mesh.materials)
+                        if mat and mat.use_face_texture])
+        if not face_tex or not mesh.uv_textures:
+            return keys
+        face_image_keys = [np.asarray(face_image, dtype = np.int64)
+                           for uv_name, images, face_image
+                           in get_face_image_index(mesh).layers]
+        for idx, mat_idx in enumerate(keys):
+            if mat_idx in face_tex:
+                keys[idx] = (mat_idx, tuple([int(k[idx]) for k in face_image_keys]))
+        return keys
+
     def collect_polygons(self):
         """ Convert and collect polygons info
         """
-        tref = self.collect_poly_tref
-        mref = self.collect_poly_mref
-        normal = self.collect_poly_normal
-        rgba = self.collect_poly_rgba
-        bface = self.collect_poly_bface
-        vertexref = self.collect_poly_vertexref
+        normal = self.get_poly_normal_str
+        vertexref = self.get_poly_vertexref_str
+        # Material dependent attributes are collected once per key
+        templates = {}
         polygons = []
-        for f in self.obj_ref.data.polygons:
-            #poly = '<Polygon> {\n'
-            attributes = []
-            tref(f, attributes)
-            mref(f, attributes)
-            normal(f, attributes)
-            rgba(f, attributes)
-            bface(f, attributes)
-            vertexref(f, attributes)
-            #for attr in attributes:
-            #    for attr_str in attr.splitlines():
-            #        poly += '  ' + attr_str + '\n'
-            poly = '<Polygon> {\n  %s \n}\n' % ('\n  '.join(attributes),)
-
-            polygons.append(poly)
+        for idx, key in enumerate(self.get_poly_template_keys()):
+            if key not in templates:
+                f = self.mesh.polygons[idx]
+                prefix = []
+                self.collect_poly_tref(f, prefix)
+                self.collect_poly_mref(f, prefix)
+                suffix = []
+                self.collect_poly_rgba(f, suffix)
+                self.collect_poly_bface(f, suffix)
+                templates[key] = (''.join(['  %s\n' % a for a in prefix]),
+                                  ''.join(['  %s\n' % a for a in suffix]))
+            prefix, suffix = templates[key]
+            polygons.append('<Polygon> {\n%s  %s\n%s  %s \n}\n' % \
+                            (prefix, normal(idx), suffix, vertexref(idx)))
         return polygons
 
     def get_vtx_pool_str(self):
         """ Return the vertex pool string in the EGG syntax.
         """
-        vtx_pool = '<VertexPool> %s {\n' % eggSafeName(self.obj_ref.yabee_name)
-        vtxs = ''.join(self.collect_vertices())
-        vtxs = vtxs.replace('\n', '\n  ')
-        vtx_pool += vtxs
-        vtx_pool += '}\n'
-        return vtx_pool
+        return get_egg_str(self.write_vtx_pool)
+
+    def write_vtx_pool(self, stream):
+        """ Write the vertex pool in the EGG syntax to the stream.
+
+        @param stream: EGGStream to write to.
+        """
+        with stream.block('<VertexPool> %s' % eggSafeName(self.obj_ref.yabee_name)):
+            stream.write(''.join(self.collect_vertices()))
 
     def get_polygons_str(self):
         """ Return polygons string in the EGG syntax
         """
-        polygons = '\n' + ''.join(self.collect_polygons())
-        return polygons
+        return get_egg_str(self.write_polygons)
+
+    def write_polygons(self, stream):
+        """ Write polygons in the EGG syntax to the stream.
+
+        @param stream: EGGStream to write to.
+        """
+        stream.write(''.join(self.collect_polygons()))
+
+    def get_material_hash_data(self, mat):
+        """ Return the material properties, which affect the polygons.
+        """
+        if not mat:
+            return None
+        data = [mat.yabee_name, mat.yabee_texture_slots,
+                mat.use_face_texture, mat.use_nodes, mat.use_shadeless,
+                mat.use_vertex_color_paint, mat.diffuse_color,
+                mat.game_settings.use_backface_culling,
+                mat.game_settings.face_orientation,
+                [slot.texture_coords for slot in mat.texture_slots if slot]]
+        if mat.use_nodes and mat.node_tree:
+            data.append([(link.from_node.name, link.to_node.name,
+                          link.to_socket.name)
+                         for link in mat.node_tree.links])
+        return data
+
+    def get_hash_data(self):
+        if self.hash_data is not None:
+            return self.hash_data
+        mesh = self.mesh
+        data = EGGBaseObjectData.get_hash_data(self)
+        data += [self.position_matrix, self.billboard_type, self.active_uv,
+                 self.vtx_co, self.vtx_normal, self.vtx_loop_normal,
+                 self.loop_vidx, self.poly_loop_start, self.poly_loop_total,
+                 self.poly_normal, self.poly_material, self.poly_smooth,
+                 self.loop_uvs, self.loop_color, self.shape_key_co]
+        if mesh.use_auto_smooth:
+            data += [foreach_get_array(mesh.edges, 'use_edge_sharp', bool),
+                     foreach_get_array(mesh.loops, 'edge_index', np.int32)]
+        materials = [self.get_material_hash_data(mat)
+                     for mat in mesh.materials]
+        data.append(materials)
+        if [mat for mat in mesh.materials if mat and mat.use_face_texture]:
+            for uv_tex in mesh.uv_textures:
+                data.append((uv_tex.name,
+                             [d.image.yabee_name if d.image else ''
+                              for d in uv_tex.data]))
+        else:
+            data.append([uv_tex.name for uv_tex in mesh.uv_textures])
+        if mesh.shape_keys:
+            data.append([key.name for key in mesh.shape_keys.key_blocks])
+        self.hash_data = data
+        return data
 
     def get_full_egg_str(self):
         """ Return full mesh data representation in the EGG string syntax
         """
-        result = '\n'.join((self.get_transform_str(),
-                            self.get_vtx_pool_str(),
-                            self.get_polygons_str()))
+        return get_egg_str(self.write_egg)
+
+    def write_egg(self, stream):
+        """ Write full mesh data representation in the EGG syntax
+        to the stream.
+
+        @param stream: EGGStream to write to.
+        """
+        self.prepare()
         if self.billboard_type:
-            result = '<Billboard> { %s }\n%s' % (self.billboard_type, result)
-        return result
+            stream.line('<Billboard> { %s }' % self.billboard_type)
+        stream.write(self.get_transform_str())
+        stream.line('')
+        self.write_vtx_pool(stream)
+        stream.line('')
+        self.write_polygons(stream)
 
 
 #-----------------------------------------------------------------------
@@ -978,28 +1346,148 @@ class EGGActorObjectData(EGGMeshObjectData):
 
     def __init__(self, obj):
         EGGMeshObjectData.__init__(self,obj)
-        self.joint_vtx_ref = self.pre_convert_joint_vtx_ref()
-        #print(self.joint_vtx_ref)
+        self.joint_vtx_ref = None
+
+    def pre_extract_arrays(self):
+        EGGMeshObjectData.pre_extract_arrays(self)
+        self.pre_extract_skin()
+
+    def pre_extract_skin(self):
+        """ Read the vertex groups memberships as the (vertex, group,
+        weight) arrays, sorted by vertex and by weight descending inside
+        the vertex. Only groups, named as bones of the armatures from
+        the modifiers, are taken. Weights less than SKIN_MIN_WEIGHT
+        are dropped, the number of influences per vertex is limited by
+        MAX_INFLUENCES (if not 0) and remaining weights are normalized
+        and quantized to the WEIGHT_STEPS (if not 0).
+        """
+        self.skin_group_names = [g.name for g in self.obj_ref.vertex_groups]
+        bone_names = set()
+        for mod in self.obj_ref.modifiers:
+            if mod.type == 'ARMATURE' and mod.object:
+                bone_names.update([bone.name for bone in mod.object.data.bones])
+        is_bone = np.array([name in bone_names for name in self.skin_group_names]
+                           + [False])
+        vtx_groups = [vtx.groups for vtx in self.mesh.vertices]
+        counts = np.array([len(groups) for groups in vtx_groups], dtype=np.int64)
+        ends = np.cumsum(counts)
+        group = np.empty(ends[-1] if len(ends) else 0, dtype=np.int32)
+        weight = np.empty(len(group), dtype=np.float32)
+        # MeshVertex.groups has no mesh wide raw access, so each vertex
+        # is read by its own foreach_get
+        for groups, end, num in zip(vtx_groups, ends, counts):
+            if num:
+                groups.foreach_get('group', group[end - num:end])
+                groups.foreach_get('weight', weight[end - num:end])
+        vidx = np.repeat(np.arange(len(vtx_groups)), counts)
+        group = group.astype(np.int64)
+        weight = weight.astype(np.float64)
+        keep = is_bone[group] & (weight >= SKIN_MIN_WEIGHT)
+        vidx, group, weight = vidx[keep], group[keep], weight[keep]
+        # The strongest influences first
+        order = np.lexsort((-weight, vidx))
+        vidx, group, weight = vidx[order], group[order], weight[order]
+        if MAX_INFLUENCES > 0 and len(vidx):
+            rank = np.arange(len(vidx)) - np.searchsorted(vidx, vidx)
+            keep = rank < MAX_INFLUENCES
+            if not keep.all():
+                print('INFO: %s: %i influences over the limit of %i dropped' % \
+                      (self.obj_ref.yabee_name, len(keep) - keep.sum(), MAX_INFLUENCES))
+                vidx, group, weight = vidx[keep], group[keep], weight[keep]
+        total = np.bincount(vidx, weights = weight, minlength = len(self.vtx_co))
+        weight = weight / total[vidx]
+        if WEIGHT_STEPS > 0 and len(vidx):
+            q = quantize_weights(vidx, weight, WEIGHT_STEPS, len(self.vtx_co))
+            keep = q > 0
+            vidx, group = vidx[keep], group[keep]
+            weight = q[keep] / float(WEIGHT_STEPS)
+        self.skin_vidx, self.skin_group, self.skin_weight = vidx, group, weight
+
+    def get_vtx_weld_keys(self):
+        """ Extend the weld keys of the vertices by the joints memberships.
+        """
+        inv_tol = 1.0 / WELD_TOLERANCE
+        # (group, weight) pairs of the vertex, sorted by group, in a row
+        order = np.lexsort((self.skin_group, self.skin_vidx))
+        vidx = self.skin_vidx[order]
+        rank = np.arange(len(vidx)) - np.searchsorted(vidx, vidx)
+        width = int(rank.max()) + 1 if len(vidx) else 0
+        memberships = np.empty((len(self.vtx_co), width * 2), dtype=np.int64)
+        memberships.fill(-1)
+        memberships[vidx, rank * 2] = self.skin_group[order]
+        memberships[vidx, rank * 2 + 1] = np.round(self.skin_weight[order] * inv_tol)
+        keys = EGGMeshObjectData.get_vtx_weld_keys(self)
+        return np.hstack((keys, memberships[self.corner_vidx]))
 
     def pre_convert_joint_vtx_ref(self):
         """ Collect and convert vertices, assigned to the bones
+
+        @return: dict {group (bone) name: {vertex pool name:
+        [(EGG vertex index, weight), ...]}}
         """
+        # Written <Vertex> -> polygon corner -> Blender's vertex
+        if self.vtx_weld_src is not None:
+            egg_corner = np.array(self.vtx_weld_src, dtype=np.int64)
+        else:
+            egg_corner = np.arange(len(self.corner_vidx))
+        egg_vidx = self.corner_vidx[egg_corner]
+        # Memberships of the each written vertex
+        counts = np.bincount(self.skin_vidx, minlength = len(self.vtx_co))
+        starts = np.cumsum(counts) - counts
+        num = counts[egg_vidx]
+        offsets = np.cumsum(num) - num
+        egg_idx = np.repeat(np.arange(len(egg_vidx)), num)
+        rows = np.arange(num.sum()) - np.repeat(offsets, num) \
+               + np.repeat(starts[egg_vidx], num)
+        groups = self.skin_group[rows]
+        weights = self.skin_weight[rows]
+        # Group by the bone, keeping vertices order
+        order = np.argsort(groups, kind = 'mergesort')
+        groups, egg_idx, weights = groups[order], egg_idx[order], weights[order]
+        bounds = np.nonzero(np.diff(groups))[0] + 1
         joint_vref = {}
-        idx = 0
-        for face in self.obj_ref.data.polygons:
-            for v in face.vertices:
-                for g in self.obj_ref.data.vertices[v].groups:
-                    gname = self.obj_ref.vertex_groups[g.group].name
-                    # Goup name = Joint (bone) name
-                    if gname not in list(joint_vref.keys()):
-                        joint_vref[gname] = {}
-                    # Object name = vertices pool name
-                    if self.obj_ref.yabee_name not in list(joint_vref[gname].keys()):
-                        joint_vref[gname][self.obj_ref.yabee_name] = []
-                    joint_vref[gname][self.obj_ref.yabee_name].append((idx, g.weight))
-                idx += 1
+        pool = self.obj_ref.yabee_name
+        for g_idx, w_idx, w in zip(np.split(groups, bounds),
+                                   np.split(egg_idx, bounds),
+                                   np.split(weights, bounds)):
+            if len(g_idx):
+                gname = self.skin_group_names[int(g_idx[0])]
+                joint_vref[gname] = {pool: list(zip(w_idx.tolist(), w.tolist()))}
         return joint_vref
 
+    def get_joint_vtx_ref(self):
+        """ Return the vertices, assigned to the bones (see
+        pre_convert_joint_vtx_ref()). The welded vertex indices depend on
+        the all vertex data, so with the WELD_VERTICES the references
+        are kept in the fragment cache next to the EGG text of the object.
+        """
+        if self.joint_vtx_ref is not None:
+            return self.joint_vtx_ref
+        key = None
+        if WELD_VERTICES and FRAGMENT_CACHE is not None:
+            key = FRAGMENT_CACHE.make_key('JointVtxRef', self.get_hash_data())
+            text = FRAGMENT_CACHE.get(key)
+            if text is not None:
+                self.joint_vtx_ref = json.loads(text)
+                return self.joint_vtx_ref
+        if WELD_VERTICES:
+            self.prepare()
+        self.joint_vtx_ref = self.pre_convert_joint_vtx_ref()
+        if key is not None:
+            FRAGMENT_CACHE.put(key, json.dumps(self.joint_vtx_ref))
+        return self.joint_vtx_ref
+
+    def get_armature_names(self):
+        """ Return names of the armatures, deforming the object.
+        """
+        return [mod.object.name for mod in self.obj_ref.modifiers
+                if mod.type == 'ARMATURE' and mod.object]
+
+    def get_hash_data(self):
+        return EGGMeshObjectData.get_hash_data(self) + [
+                    self.skin_group_names, self.skin_vidx,
+                    self.skin_group, self.skin_weight]
+
     def get_joints_str(self):
         """ Make  the EGGArmature object from the bones, pass the
         vertex referense to it, and return the EGG string representation
@@ -1010,7 +1498,7 @@ class EGGActorObjectData(EGGMeshObjectData):
             if mod.type == 'ARMATURE':
                 ar = EGGArmature(None)
                 ar.make_hierarchy_from_list(mod.object.data.bones)
-                j_str += ar.get_full_egg_str(self.joint_vtx_ref, mod.object, -1)
+                j_str += ar.get_full_egg_str(self.get_joint_vtx_ref(), mod.object, -1)
         return j_str
 
     #def get_full_egg_str(self):
@@ -1025,114 +1513,135 @@ class EGGAnimJoint(Group):
     """ Representation of the <Joint> animation data. Has the same
     hierarchy as the character's skeleton.
     """
-    def make_hierarchy_from_list(self, obj_list):
-        """ Old <Group> function
-        -------------------------------
-        This function make <Group> hierarchy from the list of
-        Blender's objects. Self.object is the top level of the created
-        hierarchy. Usually in this case self.object == None
-
-        @param obj_list: tuple or lis of blender's objects.
-        """
-        for obj in obj_list:
-            if ((obj.parent == self.object) or
-                ((self.object == None) and
-                 (str(obj.parent) not in map(str,obj_list)) and
-                 (str(obj) not in [str(ch.object) for ch in self.children]))):
-                try:
-                    gr = self.__class__(obj)
-                except:
-                    print_exc()
-                    return ['ERR_MK_OBJ',]
-                self.children.append(gr)
-                gr.make_hierarchy_from_list(obj_list)
-        return []
-
-    def get_full_egg_str(self, anim_info, framerate, level = 0):
+    def get_full_egg_str(self, anim_info, framerate, level = 0, pruned = None):
         """ Create and return the string representation of the <Joint>
         animation data, included all joints hierarchy.
         """
-        egg_str = ''
+        return get_egg_str(self.write_egg, level, anim_info, framerate, pruned)
+
+    def write_egg(self, stream, anim_info, framerate, pruned = None):
+        """ Write the <Joint> animation data, included all joints
+        hierarchy, to the stream.
+
+        @param stream: EGGStream to write to.
+        @param pruned: dict {joint name: channel strings}, made by
+        the prune_anim_tables(), or None to write the full tables.
+        """
         if self.object:
-            egg_str += '%s<Table> %s {\n' % ('  ' * level, eggSafeName(self.object.yabee_name))
-            bone_data = anim_info['<skeleton>'][self.object.yabee_name]
-            egg_str += '%s  <Xfm$Anim> xform {\n' % ('  ' * level)
-            egg_str += '%s    <Scalar> order { sprht }\n' % ('  ' * level)
-            egg_str += '%s    <Scalar> fps { %i }\n' % ('  ' * level, framerate)
-            egg_str += '%s    <Scalar> contents { ijkprhxyz }\n' % ('  ' * level)
-            egg_str += '%s    <V> {\n' % ('  ' * level)
-            for i in range(len(bone_data['r'])):
-                egg_str += '%s      %s %s %s %s %s %s %s %s %s\n' % (
-                                                    '  ' * level,
-                                                    STRF(bone_data['i'][i]),
-                                                    STRF(bone_data['j'][i]),
-                                                    STRF(bone_data['k'][i]),
-                                                    STRF(bone_data['p'][i]),
-                                                    STRF(bone_data['r'][i]),
-                                                    STRF(bone_data['h'][i]),
-                                                    STRF(bone_data['x'][i]),
-                                                    STRF(bone_data['y'][i]),
-                                                    STRF(bone_data['z'][i]))
-            egg_str += '%s    }\n' % ('  ' * level)
-            egg_str += '%s  }\n' % ('  ' * level)
-            for ch in self.children:
-                egg_str += ch.get_full_egg_str(anim_info, framerate, level + 1)
-            egg_str += '%s}\n' % ('  ' * level)
+            with stream.block('<Table> %s' % eggSafeName(self.object.yabee_name)):
+                bone_data = anim_info['<skeleton>'][self.object.yabee_name]
+                if pruned is not None:
+                    # Each channel in the own table, so the constant
+                    # channels are written once and defaults are skipped
+                    channels = pruned[self.object.yabee_name]
+                    with stream.block('<Xfm$Anim_S$> xform'):
+                        stream.line('<Scalar> fps { %i }' % framerate)
+                        stream.line('<Char*> order { sprht }')
+                        for ch, values in zip(XFM_CHANNELS, channels):
+                            if values:
+                                with stream.block('<S$Anim> %s' % ch):
+                                    stream.line('<V> { %s }' % ' '.join(values))
+                else:
+                    with stream.block('<Xfm$Anim> xform'):
+                        stream.line('<Scalar> order { sprht }')
+                        stream.line('<Scalar> fps { %i }' % framerate)
+                        stream.line('<Scalar> contents { %s }' % XFM_CHANNELS)
+                        with stream.block('<V>'):
+                            for row in format_rows(STRF_ANIM, bone_data):
+                                stream.line(row)
+                for ch in self.children:
+                    ch.write_egg(stream, anim_info, framerate, pruned)
         else:
             for ch in self.children:
-                egg_str += ch.get_full_egg_str(anim_info, framerate, level + 1)
-        return egg_str
+                ch.write_egg(stream, anim_info, framerate, pruned)
+
+def prune_anim_tables(tables, defaults = None):
+    """ Compress the channels of the bundle's tables by the
+    compress_channels(). Panda takes the length of the animation from
+    the longest table of the bundle, so if all channels came out
+    constant, the first channel of the first table is kept full-length
+    and the clip doesn't lose its duration.
+
+    @param tables: list of (table name, (frames, channels) array).
+    @param defaults: default value of the each channel or None.
+
+    @return: dict {table name: list of the channel strings}.
+    """
+    pruned = [(name, compress_channels(STRF_ANIM, values, defaults, ANIM_TOLERANCE))
+              for name, values in tables]
+    if tables and len(tables[0][1]) > 1 \
+       and not [ch for name, channels in pruned for ch in channels if len(ch) > 1]:
+        name, values = tables[0]
+        pruned[0] = (name, compress_channels(STRF_ANIM, values, defaults,
+                                             ANIM_TOLERANCE, keep = 0))
+    return dict(pruned)
 
 class AnimCollector():
     """ Collect an armature and a shapekeys animation data and
     convert it to the EGG string.
     """
 
-    def __init__(self, obj_list, start_f, stop_f, framerate, name, action=None):
+    def __init__(self, obj_list, start_f, stop_f, framerate, name,
+                 action=None, sampler=None, rate=0):
         """ @param obj_list: list or tuple of the Blender's objects
         for wich needed to collect animation data.
         @param start_f: number of the "from" frame.
         @param stop_f: number of the "to" frame.
         @param framerate: framerate for the given animation.
         @param name: name of the animation for access in the Panda.
+        @param action: action to assign to the armatures.
+        @param sampler: sampled TimelineSampler, which contains the
+        frames of this animation. If None, then own sampler is used.
+        @param rate: number of the samples per second in the exported
+        animation. 0 - one sample per frame.
         """
         self.obj_list = obj_list
         self.start_f = start_f
         self.stop_f = stop_f
         if self.start_f == self.stop_f: self.stop_f += 1
         self.framerate = framerate
+        self.sample_rate = rate if rate > 0 else framerate
         self.name = name
         self.bone_groups = {}
-        for arm in bpy.data.armatures:
-            arm.pose_position = 'POSE'
+        if action:
+            for obj in obj_list:
+                if obj.__class__ == bpy.types.Bone:
+                    continue
+                if obj.type == 'ARMATURE':
+                    target = obj
+                elif obj.type == 'MESH' and obj.data.shape_keys \
+                     and get_action_targets(action)[1]:
+                    target = obj.data.shape_keys
+                else:
+                    continue
+                if target.animation_data:
+                    target.animation_data.action = action
+        if sampler is None:
+            sampler = make_anim_sampler(obj_list, self.get_frames())
+            sampler.sample()
+        self.sampler = sampler
         self.obj_anim_ref = {}
         for obj in obj_list:
             if obj.__class__ != bpy.types.Bone:
                 if obj.type == 'MESH':
-                    '''
-                    for mod in obj.modifiers:
-                        if mod:
-                            if mod.type == 'ARMATURE':
-                                self.bone_groups[obj.yabee_name] = EGGAnimJoint(None)
-                                self.bone_groups[obj.yabee_name].make_hierarchy_from_list(mod.object.data.bones)
-                                if obj.yabee_name not in list(self.obj_anim_ref.keys()):
-                                    self.obj_anim_ref[obj.yabee_name] = {}
-                                self.obj_anim_ref[obj.yabee_name]['<skeleton>'] = \
-                                        self.collect_arm_anims(mod.object)
-                    '''
                     if ((obj.data.shape_keys) and (len(obj.data.shape_keys.key_blocks) > 1)):
-                        if obj.yabee_name not in list(self.obj_anim_ref.keys()):
+                        if obj.yabee_name not in self.obj_anim_ref:
                             self.obj_anim_ref[obj.yabee_name] = {}
                         self.obj_anim_ref[obj.yabee_name]['morph'] = self.collect_morph_anims(obj)
                 elif obj.type == 'ARMATURE':
-                    if action and obj.animation_data:
-                        obj.animation_data.action = action
                     self.bone_groups[obj.yabee_name] = EGGAnimJoint(None)
                     self.bone_groups[obj.yabee_name].make_hierarchy_from_list(obj.data.bones)
-                    if obj.yabee_name not in list(self.obj_anim_ref.keys()):
+                    if obj.yabee_name not in self.obj_anim_ref:
                         self.obj_anim_ref[obj.yabee_name] = {}
                     self.obj_anim_ref[obj.yabee_name]['<skeleton>'] = \
                             self.collect_arm_anims(obj)
+
+    def get_frames(self):
+        """ Return the list of frames of the animation.
+        """
+        return list(get_clip_frames(self.start_f, self.stop_f,
+                                    self.framerate, self.sample_rate))
+
     def collect_morph_anims(self, obj):
         """ Collect an animation data for the morph target (shapekeys).
 
@@ -1140,53 +1649,42 @@ class AnimCollector():
         """
         keys = {}
         if ((obj.data.shape_keys) and (len(obj.data.shape_keys.key_blocks) > 1)):
-            current_f = bpy.context.scene.frame_current
-            anim_dict = {}
-            for f in range(self.start_f, self.stop_f):
-                bpy.context.scene.frame_current = f
-                bpy.context.scene.frame_set(f)
-                for i in range(1,len(obj.data.shape_keys.key_blocks)):
-                    key = obj.data.shape_keys.key_blocks[i]
-                    if key.name not in list(keys.keys()):
-                        keys[key.name] = []
-                    keys[key.name].append(key.value)
-            bpy.context.scene.frame_current = current_f
+            values = self.sampler.get_shape_values(obj, self.get_frames())
+            static = STATIC_SHAPE_KEYS.get(obj.yabee_name, ())
+            for i, key in enumerate(obj.data.shape_keys.key_blocks):
+                if i > 0 and key.name not in static:
+                    keys[key.name] = values[:, i].tolist()
         return keys
 
     def collect_arm_anims(self, arm):
         """ Collect an animation data for the skeleton (Armature).
 
         @param arm: Blender's Armature for wich need to collect an animation data
+
+        @return: dict of the (frames, 9) arrays of the ijkprhxyz channels
+        by the bone name.
         """
-        current_f = bpy.context.scene.frame_current
+        frames = self.get_frames()
+        pose = self.sampler.get_pose_matrices(arm, frames).astype(np.float64)
+        world = self.sampler.get_world_matrices(arm, frames)
+        pbones = arm.pose.bones
+        bone_index = dict([(bone.name, i) for i, bone in enumerate(pbones)])
+        parents = np.array([bone_index[bone.parent.name] if bone.parent else -1
+                            for bone in pbones], dtype = np.int64)
+        # Matrices relative to the parent (or to the world for the roots)
+        rel = np.empty(pose.shape)
+        child = parents >= 0
+        if child.any():
+            parent_inv = np.linalg.inv(pose[:, parents[child]])
+            rel[:, child] = np.einsum('fbij,fbjk->fbik', parent_inv, pose[:, child])
+        if (~child).any():
+            rel[:, ~child] = np.einsum('fij,fbjk->fbik', world, pose[:, ~child])
+        channels = decompose_matrices(rel)
+        channels[..., 3:6] *= 180.0 / pi
+        # Contents order: ijkprhxyz (p, r, h are rotations by X, Y, Z)
         anim_dict = {}
-        for f in range(self.start_f, self.stop_f):
-            bpy.context.scene.frame_current = f
-            bpy.context.scene.frame_set(f)
-            for bone in arm.pose.bones:
-                if bone.yabee_name not in list(anim_dict.keys()):
-                    anim_dict[bone.yabee_name] = {}
-                for k in 'ijkabcrphxyz':
-                    if k not in list(anim_dict[bone.yabee_name].keys()):
-                        anim_dict[bone.yabee_name][k] = []
-                if bone.parent:
-                    matrix = bone.parent.matrix.inverted() * bone.matrix
-                else:
-                    matrix = arm.matrix_world * bone.matrix
-
-                i, j, k = matrix.to_scale()
-                anim_dict[bone.yabee_name]['i'].append(i)
-                anim_dict[bone.yabee_name]['j'].append(j)
-                anim_dict[bone.yabee_name]['k'].append(k)
-                p, r, h = matrix.to_euler()
-                anim_dict[bone.yabee_name]['p'].append(p/pi*180)
-                anim_dict[bone.yabee_name]['r'].append(r/pi*180)
-                anim_dict[bone.yabee_name]['h'].append(h/pi*180)
-                x, y, z = matrix.to_translation()
-                anim_dict[bone.yabee_name]['x'].append(x)
-                anim_dict[bone.yabee_name]['y'].append(y)
-                anim_dict[bone.yabee_name]['z'].append(z)
-        bpy.context.scene.frame_current = current_f
+        for b_idx, bone in enumerate(pbones):
+            anim_dict[bone.yabee_name] = channels[:, b_idx]
         return anim_dict
 
     def get_morph_anim_str(self, obj_name):
@@ -1195,17 +1693,29 @@ class AnimCollector():
 
         @param obj_name: name of the Blender's object
         """
-        morph_str = ''
+        return get_egg_str(self.write_morph_anim, 0, obj_name)
+
+    def write_morph_anim(self, stream, obj_name):
+        """ Write the EGG morph animation of the given object to the stream.
+
+        @param stream: EGGStream to write to.
+        @param obj_name: name of the Blender's object
+        """
         data = self.obj_anim_ref[obj_name]
-        if 'morph' in list(data.keys()):
-            morph_str += '<Table> morph {\n'
-            for key, anim_vals in data['morph'].items():
-                morph_str += '  <S$Anim> %s {\n' % eggSafeName(key)
-                morph_str += '    <Scalar> fps { %i }\n' % self.framerate
-                morph_str += '    <V> { %s }\n' % (' '.join(map(STRF, anim_vals)))
-                morph_str += '  }\n'
-            morph_str += '}\n'
-        return morph_str
+        if 'morph' in data:
+            if ANIM_PRUNE:
+                # Morph tables are kept even at the default value
+                pruned = prune_anim_tables([(key, np.reshape(anim_vals, (-1, 1)))
+                                            for key, anim_vals in data['morph'].items()])
+            with stream.block('<Table> morph'):
+                for key, anim_vals in data['morph'].items():
+                    if ANIM_PRUNE:
+                        values = pruned[key][0]
+                    else:
+                        values = list(map(STRF_ANIM, anim_vals))
+                    with stream.block('<S$Anim> %s' % eggSafeName(key)):
+                        stream.line('<Scalar> fps { %i }' % self.sample_rate)
+                        stream.line('<V> { %s }' % ' '.join(values))
 
     def get_skeleton_anim_str(self, obj_name):
         """ Create and return the EGG string of the Armature animation for
@@ -1213,39 +1723,62 @@ class AnimCollector():
 
         @param obj_name: name of the Blender's object
         """
-        skel_str = ''
+        return get_egg_str(self.write_skeleton_anim, 0, obj_name)
+
+    def write_skeleton_anim(self, stream, obj_name):
+        """ Write the EGG Armature animation of the given object
+        to the stream.
+
+        @param stream: EGGStream to write to.
+        @param obj_name: name of the Blender's object
+        """
         data = self.obj_anim_ref[obj_name]
-        if '<skeleton>' in list(data.keys()):
-            skel_str += '<Table> "<skeleton>" {\n'
-            for line in self.bone_groups[obj_name].get_full_egg_str(data, self.framerate, -1).splitlines():
-                skel_str += '  %s\n' % line
-            skel_str += '}\n'
-        return skel_str
+        if '<skeleton>' in data:
+            group = self.bone_groups[obj_name]
+            pruned = None
+            if ANIM_PRUNE:
+                # The root joint goes first, so it keeps the full-length
+                # table, if all channels are constant
+                skeleton = data['<skeleton>']
+                names = [ch.object.yabee_name for ch in group.children]
+                names += [name for name in skeleton if name not in names]
+                pruned = prune_anim_tables([(name, skeleton[name]) for name in names
+                                            if name in skeleton], XFM_DEFAULTS)
+            with stream.block('<Table> "<skeleton>"'):
+                group.write_egg(stream, data, self.sample_rate, pruned)
+
+    def has_data(self):
+        """ Return True if the animation has any data to write.
+        """
+        return bool(self.obj_anim_ref)
 
     def get_full_egg_str(self):
         """ Create and return the full EGG string for the animation, wich
         has been setup in the object constructor (__init__)
         """
-        egg_str = ''
-        if self.obj_anim_ref:
-            egg_str += '<Table> {\n'
-            for obj_name, obj_data in self.obj_anim_ref.items():
-                yabee_obj_name = bpy.data.objects[obj_name].yabee_name
-                if self.name:
-                    anim_name = self.name
-                else:
-                    anim_name = obj_name
-                if SEPARATE_ANIM_FILE or ANIM_ONLY:
-                    egg_str += '  <Bundle> %s {\n' % eggSafeName(yabee_obj_name)
-                else:
-                    egg_str += '  <Bundle> %s {\n' % eggSafeName(anim_name)
-                for line in self.get_skeleton_anim_str(obj_name).splitlines():
-                    egg_str += '    %s\n' % line
-                for line in self.get_morph_anim_str(obj_name).splitlines():
-                    egg_str += '    %s\n' % line
-                egg_str += '  }\n'
-            egg_str += '}\n'
-        return egg_str
+        return get_egg_str(self.write_egg)
+
+    def write_egg(self, stream):
+        """ Write the full EGG animation, wich has been setup in
+        the object constructor (__init__), to the stream.
+
+        @param stream: EGGStream to write to.
+        """
+        if self.has_data():
+            with stream.block('<Table>'):
+                for obj_name, obj_data in self.obj_anim_ref.items():
+                    yabee_obj_name = bpy.data.objects[obj_name].yabee_name
+                    if self.name:
+                        anim_name = self.name
+                    else:
+                        anim_name = obj_name
+                    if SEPARATE_ANIM_FILE or ANIM_ONLY:
+                        bundle_name = yabee_obj_name
+                    else:
+                        bundle_name = anim_name
+                    with stream.block('<Bundle> %s' % eggSafeName(bundle_name)):
+                        self.write_skeleton_anim(stream, obj_name)
+                        self.write_morph_anim(stream, obj_name)
 
 #-----------------------------------------------------------------------
 #                     SCENE MATERIALS & TEXTURES
@@ -1268,6 +1801,7 @@ def get_used_materials(objects):
 def get_egg_materials_str(object_names=None):
     """ Return the EGG string of used materials
     """
+    global TEXTURE_ALIASES, ATLAS_PLACEMENTS
     if not object_names:
         objects = bpy.context.selected_objects
     else:
@@ -1433,33 +1967,46 @@ def get_egg_materials_str(object_names=None):
 
         mat_str += '}\n\n'
     used_textures = {}
+    bake_aliases = {}
     
     if containsPBRNodes:
         print("collecting PBR textures")
         pbrtex = PbrTextures(objects,
                             EXPORT_UV_IMAGE_AS_TEXTURE,
                             COPY_TEX_FILES,
-                            FILE_PATH, TEX_PATH)
+                            FILE_PATH, TEX_PATH, TEXTURE_COPIER)
         used_textures.update(pbrtex.get_used_textures()) 
     
     elif TEXTURE_PROCESSOR == 'SIMPLE':
         st = SimpleTextures(objects,
                             EXPORT_UV_IMAGE_AS_TEXTURE,
                             COPY_TEX_FILES,
-                            FILE_PATH, TEX_PATH)
+                            FILE_PATH, TEX_PATH, TEXTURE_COPIER)
         used_textures.update(st.get_used_textures())
     elif TEXTURE_PROCESSOR == 'RAW':
         rt = RawTextures(objects,
                          EXPORT_UV_IMAGE_AS_TEXTURE,
                          COPY_TEX_FILES,
-                         FILE_PATH, TEX_PATH)
+                         FILE_PATH, TEX_PATH, TEXTURE_COPIER)
         used_textures.update(rt.get_used_textures())
 
     if TEXTURE_PROCESSOR != 'RAW':
-        tb = TextureBaker(objects, FILE_PATH, TEX_PATH)
+        tb = TextureBaker(objects, FILE_PATH, TEX_PATH, TEXTURE_COPIER, BAKE_ATLAS)
         used_textures.update(tb.bake(BAKE_LAYERS))
+        bake_aliases = tb.aliases
 
+    if ATLAS_SIZE and TEXTURE_PROCESSOR in ('SIMPLE', 'RAW'):
+        ATLAS_PLACEMENTS = build_texture_atlas(objects, used_textures)
+
+    # The same image with the same settings is written once
+    TEXTURE_ALIASES = get_texture_aliases(used_textures)
+    # Packed textures are replaced by their atlas pages
+    for tex_name, placement in ATLAS_PLACEMENTS.items():
+        TEXTURE_ALIASES[tex_name] = placement[0]
+    TEXTURE_ALIASES.update(bake_aliases)
     for name, params in used_textures.items():
+        if TEXTURE_ALIASES.get(name, name) != name:
+            continue
         mat_str += '<Texture> %s {\n' % eggSafeName(name)
         mat_str += '  "' + convertFileNameToPanda(params['path']) + '"\n'
         for scalar in params['scalars']:
@@ -1475,9 +2022,258 @@ def get_egg_materials_str(object_names=None):
     return mat_str, used_materials, used_textures
 
 
+def get_texture_aliases(used_textures):
+    """ Find the textures, which refer to the same image file with
+    the same scalars and transform, for example the same image in the
+    several materials or texture slots.
+
+    @param used_textures: dict of the textures, see get_used_textures()
+    of the texture processors.
+
+    @return: dict {texture name: name of the first texture with the
+    same file and settings}.
+    """
+    fdir = os.path.dirname(os.path.abspath(FILE_PATH))
+    canonical = {}
+    aliases = {}
+    for name, params in used_textures.items():
+        path = bpy.path.abspath(params['path'])
+        path = os.path.normcase(os.path.abspath(os.path.join(fdir, path)))
+        transform = [(ttype, tuple(value)) for ttype, value
+                     in params.get('transform', ())]
+        key = (path, repr(params['scalars']), repr(transform))
+        aliases[name] = canonical.setdefault(key, name)
+    merged = len(aliases) - len(canonical)
+    if merged:
+        print('INFO: %i textures are merged with the same textures' % merged)
+    return aliases
+
+def build_texture_atlas(objects, used_textures):
+    """ Pack the per-face UV images of the objects into the atlas
+    pages (see ATLAS_SIZE). Images, which faces have UVs out of the
+    [0, 1] range, rely on the texture wrapping and aren't packed.
+    Pages are added to the used_textures.
+
+    @param objects: list of the exported Blender's objects.
+    @param used_textures: dict of the textures, see get_used_textures()
+    of the texture processors.
+
+    @return: dict {texture name: (page name, u offset, v offset,
+    u scale, v scale)}.
+    """
+    candidates = {}
+    wrapped = set()
+    for obj in objects:
+        if obj.type != 'MESH':
+            continue
+        mesh = get_export_mesh(obj)
+        face_tex = [idx for idx, mat in enumerate(mesh.materials)
+                    if mat and mat.use_face_texture]
+        if not face_tex:
+            continue
+        use_face = np.in1d(foreach_get_array(mesh.polygons, 'material_index', np.int32),
+                           face_tex)
+        loop_start = foreach_get_array(mesh.polygons, 'loop_start', np.int64)
+        loop_total = foreach_get_array(mesh.polygons, 'loop_total', np.int64)
+        corner_poly = np.repeat(np.arange(len(loop_total)), loop_total)
+        corner_start = np.cumsum(loop_total) - loop_total
+        loop_face = np.zeros(len(mesh.loops), dtype = np.int64)
+        loop_face[np.arange(len(corner_poly)) - corner_start[corner_poly]
+                  + loop_start[corner_poly]] = corner_poly
+        for uv_name, images, face_image in get_face_image_index(mesh).layers:
+            uv = foreach_get_array(mesh.uv_layers[uv_name].data, 'uv', np.float32, 2)
+            for k, img in enumerate(images):
+                tex_name = '%s_%s' % (uv_name, img.yabee_name)
+                if tex_name not in used_textures:
+                    continue
+                faces = use_face & (face_image == k)
+                if not faces.any():
+                    continue
+                candidates[tex_name] = img
+                face_uv = uv[faces[loop_face]]
+                if face_uv.min() < -0.001 or face_uv.max() > 1.001:
+                    wrapped.add(tex_name)
+    if wrapped:
+        print('INFO: wrapped textures are not packed to the atlas:',
+              ', '.join(sorted(wrapped)))
+    builder = AtlasBuilder(ATLAS_SIZE, ATLAS_PADDING)
+    for tex_name, img in candidates.items():
+        if tex_name not in wrapped:
+            group = tuple([s for s in used_textures[tex_name]['scalars']
+                           if s[0] != 'wrap'])
+            builder.add(tex_name, img, group)
+    fdir, fname = os.path.split(os.path.abspath(FILE_PATH))
+    placements, pages = builder.build(fname.split('.')[0],
+                                      os.path.join(fdir, TEX_PATH))
+    for page_name, (group, page_file) in sorted(pages.items()):
+        rel_path = os.path.join(TEX_PATH, page_file).replace('\\', '/')
+        used_textures[page_name] = {'path': rel_path,
+                                    'scalars': list(group) + [('wrap', 'CLAMP')],
+                                    'transform': []}
+    return placements
+
+def get_texture_ref(tex_name):
+    """ Return the name of the written <Texture> for the texture.
+    """
+    return TEXTURE_ALIASES.get(tex_name, tex_name)
+
+
 #-----------------------------------------------------------------------
 #                   Preparing & auxiliary functions
 #-----------------------------------------------------------------------
+def make_hierarchy_index(obj_list):
+    """ Make the parent to children index of the Blender's objects
+    and bones. Bones of the armatures from the list are included.
+    Children of the top level are stored with the None key. Root
+    bones are the children of their armature object (or of the top
+    level if the list contains bones only).
+
+    @param obj_list: tuple or list of Blender's objects or bones.
+
+    @return: dict {parent object or bone: [children]}
+    """
+    index = {}
+    def add(parent, obj):
+        if parent in index:
+            index[parent].append(obj)
+        else:
+            index[parent] = [obj]
+    exported = set([obj for obj in obj_list
+                    if obj.__class__ != bpy.types.Bone])
+    # Root bones go first in the armature
+    for obj in obj_list:
+        if obj.__class__ == bpy.types.Bone:
+            if not obj.parent:
+                add(None, obj)
+        elif obj.type == 'ARMATURE':
+            for bone in obj.data.bones:
+                if not bone.parent:
+                    add(obj, bone)
+    for obj in obj_list:
+        if obj.__class__ == bpy.types.Bone:
+            continue
+        parent = get_parent(obj)
+        if not parent or parent not in exported:
+            add(None, obj)
+        elif parent.type == 'ARMATURE' and obj.parent_type == 'BONE' \
+             and obj.name not in PARENT_OVERRIDES:
+            bone = parent.data.bones.get(obj.parent_bone)
+            add(bone or parent, obj)
+        else:
+            add(parent, obj)
+    for obj in obj_list:
+        if obj.__class__ == bpy.types.Bone:
+            bones = (obj,)
+        elif obj.type == 'ARMATURE':
+            bones = obj.data.bones
+        else:
+            continue
+        for bone in bones:
+            if bone.parent:
+                add(bone.parent, bone)
+    return index
+
+def get_action_objects(action, obj_list, action_map = None):
+    """ Select the objects, which are animated by the action: armatures
+    with the animated bones and meshes with the animated shape keys.
+
+    @param action: Blender's action.
+    @param obj_list: list of the exported Blender's objects.
+    @param action_map: dict {action name: armature name or list of
+    names}. Mapped actions are used for the given armatures only.
+
+    @return: list of the objects for the AnimCollector.
+    """
+    bones, keys = get_action_targets(action)
+    mapped = None
+    if action_map and action.name in action_map:
+        mapped = action_map[action.name]
+        if isinstance(mapped, str):
+            mapped = (mapped,)
+    objects = []
+    for obj in obj_list:
+        if obj.__class__ == bpy.types.Bone:
+            continue
+        if obj.type == 'ARMATURE':
+            if mapped is not None:
+                if obj.yabee_name in mapped or obj.name in mapped:
+                    objects.append(obj)
+            elif [name for name in bones if name in obj.data.bones]:
+                objects.append(obj)
+        elif obj.type == 'MESH' and obj.data.shape_keys and keys and mapped is None:
+            if [name for name in keys if name in obj.data.shape_keys.key_blocks]:
+                objects.append(obj)
+    return objects
+
+def iter_anim_collectors(obj_list):
+    """ Create the AnimCollector for the each exported animation:
+    for the each action, if ANIMS_FROM_ACTIONS is set, or for the each
+    clip from the ANIMATIONS otherwise.
+
+    @param obj_list: list of the exported Blender's objects.
+    """
+    if ANIMS_FROM_ACTIONS:
+        # Export an animation for each action.
+        fps = bpy.context.scene.render.fps / bpy.context.scene.render.fps_base
+        for action in bpy.data.actions:
+            action_objects = get_action_objects(action, obj_list, ACTION_MAP)
+            if not action_objects:
+                print('Skip action %s: no exported objects are animated' % action.name)
+                continue
+            frange = action.frame_range
+            yield AnimCollector(action_objects, int(frange[0]), int(frange[1]),
+                                fps, action.name, action, rate = ACTION_RATE)
+    else:
+        # Export animations named in ANIMATIONS dictionary.
+        # All clips share one pass over the timeline.
+        # Clip is (start, stop, fps) or (start, stop, fps, rate)
+        clips = dict([(a_name, tuple(frames) + (0,) * (4 - len(frames)))
+                      for a_name, frames in ANIMATIONS.items()])
+        all_frames = set()
+        for clip in clips.values():
+            all_frames.update(get_clip_frames(*clip))
+        sampler = make_anim_sampler(obj_list, all_frames)
+        if all_frames:
+            sampler.sample()
+        for a_name, clip in clips.items():
+            yield AnimCollector(obj_list, clip[0], clip[1], clip[2],
+                                a_name, sampler = sampler, rate = clip[3])
+
+def get_clip_frames(start_f, stop_f, framerate, rate = 0):
+    """ Return the frames to sample for the animation clip. Frames are
+    fractional, if the sample rate differs from the framerate.
+
+    @param start_f: number of the "from" frame.
+    @param stop_f: number of the "to" frame (not included).
+    @param framerate: framerate of the animation.
+    @param rate: number of the samples per second. 0 - one sample
+    per frame.
+    """
+    if start_f == stop_f: stop_f += 1
+    if rate <= 0 or rate == framerate:
+        return range(start_f, stop_f)
+    step = float(framerate) / rate
+    num = max(int(round((stop_f - start_f) / step)), 1)
+    return [round(start_f + i * step, 4) for i in range(num)]
+
+def make_anim_sampler(obj_list, frames):
+    """ Create the TimelineSampler for the armatures and the meshes
+    with shape keys from the list.
+
+    @param obj_list: list of the Blender's objects.
+    @param frames: frames to sample.
+    """
+    sampler = TimelineSampler(frames)
+    for obj in obj_list:
+        if obj.__class__ == bpy.types.Bone:
+            continue
+        if obj.type == 'ARMATURE':
+            sampler.add_armature(obj)
+        elif obj.type == 'MESH' and obj.data.shape_keys \
+             and len(obj.data.shape_keys.key_blocks) > 1:
+            sampler.add_shape_keys(obj)
+    return sampler
+
 def hierarchy_to_list(obj, list, base_filter = None):
     if base_filter:
         if obj._yabee_object.__class__ == base_filter:
@@ -1485,8 +2281,26 @@ def hierarchy_to_list(obj, list, base_filter = None):
     else:
         list.append(obj)
     for ch in obj.children:
-        if ch not in list:
-            hierarchy_to_list(ch, list, base_filter)
+        hierarchy_to_list(ch, list, base_filter)
+
+def make_joints_index(actor_data_list):
+    """ Make the index of the actors vertex references by bone.
+
+    @param actor_data_list: list of the Groups with EGGActorObjectData.
+
+    @return: dict {(armature name, bone name): [vertex references]}
+    """
+    index = {}
+    for ad in actor_data_list:
+        actor = ad._yabee_object
+        for arm_name in actor.get_armature_names():
+            for gname, vref in actor.get_joint_vtx_ref().items():
+                key = (arm_name, gname)
+                if key in index:
+                    index[key].append(vref)
+                else:
+                    index[key] = [vref]
+    return index
 
 
 def merge_objects():
@@ -1563,6 +2377,140 @@ def reparenting_to_armature(obj_list):
                     obj.parent = mod.object
                     obj.matrix_world = m
 
+def get_parent(obj):
+    """ Return the parent of the object, taking into account the
+    PARENT_OVERRIDES.
+    """
+    if obj.__class__ != bpy.types.Bone and obj.name in PARENT_OVERRIDES:
+        return PARENT_OVERRIDES[obj.name]
+    return obj.parent
+
+def get_armature_parent_overrides(obj_list):
+    """ Non-destructive variant of the reparenting_to_armature().
+    Return {object name: armature object} for the armatured objects,
+    which are not parented to their armature.
+    """
+    overrides = {}
+    for obj in obj_list:
+        for mod in obj.modifiers:
+            if mod and mod.type == 'ARMATURE' and mod.show_viewport:
+                if mod.object and obj.parent != mod.object:
+                    print('WARNING:Reparent %s to %s' % (obj.yabee_name, mod.object.yabee_name))
+                    overrides[obj.name] = mod.object
+    return overrides
+
+def get_export_mesh(obj):
+    """ Return the mesh, which should be exported for the object:
+    the temporary mesh from the EXPORT_MESHES or the object's data.
+    """
+    return EXPORT_MESHES.get(obj.name, obj.data)
+
+def triangulate_ngons(mesh):
+    """ Triangulate polygons with more than 4 vertices.
+    """
+    bm = bmesh.new()
+    bm.from_mesh(mesh)
+    faces = [f for f in bm.faces if len(f.verts) > 4]
+    if faces:
+        bmesh.ops.triangulate(bm, faces = faces)
+        bm.to_mesh(mesh)
+    bm.free()
+
+def make_export_meshes(obj_list, meshes):
+    """ Non-destructive variant of the apply_modifiers(). Create the
+    temporary meshes with applied modifiers (except of the armature)
+    for the mesh objects. Objects with shape keys and objects without
+    modifiers are exported from their own data.
+
+    @param obj_list: list of the Blender's objects.
+    @param meshes: dict to store {object name: temporary mesh}.
+    """
+    scene = bpy.context.scene
+    for obj in obj_list:
+        if obj.type != 'MESH':
+            continue
+        if obj.mode == 'EDIT':
+            obj.update_from_editmode()
+        modifiers = [mod for mod in obj.modifiers
+                     if mod.show_viewport and mod.type != 'ARMATURE']
+        triangulate = CALC_TBS == 'BLENDER' \
+                      and [f for f in obj.data.polygons if len(f.vertices) > 4]
+        if obj.data.shape_keys or not ((APPLY_MOD and modifiers) or triangulate):
+            continue
+        # Skinning is done by Panda, so the mesh should stay in rest pose
+        disabled = []
+        for mod in obj.modifiers:
+            if mod.show_viewport and mod.type == 'ARMATURE':
+                mod.show_viewport = False
+                disabled.append(mod)
+        try:
+            mesh = obj.to_mesh(scene, APPLY_MOD, 'PREVIEW')
+        finally:
+            for mod in disabled:
+                mod.show_viewport = True
+        if triangulate:
+            print('WARNING:TBS: Triangulate %s to avoid non tris/quads polygons' % obj.yabee_name)
+            triangulate_ngons(mesh)
+        meshes[obj.name] = mesh
+    for obj in obj_list:
+        if USE_LOOP_NORMALS and obj.type == 'MESH':
+            mesh = meshes.get(obj.name, obj.data)
+            if mesh.has_custom_normals:
+                mesh.calc_normals_split()
+
+def remove_export_meshes(meshes):
+    """ Remove the temporary meshes, created by make_export_meshes().
+    """
+    for mesh in meshes.values():
+        bpy.data.meshes.remove(mesh)
+
+def save_anim_state(obj_list):
+    """ Save the scene state, which is changed by the AnimCollector:
+    current frame, pose position of the armatures and active actions.
+    """
+    actions = []
+    for obj in obj_list:
+        if obj.type == 'ARMATURE':
+            target = obj
+        elif obj.type == 'MESH' and obj.data.shape_keys:
+            target = obj.data.shape_keys
+        else:
+            continue
+        if target.animation_data:
+            actions.append((target, target.animation_data.action))
+    pose_positions = [(arm, arm.pose_position) for arm in bpy.data.armatures]
+    return bpy.context.scene.frame_current, actions, pose_positions
+
+def restore_anim_state(state):
+    """ Restore the scene state, saved by save_anim_state().
+    """
+    frame, actions, pose_positions = state
+    for obj, action in actions:
+        obj.animation_data.action = action
+    for arm, pose_position in pose_positions:
+        arm.pose_position = pose_position
+    bpy.context.scene.frame_set(frame)
+
+def needs_scene_copy():
+    """ Baking modifies the exported objects (new UV layers, images,
+    materials), so it's still performed on the copy of the scene.
+    """
+    if TEXTURE_PROCESSOR == 'RAW' or not BAKE_LAYERS:
+        return False
+    for params in BAKE_LAYERS.values():
+        if len(params) == 2:
+            params = (params[0], params[0], params[1])
+        if params[2]:
+            return True
+    return False
+
+def needs_texture_copier():
+    """ Texture files are written to the textures directory only when
+    they are copied or baked (see needs_scene_copy()). The atlas pages
+    are saved by the AtlasBuilder itself.
+    """
+    return bool(COPY_TEX_FILES) or needs_scene_copy()
+
 def apply_modifiers(obj_list=None):
     if not obj_list:
         obj_list = bpy.context.selected_objects
@@ -1597,14 +2545,153 @@ def generate_shadow_uvs():
 #-----------------------------------------------------------------------
 #                           WRITE OUT
 #-----------------------------------------------------------------------
+def get_fragment_cache():
+    """ Create the fragment cache for the current FILE_PATH. Cache is
+    stored in the ".yabee_cache" directory near the EGG file. Options,
+    which affect all objects, and the exporter code are mixed into the
+    keys, so changing of them invalidates the cache.
+    """
+    fdir, fname = os.path.split(os.path.abspath(FILE_PATH))
+    lib_dir = os.path.dirname(os.path.abspath(__file__))
+    code_hash = hash_files(*[os.path.join(lib_dir, name) for name in
+                             sorted(os.listdir(lib_dir)) if name.endswith('.py')])
+    salt = hash_data(code_hash, CALC_TBS, TEXTURE_PROCESSOR, BAKE_LAYERS,
+                     EXPORT_UV_IMAGE_AS_TEXTURE, USE_LOOP_NORMALS,
+                     WELD_VERTICES, WELD_TOLERANCE, PRECISION, EXPORT_PBS,
+                     FORCE_EXPORT_VERTEX_COLORS, sorted(USED_TEXTURES.keys()),
+                     sorted(TEXTURE_ALIASES.items()), sorted(ATLAS_PLACEMENTS.items()))
+    return FragmentCache(os.path.join(fdir, '.yabee_cache', fname), salt)
+
+def get_anim_file_path(path, anim_name):
+    """ Return the path of the separate animation file. Animation
+    of the compressed .egg.pz file is compressed too.
+
+    @param path: path of the main EGG file.
+    @param anim_name: name of the animation.
+    """
+    for ext in ('.egg.pz', '.egg'):
+        if path.lower().endswith(ext):
+            return path[:-len(ext)] + '-' + anim_name + path[-len(ext):]
+    return path + '-' + anim_name + '.egg'
+
+def make_scene_copy(selected_obj):
+    """ Make the full copy of the scene. Used when the exported objects
+    should be modified (baking).
+
+    @param selected_obj: names of the objects to export.
+
+    @return: tuple (old_data, precopy_obj_list), where old_data is state
+    of bpy.data collections before copying for the clear_scene_copy()
+    and precopy_obj_list is the exported objects of the original scene.
+    """
+    old_data = {}
+    for d in (bpy.data.materials, bpy.data.objects, bpy.data.textures,
+              bpy.data.armatures, bpy.data.actions, bpy.data.brushes,
+              bpy.data.cameras, bpy.data.curves, bpy.data.groups,
+              bpy.data.images, bpy.data.lamps, bpy.data.meshes,
+              bpy.data.metaballs, bpy.data.movieclips,
+              bpy.data.node_groups, bpy.data.particles, bpy.data.screens,
+              bpy.data.shape_keys, bpy.data.sounds,
+              bpy.data.speakers, bpy.data.texts, bpy.data.window_managers,
+              bpy.data.worlds, bpy.data.grease_pencil):
+        old_data[d] = d[:]
+
+    #even obj.data.copy() will not contain loop normals
+    precopy_obj_list = [obj for obj in bpy.context.scene.objects
+                if obj.yabee_name in selected_obj]
+
+    bpy.ops.scene.new(type = 'FULL_COPY')
+    return old_data, precopy_obj_list
+
+
+def prepare_scene_copy(obj_list, precopy_obj_list):
+    """ Prepare objects in the copy of the scene for the export:
+    apply modifiers, reparent armatured objects, etc.
+
+    @param obj_list: objects to export from the copy of the scene.
+    @param precopy_obj_list: the same objects of the original scene.
+    """
+    if USE_LOOP_NORMALS:
+        for old, new in zip(precopy_obj_list, obj_list):
+            if old.type != "MESH":
+                continue
+            print("{} has custom normals!".format(old.name) if old.data.has_custom_normals else "{} has no custom normals.".format(old.name))
+            bpy.context.scene.objects.active = new
+            bpy.ops.object.modifier_add(type='DATA_TRANSFER')
+            bpy.context.object.modifiers["DataTransfer"].object = old
+            bpy.context.object.modifiers["DataTransfer"].use_loop_data = True
+            #bpy.context.object.modifiers["DataTransfer"].loop_mapping = 'POLYINTERP_LNORPROJ'
+            bpy.context.object.modifiers["DataTransfer"].loop_mapping = 'TOPOLOGY'
+            bpy.context.object.modifiers["DataTransfer"].data_types_loops = {'CUSTOM_NORMAL'}
+            bpy.ops.object.modifier_apply(apply_as='DATA', modifier="DataTransfer")
+            new.data.calc_normals_split()
+    if CALC_TBS == 'BLENDER':
+        for obj in obj_list:
+
+            if not hasattr(obj.data, "polygons"):
+                print('WARNING: Skipping non-geometry object:', obj.name)
+                continue
+
+            for face in obj.data.polygons:
+                if len(face.vertices) > 4:
+                    obj.modifiers.new('triangulate_for_TBS', 'TRIANGULATE')
+                    print('WARNING:TBS: Triangulate %s to avoid non tris/quads polygons' % obj.yabee_name)
+                    bpy.context.scene.objects.active = obj
+                    bpy.ops.object.modifier_apply(modifier = 'triangulate_for_TBS')
+                    break
+    if APPLY_MOD:
+        apply_modifiers(obj_list)
+    reparenting_to_armature(obj_list)
+    #parented_to_armatured()
+    #if MERGE_ACTOR_MESH:
+    #    merge_objects()
+    if bpy.ops.object.mode_set.poll():
+        bpy.ops.object.mode_set(mode='OBJECT')
+    # Generate UV layers for shadows
+    if BAKE_LAYERS and (BAKE_LAYERS['AO'][2] or BAKE_LAYERS['shadow'][2]):
+        generate_shadow_uvs()
+
+
+def clear_scene_copy(old_data):
+    """ Delete the copy of the scene, made by make_scene_copy(), and
+    all the data created with it.
+
+    @param old_data: state of the bpy.data collections before copying.
+    """
+    # (!) Possible Incomplete.
+    # Whenever we are deleted our copy of the scene,
+    # Blender won't to delete other objects, created with the scene, so
+    # we should do it by hand. I recommend to save the .blend file before
+    # exporting and reload it after.
+    bpy.ops.scene.delete()
+    for d in old_data:
+        for obj in d:
+            if obj not in old_data[d]:
+                #print("{} has {} users. Proceeding to clear.".format(obj.name, obj.users))
+                obj.user_clear()
+                try:
+                    d.remove(obj, do_unlink=True)
+                except:
+                    print ('WARNING: Can\'t delete', obj, 'from', d)
+
+
 def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
               copy_tex, t_path, tbs, tex_processor, b_layers,
-              m_actor, apply_m, pview, loop_normals, export_pbs, force_export_vertex_colors, objects=None):
+              m_actor, apply_m, pview, loop_normals, export_pbs, force_export_vertex_colors, objects=None,
+              weld_vertices=False, compress_level=6, precision=None,
+              use_cache=False, max_influences=0, weight_steps=0,
+              anim_prune=False, anim_tolerance=0.0, action_map=None,
+              action_rate=0, atlas_size=0, bake_atlas=False, atlas_padding=8):
     global FILE_PATH, ANIMATIONS, ANIMS_FROM_ACTIONS, EXPORT_UV_IMAGE_AS_TEXTURE, \
            COPY_TEX_FILES, TEX_PATH, SEPARATE_ANIM_FILE, ANIM_ONLY, \
-           STRF, CALC_TBS, TEXTURE_PROCESSOR, BAKE_LAYERS, \
+           STRF_XYZ, STRF_NORMAL, STRF_UV, STRF_WEIGHT, STRF_ANIM, CALC_TBS, TEXTURE_PROCESSOR, BAKE_LAYERS, \
            MERGE_ACTOR_MESH, APPLY_MOD, PVIEW, USED_MATERIALS, USED_TEXTURES, \
-           USE_LOOP_NORMALS, EXPORT_PBS, FORCE_EXPORT_VERTEX_COLORS
+           USE_LOOP_NORMALS, EXPORT_PBS, FORCE_EXPORT_VERTEX_COLORS, \
+           WELD_VERTICES, COMPRESS_LEVEL, PRECISION, FRAGMENT_CACHE, \
+           EXPORT_MESHES, PARENT_OVERRIDES, MAX_INFLUENCES, WEIGHT_STEPS, \
+           ANIM_PRUNE, ANIM_TOLERANCE, ACTION_MAP, ACTION_RATE, STATIC_SHAPE_KEYS, \
+           TEXTURE_COPIER, TEXTURE_ALIASES, ATLAS_SIZE, ATLAS_PADDING, ATLAS_PLACEMENTS, BAKE_ATLAS, \
+           ATLAS_UV_LAYERS
     imp.reload(sys.modules[lib_name + '.texture_processor'])
     imp.reload(sys.modules[lib_name + '.utils'])
     errors = []
@@ -1626,10 +2713,35 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
     USE_LOOP_NORMALS = loop_normals
     EXPORT_PBS = export_pbs
     FORCE_EXPORT_VERTEX_COLORS = force_export_vertex_colors
-    s_acc = '%.6f'
-    def str_f(x):
-        return s_acc % x
-    STRF = str_f
+    WELD_VERTICES = weld_vertices
+    MAX_INFLUENCES = max_influences
+    WEIGHT_STEPS = weight_steps
+    COMPRESS_LEVEL = compress_level
+    ANIM_PRUNE = anim_prune
+    ANIM_TOLERANCE = anim_tolerance
+    ACTION_MAP = action_map
+    ACTION_RATE = action_rate
+    prec = dict(DEFAULT_PRECISION)
+    if precision:
+        prec.update(precision)
+    PRECISION = prec
+    FRAGMENT_CACHE = None
+    TEXTURE_COPIER = None
+    TEXTURE_ALIASES = {}
+    ATLAS_SIZE = atlas_size
+    ATLAS_PADDING = atlas_padding
+    ATLAS_PLACEMENTS = {}
+    BAKE_ATLAS = bake_atlas
+    ATLAS_UV_LAYERS = []
+    EXPORT_MESHES = {}
+    PARENT_OVERRIDES = {}
+    STATIC_SHAPE_KEYS = {}
+    clear_face_image_index()
+    STRF_XYZ = make_float_formatter(prec['xyz'])
+    STRF_NORMAL = make_float_formatter(prec['normal'])
+    STRF_UV = make_float_formatter(prec['uv'])
+    STRF_WEIGHT = make_float_formatter(prec['weight'])
+    STRF_ANIM = make_float_formatter(prec['anim'])
     # Prepare copy of the scene.
     # Sync objects names with custom property "yabee_name"
     # to be able to get basic object name in the copy of the scene.
@@ -1659,66 +2771,24 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
             for bone in obj.pose.bones:
                 bone.yabee_name = bone.name
 
-    old_data = {}
-    for d in (bpy.data.materials, bpy.data.objects, bpy.data.textures,
-              bpy.data.armatures, bpy.data.actions, bpy.data.brushes,
-              bpy.data.cameras, bpy.data.curves, bpy.data.groups,
-              bpy.data.images, bpy.data.lamps, bpy.data.meshes,
-              bpy.data.metaballs, bpy.data.movieclips,
-              bpy.data.node_groups, bpy.data.particles, bpy.data.screens,
-              bpy.data.shape_keys, bpy.data.sounds,
-              bpy.data.speakers, bpy.data.texts, bpy.data.window_managers,
-              bpy.data.worlds, bpy.data.grease_pencil):
-        old_data[d] = d[:]
-
-    if USE_LOOP_NORMALS:
-        #even obj.data.copy() will not contain loop normals
-        precopy_obj_list = [obj for obj in bpy.context.scene.objects
-                    if obj.yabee_name in selected_obj]
-
-    bpy.ops.scene.new(type = 'FULL_COPY')
+    use_scene_copy = needs_scene_copy()
+    anim_state = None
+    if use_scene_copy:
+        old_data, precopy_obj_list = make_scene_copy(selected_obj)
     try:
         obj_list = [obj for obj in bpy.context.scene.objects
                     if obj.yabee_name in selected_obj]
-        if USE_LOOP_NORMALS:
-            for old, new in zip(precopy_obj_list, obj_list):
-                if old.type != "MESH":
-                    continue
-                print("{} has custom normals!".format(old.name) if old.data.has_custom_normals else "{} has no custom normals.".format(old.name))
-                bpy.context.scene.objects.active = new
-                bpy.ops.object.modifier_add(type='DATA_TRANSFER')
-                bpy.context.object.modifiers["DataTransfer"].object = old
-                bpy.context.object.modifiers["DataTransfer"].use_loop_data = True
-                #bpy.context.object.modifiers["DataTransfer"].loop_mapping = 'POLYINTERP_LNORPROJ'
-                bpy.context.object.modifiers["DataTransfer"].loop_mapping = 'TOPOLOGY'
-                bpy.context.object.modifiers["DataTransfer"].data_types_loops = {'CUSTOM_NORMAL'}
-                bpy.ops.object.modifier_apply(apply_as='DATA', modifier="DataTransfer")
-                new.data.calc_normals_split()
-        if CALC_TBS == 'BLENDER':
-            for obj in obj_list:
-
-                if not hasattr(obj.data, "polygons"):
-                    print('WARNING: Skipping non-geometry object:', obj.name)
-                    continue
-
-                for face in obj.data.polygons:
-                    if len(face.vertices) > 4:
-                        obj.modifiers.new('triangulate_for_TBS', 'TRIANGULATE')
-                        print('WARNING:TBS: Triangulate %s to avoid non tris/quads polygons' % obj.yabee_name)
-                        bpy.context.scene.objects.active = obj
-                        bpy.ops.object.modifier_apply(modifier = 'triangulate_for_TBS')
-                        break
-        if APPLY_MOD:
-            apply_modifiers(obj_list)
-        reparenting_to_armature(obj_list)
-        #parented_to_armatured()
-        #if MERGE_ACTOR_MESH:
-        #    merge_objects()
-        if bpy.ops.object.mode_set.poll():
-            bpy.ops.object.mode_set(mode='OBJECT')
-        # Generate UV layers for shadows
-        if BAKE_LAYERS and (BAKE_LAYERS['AO'][2] or BAKE_LAYERS['shadow'][2]):
-            generate_shadow_uvs()
+        if use_scene_copy:
+            prepare_scene_copy(obj_list, precopy_obj_list)
+        if BAKE_ATLAS and TEXTURE_PROCESSOR != 'RAW':
+            # The atlas UVs are written to the vertices, so the layers
+            # are made before the export meshes and the hierarchy
+            ATLAS_UV_LAYERS = make_atlas_uvs(obj_list, BAKE_LAYERS)
+        if not use_scene_copy:
+            # Armatures of the selected meshes are added to the list later
+            anim_state = save_anim_state(bpy.context.scene.objects)
+            PARENT_OVERRIDES = get_armature_parent_overrides(obj_list)
+            make_export_meshes(obj_list, EXPORT_MESHES)
         gr = Group(None)
 
         incl_arm = []
@@ -1741,7 +2811,6 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
         errors += gr.make_hierarchy_from_list(obj_list)
         if not errors:
             #gr.print_hierarchy()
-            gr.update_joints_data()
 
             fdir, fname = os.path.split(os.path.abspath(FILE_PATH))
             if not os.path.exists(fdir):
@@ -1750,52 +2819,46 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
             # === write egg data ===
             print('WRITE main EGG to %s' % os.path.abspath(FILE_PATH))
             if ((not ANIM_ONLY) or (not SEPARATE_ANIM_FILE)):
-                file = open(FILE_PATH, 'w')
-            if not ANIM_ONLY:
-                file.write('<CoordinateSystem> { Z-up } \n')
-                materials_str, USED_MATERIALS, USED_TEXTURES = get_egg_materials_str(selected_obj)
-                file.write(materials_str)
-                file.write(gr.get_full_egg_str())
-
-            anim_collectors = []
-            if ANIMS_FROM_ACTIONS:
-                # Export an animation for each action.
-                fps = bpy.context.scene.render.fps / bpy.context.scene.render.fps_base
-
-                for action in bpy.data.actions:
-                    frange = action.frame_range
-                    ac = AnimCollector(obj_list, int(frange[0]), int(frange[1]),
-                                       fps, action.name, action)
-                    anim_collectors.append(ac)
-            else:
-                # Export animations named in ANIMATIONS dictionary.
-                for a_name, frames in ANIMATIONS.items():
-                    ac = AnimCollector(obj_list, frames[0], frames[1],
-                                       frames[2], a_name)
-                    anim_collectors.append(ac)
+                with egg_output(FILE_PATH, COMPRESS_LEVEL) as file:
+                    if not ANIM_ONLY:
+                        file.write('<CoordinateSystem> { Z-up } \n')
+                        # Textures are copied in the background while
+                        # the geometry is written
+                        if needs_texture_copier():
+                            TEXTURE_COPIER = TextureCopier(os.path.join(fdir, TEX_PATH))
+                        materials_str, USED_MATERIALS, USED_TEXTURES = get_egg_materials_str(selected_obj)
+                        file.write(materials_str)
+                        if use_cache:
+                            FRAGMENT_CACHE = get_fragment_cache()
+                        # Joints take the vertex references from the actors,
+                        # which may come from the fragment cache
+                        gr.update_joints_data()
+                        gr.write_egg(EGGStream(file))
+                        if FRAGMENT_CACHE is not None:
+                            FRAGMENT_CACHE.report()
+                            FRAGMENT_CACHE.prune()
+                            FRAGMENT_CACHE = None
+                    if not SEPARATE_ANIM_FILE:
+                        # Each animation is collected, streamed to the file
+                        # and released before the next one
+                        for ac in iter_anim_collectors(obj_list):
+                            if ANIM_ONLY:
+                                file.write('<CoordinateSystem> { Z-up } \n')
+                            ac.write_egg(EGGStream(file))
 
             fpa = []
-            for ac in anim_collectors:
-                if not SEPARATE_ANIM_FILE:
-                    if ANIM_ONLY:
-                        file.write('<CoordinateSystem> { Z-up } \n')
-                    file.write(ac.get_full_egg_str())
-                else:
-                    a_path = FILE_PATH
-                    if a_path[-4:].upper() == '.EGG':
-                        a_path = a_path[:-4] + '-' + ac.name + a_path[-4:]
-                    else:
-                        a_path = a_path + '-' + ac.name + '.egg'
-                    a_egg_str = ac.get_full_egg_str()
-                    if len(a_egg_str) > 0:
-                        a_file = open(a_path, 'w')
-                        a_file.write('<CoordinateSystem> { Z-up } \n')
-                        a_file.write(ac.get_full_egg_str())
-                        a_file.close()
+            if SEPARATE_ANIM_FILE:
+                for ac in iter_anim_collectors(obj_list):
+                    if ac.has_data():
+                        a_path = get_anim_file_path(FILE_PATH, ac.name)
+                        with egg_output(a_path, COMPRESS_LEVEL) as a_file:
+                            a_file.write('<CoordinateSystem> { Z-up } \n')
+                            ac.write_egg(EGGStream(a_file))
                         fpa.append(a_path)
 
-            if ((not ANIM_ONLY) or (not SEPARATE_ANIM_FILE)):
-                file.close()
+            if TEXTURE_COPIER:
+                TEXTURE_COPIER.finish()
+                TEXTURE_COPIER = None
 
             if CALC_TBS == 'PANDA':
                 try:
@@ -1814,22 +2877,20 @@ def write_out(fname, anims, from_actions, uv_img_as_tex, sep_anim, a_only,
         errors.append('ERR_UNEXPECTED')
         #print('\n'.join(format_tb(exc.__traceback__)))
         print_exc()
-    # Clearing the scene.
-    # (!) Possible Incomplete.
-    # Whenever we are deleted our copy of the scene,
-    # Blender won't to delete other objects, created with the scene, so
-    # we should do it by hand. I recommend to save the .blend file before
-    # exporting and reload it after.
-    bpy.ops.scene.delete()
-    for d in old_data:
-        for obj in d:
-            if obj not in old_data[d]:
-                #print("{} has {} users. Proceeding to clear.".format(obj.name, obj.users))
-                obj.user_clear()
-                try:
-                    d.remove(obj, do_unlink=True)
-                except:
-                    print ('WARNING: Can\'t delete', obj, 'from', d)
+    remove_atlas_uvs(ATLAS_UV_LAYERS)
+    ATLAS_UV_LAYERS = []
+    if use_scene_copy:
+        clear_scene_copy(old_data)
+    else:
+        if anim_state:
+            restore_anim_state(anim_state)
+        remove_export_meshes(EXPORT_MESHES)
+        EXPORT_MESHES = {}
+        PARENT_OVERRIDES = {}
+    if TEXTURE_COPIER:
+        TEXTURE_COPIER.finish()
+        TEXTURE_COPIER = None
+    clear_face_image_index()
     return errors
 
 def write_out_test(fname, anims, uv_img_as_tex, sep_anim, a_only, copy_tex,
@@ -0,0 +1,131 @@
+""" Part of the YABEE
+    Persistent cache of the EGG text fragments, keyed by the hash
+    of the data, from which the fragment was generated.
+"""
+
+import os, hashlib
+import numpy as np
+
+
+def update_hash(h, item):
+    """ Feed the item to the hash object. Supports None, numbers,
+    strings, numpy arrays, mathutils vectors/matrices and nested
+    lists, tuples and dicts of them.
+
+    @param h: hashlib hash object.
+    @param item: data to hash.
+    """
+    if item is None:
+        h.update(b'N')
+    elif isinstance(item, np.ndarray):
+        h.update(('A%s%s' % (item.dtype.str, item.shape)).encode('utf-8'))
+        h.update(np.ascontiguousarray(item).tobytes())
+    elif isinstance(item, (str, bool, int, float)):
+        h.update(('%s:%r;' % (type(item).__name__, item)).encode('utf-8'))
+    elif isinstance(item, dict):
+        h.update(b'D')
+        for key in sorted(item.keys(), key = repr):
+            update_hash(h, key)
+            update_hash(h, item[key])
+    elif isinstance(item, (set, frozenset)):
+        h.update(b'S')
+        for sub in sorted(item, key = repr):
+            update_hash(h, sub)
+    elif hasattr(item, '__len__'):
+        # lists, tuples, mathutils Vector and Matrix, bpy arrays
+        h.update(('L%i' % len(item)).encode('utf-8'))
+        for sub in item:
+            update_hash(h, sub)
+    else:
+        h.update(repr(item).encode('utf-8'))
+
+def hash_data(*items):
+    """ Return the hex digest of the given data items.
+    """
+    h = hashlib.sha1()
+    for item in items:
+        update_hash(h, item)
+    return h.hexdigest()
+
+def hash_files(*paths):
+    """ Return the hex digest of the files content. Used to invalidate
+    cache, when the exporter code was changed.
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class FragmentCache:
+    """ Directory with the EGG fragments. Each fragment is stored in
+    the separate file named by its key. The fragments are stored
+    with zero indent level.
+    """
+
+    def __init__(self, path, salt = ''):
+        """ @param path: cache directory.
+        @param salt: string, mixed into the every key. Should contain
+        everything, which affects the all fragments (export options,
+        exporter version, etc).
+        """
+        self.path = path
+        self.salt = salt
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    def make_key(self, *items):
+        """ Return the key of the fragment for the given data.
+        """
+        return hash_data(self.salt, *items)
+
+    def _file_path(self, key):
+        return os.path.join(self.path, key + '.egg')
+
+    def get(self, key):
+        """ Return the cached fragment or None.
+
+        @param key: key of the fragment, see make_key().
+        """
+        self.used.add(key)
+        try:
+            with open(self._file_path(key), 'r', encoding = 'utf-8') as f:
+                text = f.read()
+        except (IOError, OSError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return text
+
+    def put(self, key, text):
+        """ Store the fragment.
+
+        @param key: key of the fragment, see make_key().
+        @param text: EGG text of the fragment.
+        """
+        self.used.add(key)
+        tmp_path = self._file_path(key) + '.tmp'
+        try:
+            with open(tmp_path, 'w', encoding = 'utf-8') as f:
+                f.write(text)
+            os.replace(tmp_path, self._file_path(key))
+        except (IOError, OSError):
+            print('WARNING: Can\'t write the cache fragment', key)
+
+    def prune(self):
+        """ Remove the fragments, which were not used by the last export.
+        """
+        for fname in os.listdir(self.path):
+            key, ext = os.path.splitext(fname)
+            if ext == '.egg' and key not in self.used:
+                try:
+                    os.remove(os.path.join(self.path, fname))
+                except OSError:
+                    pass
+
+    def report(self):
+        print('Fragment cache: %i hits, %i misses' % (self.hits, self.misses))
@@ -0,0 +1,152 @@
+""" Part of the YABEE
+    Packing of the small per-face images into the atlas pages.
+"""
+
+import bpy, os
+import numpy as np
+
+
+def pack_shelves(sizes, page_size, padding = 8):
+    """ Pack the rectangles into the square pages by the shelf
+    algorithm: rectangles sorted by height are placed left to right
+    in the rows (shelves), new shelf is started over the previous one.
+
+    @param sizes: list of (width, height).
+    @param page_size: size of the page.
+    @param padding: free border around the each rectangle.
+
+    @return: list of (page, x, y) for the each rectangle, or None for
+    the rectangles, which don't fit the page.
+    """
+    order = sorted(range(len(sizes)), key = lambda i: (-sizes[i][1], -sizes[i][0]))
+    result = [None] * len(sizes)
+    pages = []  # [shelf y, shelf height, x on the shelf]
+    for i in order:
+        w, h = sizes[i][0] + 2 * padding, sizes[i][1] + 2 * padding
+        if w > page_size or h > page_size:
+            continue
+        for page_idx, page in enumerate(pages):
+            shelf_y, shelf_h, x = page
+            if x + w <= page_size and h <= shelf_h:
+                break
+            if shelf_y + shelf_h + h <= page_size:
+                # Start the new shelf
+                page[:] = [shelf_y + shelf_h, h, 0]
+                break
+        else:
+            pages.append([0, h, 0])
+            page_idx = len(pages) - 1
+        page = pages[page_idx]
+        result[i] = (page_idx, page[2] + padding, page[0] + padding)
+        page[2] += w
+    return result
+
+
+class AtlasPage:
+    """ One atlas image. Images are copied into the page with the
+    padding filled by the edge pixels, so the mipmaps don't bleed.
+    """
+
+    def __init__(self, name, size, padding):
+        self.name = name
+        self.size = size
+        self.padding = padding
+        # Blender's pixels order: rows from the bottom, RGBA
+        self.pixels = np.zeros((size, size, 4), dtype = np.float32)
+
+    def put(self, img, x, y):
+        """ Copy the Blender's image to the page position.
+        """
+        w, h = img.size
+        data = np.array(img.pixels[:], dtype = np.float32).reshape((h, w, 4))
+        p = self.padding
+        data = np.pad(data, ((p, p), (p, p), (0, 0)), mode = 'edge')
+        self.pixels[y - p:y + h + p, x - p:x + w + p] = data
+
+    def save(self, path):
+        """ Save the page to the PNG file.
+        """
+        img = bpy.data.images.new(self.name, self.size, self.size, alpha = True)
+        try:
+            img.pixels[:] = self.pixels.ravel()
+            img.filepath_raw = path
+            img.file_format = 'PNG'
+            img.save()
+        finally:
+            bpy.data.images.remove(img)
+
+
+class AtlasBuilder:
+    """ Collect the images and pack them into the atlas pages.
+    Images with the different texture settings go to the different
+    pages.
+    """
+
+    def __init__(self, page_size, padding = 8):
+        """ @param page_size: size of the page in pixels. Images larger
+        than the half of the page aren't packed.
+        @param padding: border around the each image, filled by its
+        edge pixels. Mipmap level N averages 2**N pixels, so the padding
+        of 2**N pixels keeps N levels from the bleeding.
+        """
+        self.page_size = page_size
+        self.padding = padding
+        self.groups = {}
+
+    def add(self, tex_name, img, group):
+        """ Add the image of the texture to the atlas.
+
+        @param tex_name: name of the texture.
+        @param img: Blender's image.
+        @param group: key of the texture settings, hashable.
+
+        @return: True if the image is accepted.
+        """
+        w, h = img.size
+        limit = self.page_size // 2
+        if not w or not h or w > limit or h > limit or not img.has_data:
+            return False
+        self.groups.setdefault(group, []).append((tex_name, img))
+        return True
+
+    def build(self, name, out_dir):
+        """ Pack and save the pages.
+
+        @param name: prefix of the page names.
+        @param out_dir: directory for the page images.
+
+        @return: tuple of the two dicts. First is {texture name:
+        (page name, u offset, v offset, u scale, v scale)}, second is
+        {page name: (group, file name)}.
+        """
+        placements = {}
+        pages = {}
+        if not os.path.exists(out_dir):
+            os.makedirs(out_dir)
+        for group_idx, group in enumerate(sorted(self.groups, key = repr)):
+            items = self.groups[group]
+            if len(items) < 2:
+                continue
+            sizes = [tuple(img.size) for tex_name, img in items]
+            result = pack_shelves(sizes, self.page_size, self.padding)
+            group_pages = {}
+            for (tex_name, img), place in zip(items, result):
+                if place is None:
+                    continue
+                page_idx, x, y = place
+                if page_idx not in group_pages:
+                    page_name = '%s_atlas%i_%i' % (name, group_idx, page_idx)
+                    group_pages[page_idx] = AtlasPage(page_name, self.page_size,
+                                                      self.padding)
+                page = group_pages[page_idx]
+                page.put(img, x, y)
+                w, h = img.size
+                s = float(self.page_size)
+                placements[tex_name] = (page.name, x / s, y / s, w / s, h / s)
+            for page in group_pages.values():
+                fname = page.name + '.png'
+                page.save(os.path.join(out_dir, fname))
+                pages[page.name] = (group, fname)
+                print('ATLAS %s: %s' % (page.name, ', '.join(
+                    [t for t, p in placements.items() if p[0] == page.name])))
+        return placements, pages
@@ -0,0 +1,169 @@
+""" Part of the YABEE
+    Output of the texture files. Files are copied on the thread pool
+    and recorded in the manifest, so the unchanged textures aren't
+    rewritten by the next export.
+"""
+
+import os, json, hashlib, shutil, threading
+from concurrent.futures import ThreadPoolExecutor
+
+MANIFEST_NAME = '.yabee_textures.json'
+
+
+def hash_file(path, chunk_size = 1 << 20):
+    """ Return the hex digest of the file content.
+    """
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class TextureCopier:
+    """ Copy the texture files to the textures directory. The manifest
+    in the directory stores the source path, size, mtime and content
+    hash of the each written file. The file is skipped if its source
+    isn't changed and the written file isn't touched since the last
+    export. Copies run on the thread pool, so they overlap with the
+    writing of the EGG file; finish() waits for them.
+    """
+
+    def __init__(self, tex_dir, workers = 4):
+        """ @param tex_dir: textures directory.
+        @param workers: number of the copying threads.
+        """
+        self.tex_dir = os.path.abspath(tex_dir)
+        self.manifest_path = os.path.join(self.tex_dir, MANIFEST_NAME)
+        self.manifest = {}
+        try:
+            with open(self.manifest_path, 'r', encoding = 'utf-8') as f:
+                self.manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers = workers)
+        self.futures = []
+        self.scheduled = set()
+        self.copied = 0
+        self.skipped = 0
+
+    def _key(self, dst):
+        return os.path.relpath(os.path.abspath(dst), self.tex_dir).replace('\\', '/')
+
+    def _is_dst_unchanged(self, entry, dst):
+        """ Check that the written file is still the one from the manifest.
+        """
+        try:
+            st = os.stat(dst)
+        except OSError:
+            return False
+        return entry.get('dst_size') == st.st_size \
+               and entry.get('dst_mtime') == st.st_mtime
+
+    def _record(self, key, dst, entry):
+        st = os.stat(dst)
+        entry['dst_size'] = st.st_size
+        entry['dst_mtime'] = st.st_mtime
+        with self.lock:
+            self.manifest[key] = entry
+
+    def copy(self, src, dst):
+        """ Schedule the copying of the file.
+
+        @param src: source file path.
+        @param dst: destination file path.
+        """
+        src = os.path.abspath(src)
+        key = self._key(dst)
+        if key in self.scheduled:
+            return
+        self.scheduled.add(key)
+        try:
+            st = os.stat(src)
+        except OSError:
+            print('WARNING: Can\'t find the texture file', src)
+            return
+        entry = self.manifest.get(key)
+        if entry and entry.get('source') == src and entry.get('size') == st.st_size \
+           and entry.get('mtime') == st.st_mtime and self._is_dst_unchanged(entry, dst):
+            with self.lock:
+                self.skipped += 1
+            return
+        self.futures.append(self.executor.submit(self._copy, src, st, dst, key, entry))
+
+    def _copy(self, src, st, dst, key, entry):
+        digest = hash_file(src)
+        if entry and entry.get('hash') == digest and self._is_dst_unchanged(entry, dst):
+            # Source is touched, but the content is the same
+            with self.lock:
+                self.skipped += 1
+        else:
+            dst_dir = os.path.dirname(os.path.abspath(dst))
+            if not os.path.exists(dst_dir):
+                os.makedirs(dst_dir, exist_ok = True)
+            tmp_path = dst + '.tmp'
+            shutil.copyfile(src, tmp_path)
+            os.replace(tmp_path, dst)
+            print('COPY IMAGE %s to %s' % (src, dst))
+            with self.lock:
+                self.copied += 1
+        self._record(key, dst, {'source': src, 'size': st.st_size,
+                                'mtime': st.st_mtime, 'hash': digest})
+
+    def get_packed_signature(self, img):
+        """ Return the manifest entry of the packed image or None, if
+        the image content isn't accessible.
+        """
+        data = getattr(img.packed_file, 'data', None)
+        if img.is_dirty or not data:
+            return None
+        return {'source': 'packed:' + img.name, 'size': len(data),
+                'mtime': 0, 'hash': hashlib.sha1(data).hexdigest()}
+
+    def is_render_needed(self, signature, dst):
+        """ Check if the image with the given signature should be saved
+        to the dst. Images are rendered by the caller in the main thread,
+        because Blender's data isn't thread safe.
+        """
+        if signature is None:
+            return True
+        entry = self.manifest.get(self._key(dst))
+        if entry and all(entry.get(k) == v for k, v in signature.items()) \
+           and self._is_dst_unchanged(entry, dst):
+            # Copying workers update the counters at the same time
+            with self.lock:
+                self.skipped += 1
+            return False
+        return True
+
+    def record_render(self, signature, dst):
+        """ Store the rendered image to the manifest.
+        """
+        if signature is not None and os.path.exists(dst):
+            self._record(self._key(dst), dst, dict(signature))
+
+    def finish(self):
+        """ Wait for the scheduled copies and save the manifest.
+        """
+        for future in self.futures:
+            try:
+                future.result()
+            except Exception as exc:
+                print('ERROR: Can\'t copy the texture:', exc)
+        self.futures = []
+        self.executor.shutdown()
+        if self.manifest:
+            if not os.path.exists(self.tex_dir):
+                os.makedirs(self.tex_dir)
+            tmp_path = self.manifest_path + '.tmp'
+            try:
+                with open(tmp_path, 'w', encoding = 'utf-8') as f:
+                    json.dump(self.manifest, f, indent = 1, sort_keys = True)
+                os.replace(tmp_path, self.manifest_path)
+            except (IOError, OSError):
+                print('WARNING: Can\'t write the texture manifest')
+        print('Textures: %i copied, %i unchanged' % (self.copied, self.skipped))
@@ -2,8 +2,15 @@
 """
 
 import bpy
+import numpy as np
 if __name__ != '__main__':
-    from .utils import convertFileNameToPanda, save_image
+    from .utils import convertFileNameToPanda, save_image, \
+                       foreach_get_array, get_face_image_index
+
+#: Name of the generated UV layer for the bake atlas
+ATLAS_UV_NAME = 'yabee_atlas'
+#: Margin of the baked images in pixels
+BAKE_MARGIN = 5
 
 BAKE_TYPES = {'diffuse': ('TEXTURE', 'MODULATE'),
               'normal': ('NORMALS', 'NORMAL'),
@@ -13,13 +20,111 @@ BAKE_TYPES = {'diffuse': ('TEXTURE', 'MODULATE'),
               'shadow': ('SHADOW', 'MODULATE')
               }
 
+def get_atlas_uv_name(btype):
+    """ Return the name of the atlas UV layer for the bake type. AO and
+    shadow are baked from the generated "yabee_shadow" UVs, so they
+    have the own layer, shared by all objects of the bake.
+    """
+    if btype in ('AO', 'shadow'):
+        return ATLAS_UV_NAME + '_shadow'
+    return ATLAS_UV_NAME
+
+def get_atlas_cells(count, tsize):
+    """ Split the atlas to the square grid of the cells.
+
+    @param count: number of the cells.
+    @param tsize: size of the atlas image in pixels.
+
+    @return: list of (u offset, v offset, scale) of the cells.
+    """
+    cols = int(np.ceil(np.sqrt(count)))
+    cell = 1.0 / cols
+    # Keep the bake margin inside the cell
+    pad = min(0.05, 2.0 * BAKE_MARGIN / (tsize * cell))
+    cells = []
+    for idx in range(count):
+        row, col = divmod(idx, cols)
+        cells.append((cell * (col + pad), cell * (row + pad), cell * (1 - 2 * pad)))
+    return cells
+
+def make_atlas_uvs(obj_list, bake_layers):
+    """ Write the atlas UV layers (see get_atlas_uv_name()) of the
+    enabled bake types: UVs of the each object are moved into its own
+    cell of the grid. The layers are rebuilt on the every export, because
+    the cells move when the objects are added or removed. They should be
+    made before the meshes are exported, so the vertices get the atlas
+    UVs too. Baking always works on the copy of the scene, so objects
+    with the shared mesh get the own copies of it there, otherwise they
+    would be baked into the one cell. UVs outside of the [0, 1] range
+    are clamped to the cell border.
+
+    @param obj_list: list of the exported Blender's objects.
+    @param bake_layers: bake parameters, see TextureBaker.bake().
+
+    @return: list of (mesh, layer name) for the remove_atlas_uvs().
+    """
+    sizes = {}
+    for btype, params in bake_layers.items():
+        if len(params) == 2:
+            params = (params[0], params[0], params[1])
+        if params[2] and btype in BAKE_TYPES:
+            name = get_atlas_uv_name(btype)
+            size = min(params[0], params[1])
+            sizes[name] = min(size, sizes.get(name, size))
+    meshes = []
+    if sizes:
+        for obj in obj_list:
+            if obj.type == 'MESH' and obj.data.uv_textures.active:
+                if obj.data in meshes:
+                    obj.data = obj.data.copy()
+                meshes.append(obj.data)
+    layers = []
+    for name, size in sorted(sizes.items()):
+        for mesh, cell in zip(meshes, get_atlas_cells(len(meshes), size)):
+            active = mesh.uv_textures.active.name
+            src = active
+            if name == get_atlas_uv_name('shadow') and 'yabee_shadow' in mesh.uv_textures:
+                src = 'yabee_shadow'
+            uv = foreach_get_array(mesh.uv_layers[src].data, 'uv', np.float32, 2)
+            if name not in mesh.uv_textures and mesh.uv_textures.new(name) is None:
+                print('ERROR: %s: can\'t create the atlas UV layer' % mesh.name)
+                continue
+            layers.append((mesh, name))
+            outside = ((uv < 0.0) | (uv > 1.0)).any(axis = 1).sum()
+            if outside:
+                print('WARNING: %s: %i UVs of the "%s" layer are outside of the [0, 1] range and are clamped in the atlas' % \
+                      (mesh.name, outside, src))
+            u0, v0, scale = cell
+            uv = np.clip(uv, 0.0, 1.0) * scale + (u0, v0)
+            mesh.uv_layers[name].data.foreach_set('uv', uv.astype(np.float32).ravel())
+            mesh.uv_textures.active = mesh.uv_textures[active]
+    return layers
+
+def remove_atlas_uvs(layers):
+    """ Remove the UV layers, written by make_atlas_uvs(), so they
+    don't stay in the user's file.
+    """
+    for mesh, name in layers:
+        if name in mesh.uv_textures:
+            mesh.uv_textures.remove(mesh.uv_textures[name])
+
+def get_used_material_indices(mesh):
+    """ Return the material indices of the mesh polygons in order of
+    the first appearance.
+    """
+    mat_idx = foreach_get_array(mesh.polygons, 'material_index', np.int32)
+    used, first = np.unique(mat_idx, return_index = True)
+    return used[np.argsort(first)].tolist()
+
 class PbrTextures():
-    def __init__(self, obj_list, uv_img_as_texture, copy_tex, file_path, tex_path):
+    def __init__(self, obj_list, uv_img_as_texture, copy_tex, file_path, tex_path,
+                 copier = None):
         self.obj_list = obj_list[:]
         self.uv_img_as_texture = uv_img_as_texture
         self.copy_tex = copy_tex
         self.file_path = file_path
         self.tex_path = tex_path
+        self.copier = copier
     
     def get_used_textures(self):
         """ Collect images from the UV images and Material texture slots
@@ -83,7 +188,7 @@ class PbrTextures():
                             
                                     t_path = textureNode.image.filepath
                                     if self.copy_tex:
-                                        t_path = save_image(textureNode.image, self.file_path, self.tex_path)
+                                        t_path = save_image(textureNode.image, self.file_path, self.tex_path, self.copier)
 
                                     #tex_list[tex.texture.name] = {'path': t_path,
                                     #                              'scalars': scalars, 'transform': transform }
@@ -164,12 +269,14 @@ class PbrTextures():
 
 class SimpleTextures():
 
-    def __init__(self, obj_list, uv_img_as_texture, copy_tex, file_path, tex_path):
+    def __init__(self, obj_list, uv_img_as_texture, copy_tex, file_path, tex_path,
+                 copier = None):
         self.obj_list = obj_list[:]
         self.uv_img_as_texture = uv_img_as_texture
         self.copy_tex = copy_tex
         self.file_path = file_path
         self.tex_path = tex_path
+        self.copier = copier
 
     def is_slot_valid(self, tex):
         if ((tex) and (not tex.texture.use_nodes)):
@@ -235,9 +342,9 @@ class SimpleTextures():
                 '''
                 # General textures
                 handled = set()
-                for f in obj.data.polygons:
-                    if f.material_index < len(obj.data.materials):
-                        mat = obj.data.materials[f.material_index]
+                for mat_idx in get_used_material_indices(obj.data):
+                    if mat_idx < len(obj.data.materials):
+                        mat = obj.data.materials[mat_idx]
                         if not mat or mat in handled:
                             continue
                         handled.add(mat)
@@ -292,7 +399,7 @@ class SimpleTextures():
 
                                     t_path = tex.texture.image.filepath
                                     if self.copy_tex:
-                                        t_path = save_image(tex.texture.image, self.file_path, self.tex_path)
+                                        t_path = save_image(tex.texture.image, self.file_path, self.tex_path, self.copier)
 
                                     #tex_list[tex.texture.name] = {'path': t_path,
                                     #                              'scalars': scalars, 'transform': transform }
@@ -352,7 +459,7 @@ class SimpleTextures():
                                             alpha_map_assigned = True
                                             alpha_path = alpha_tex.texture.image.filepath
                                             if self.copy_tex:
-                                                alpha_path = save_image(alpha_tex.texture.image, self.file_path, self.tex_path)
+                                                alpha_path = save_image(alpha_tex.texture.image, self.file_path, self.tex_path, self.copier)
                                             scalars.append(('alpha-file', '\"%s\"' % convertFileNameToPanda(alpha_path) ))
                                             scalars.append(('alpha-file-channel', '4'))
 
@@ -365,28 +472,27 @@ class SimpleTextures():
                     else:
                         use_uv_face_tex = True
 
-                    # use uv map image texture as face texture if appropriate flag
-                    # checked, or material has not valid texture, or object has not material
-                    if use_uv_face_tex:
-                        for num, uv in enumerate(obj.data.uv_textures):
-                            for f in uv.data:
-                                if f.image and f.image.source == 'FILE':
-                                    tex_name = '%s_%s' % (uv.name, f.image.yabee_name)
-                                    if not tex_name in tex_list:
-                                        name = uv.name
-                                        if num == 0: name = ''
-                                        t_path = bpy.path.abspath(f.image.filepath)
-                                        if self.copy_tex:
-                                            t_path = save_image(f.image, self.file_path, self.tex_path)
-                                        tex_list[tex_name] = {'path': t_path, 'scalars': [] }
-                                        tex_list[tex_name]['scalars'].append(('envtype', 'MODULATE'))
-                                        tex_list[tex_name]['scalars'].append(('minfilter', 'LINEAR_MIPMAP_LINEAR'))
-                                        tex_list[tex_name]['scalars'].append(('magfilter', 'LINEAR_MIPMAP_LINEAR'))
-                                        tex_list[tex_name]['scalars'].append(('wrap', 'REPEAT'))
-                                        if use_uv_face_tex_alpha:
-                                            tex_list[tex_name]['scalars'].append(('alpha', 'BINARY'))
-                                        if name:
-                                            tex_list[tex_name]['scalars'].append(('uv-name', name))
+                # use uv map image texture as face texture if appropriate flag
+                # checked, or material has not valid texture, or object has not material
+                if use_uv_face_tex:
+                    for num, uv_name, img in get_face_image_index(obj.data).iter_images():
+                        if img.source == 'FILE':
+                            tex_name = '%s_%s' % (uv_name, img.yabee_name)
+                            if not tex_name in tex_list:
+                                name = uv_name
+                                if num == 0: name = ''
+                                t_path = bpy.path.abspath(img.filepath)
+                                if self.copy_tex:
+                                    t_path = save_image(img, self.file_path, self.tex_path, self.copier)
+                                tex_list[tex_name] = {'path': t_path, 'scalars': [] }
+                                tex_list[tex_name]['scalars'].append(('envtype', 'MODULATE'))
+                                tex_list[tex_name]['scalars'].append(('minfilter', 'LINEAR_MIPMAP_LINEAR'))
+                                tex_list[tex_name]['scalars'].append(('magfilter', 'LINEAR_MIPMAP_LINEAR'))
+                                tex_list[tex_name]['scalars'].append(('wrap', 'REPEAT'))
+                                if use_uv_face_tex_alpha:
+                                    tex_list[tex_name]['scalars'].append(('alpha', 'BINARY'))
+                                if name:
+                                    tex_list[tex_name]['scalars'].append(('uv-name', name))
 
         return tex_list
 
@@ -511,12 +617,18 @@ class RawTextures(SimpleTextures):
 
 class TextureBaker():
 
-    def __init__(self, obj_list, file_path, tex_path):
+    def __init__(self, obj_list, file_path, tex_path, copier = None,
+                 atlas = False):
         self.saved_objs = {}
         self.rendered_images = {}
         self.obj_list = obj_list[:]
         self.file_path = file_path
         self.tex_path = tex_path
+        self.copier = copier
+        # Bake all objects into the one image per bake type
+        self.atlas = atlas
+        #: {object texture name: atlas texture name}
+        self.aliases = {}
 
     def get_active_uv(self, obj):
         auv = [uv for uv in obj.data.uv_textures if uv.active]
@@ -568,12 +680,44 @@ class TextureBaker():
                     return None
         return assigned_data
 
+    def _prepare_atlas_image(self, btype, tsizex, tsizey):
+        """ Create the one image of the bake type for all objects and
+        assign it to the atlas UV layers, made by make_atlas_uvs().
+        """
+        # The one texture, so the one UV name for all objects
+        uv_name = get_atlas_uv_name(btype)
+        objects = [obj for obj in self.obj_list
+                   if obj.type == 'MESH' and uv_name in obj.data.uv_textures]
+        if not objects:
+            return None
+        img = bpy.data.images.new(ATLAS_UV_NAME + '_' + btype, tsizex, tsizey)
+        self.rendered_images[ATLAS_UV_NAME] = img.name
+        self.atlas_sources = {}
+        atlas_uv = None
+        for obj in objects:
+            self.atlas_sources[obj.name] = self.get_active_uv(obj)
+            obj.data.uv_textures.active = obj.data.uv_textures[uv_name]
+            self._save_obj_props(obj)
+            atlas_uv = self.get_active_uv(obj)
+            for uvd in atlas_uv.data:
+                uvd.image = img
+            self.aliases[obj.yabee_name + '_' + btype] = img.name
+        return {img.name: (atlas_uv, img, 1, BAKE_TYPES[btype][1])}
+
+    def _restore_atlas_sources(self):
+        for obj in self.obj_list:
+            src = getattr(self, 'atlas_sources', {}).get(obj.name)
+            if src:
+                obj.data.uv_textures.active = src
+                obj.data.update()
+        self.atlas_sources = {}
+
     def _clear_images(self):
         for iname in self.rendered_images.values():
             img = bpy.data.images[iname]
             img.user_clear()
             bpy.data.images.remove(img)
-        self.rendred_images = []
+        self.rendered_images = {}
 
     def _save_rendered(self, spath):
         for oname, iname in self.rendered_images.items():
@@ -584,7 +728,7 @@ class TextureBaker():
         paths = {}
         for oname, iname in self.rendered_images.items():
             img = bpy.data.images[iname]
-            paths[iname] = save_image(img, self.file_path, self.tex_path)
+            paths[iname] = save_image(img, self.file_path, self.tex_path, self.copier)
         return paths
 
     def _select(self, obj):
@@ -611,13 +755,16 @@ class TextureBaker():
                                 obj.data.uv_textures.active = obj.data.uv_textures['yabee_shadow']
                                 obj.data.update()
                                 #obj.data.uv_layers.active = obj.data.uv_textures['yabee_shadow']
-                    assigned_data = self._prepare_images(btype, params[0], params[1])
+                    if self.atlas:
+                        assigned_data = self._prepare_atlas_image(btype, params[0], params[1])
+                    else:
+                        assigned_data = self._prepare_images(btype, params[0], params[1])
                     if assigned_data:
                         old_selected =  bpy.context.selected_objects[:]
                         #bpy.ops.object.select_all(action = 'DESELECT')
                         map(self._deselect, old_selected)
                         bpy.context.scene.render.bake_type = BAKE_TYPES[btype][0]
-                        bpy.context.scene.render.bake_margin = 5
+                        bpy.context.scene.render.bake_margin = BAKE_MARGIN
                         bpy.context.scene.render.image_settings.color_mode = 'RGBA'
                         bpy.context.scene.render.bake_normal_space = 'TANGENT'
                         #print(bpy.context.selected_objects[:])
@@ -633,7 +780,11 @@ class TextureBaker():
                         paths = self._save_images()
                     for obj in self.obj_list:
                         self._restore_obj_props(obj)
+                    if self.atlas:
+                        self._restore_atlas_sources()
                     self._clear_images()
+                    if not assigned_data:
+                        continue
                     for key, val in assigned_data.items():
                         uv_name = val[0].name
                         if val[2] == 0:
@@ -1,8 +1,11 @@
 """
     Part of the YABEE rev 12.1
 """
-import bpy, os, sys, shutil
+import bpy, os, sys, shutil, zlib
 import bpy_extras
+import numpy as np
+from io import StringIO
+from contextlib import contextmanager
 
 def convertFileNameToPanda(filename):
   """ (Get from Chicken) Converts Blender filenames to Panda 3D filenames.
@@ -12,7 +15,18 @@ def convertFileNameToPanda(filename):
     path = '/'+ path[0].lower() + path[2:]
   return path
 
-def save_image(img, file_path, text_path):
+def save_image(img, file_path, text_path, copier = None):
+    """ Copy or render the image to the textures directory.
+
+    @param img: Blender's image.
+    @param file_path: path of the EGG file.
+    @param text_path: textures directory, relative to the EGG file.
+    @param copier: TextureCopier, which skips the unchanged files and
+    copies the rest on the background threads. If None, the file is
+    copied immediately.
+
+    @return: path of the image relative to the EGG file.
+    """
     if img.filepath:
         oldpath = bpy.path.abspath(img.filepath)
         old_dir, old_f = os.path.split(convertFileNameToPanda(oldpath))
@@ -32,13 +46,22 @@ def save_image(img, file_path, text_path):
         os.makedirs(new_dir)
     #print('IMG', img, img.packed_file)
     if img.is_dirty or bool(img.packed_file):
+        # The scene isn't a copy anymore, so restore the render settings
+        old_color_mode = bpy.context.scene.render.image_settings.color_mode
         try:
             bpy.context.scene.render.image_settings.color_mode = 'RGBA'
         except:
             bpy.context.scene.render.image_settings.color_mode = 'RGB'
         r_path = os.path.abspath(os.path.join(new_dir, old_f))
-        img.save_render(r_path)
-        print('RENDER IMAGE to %s; rel path: %s' % (r_path, rel_path))
+        signature = copier.get_packed_signature(img) if copier else None
+        if copier and not copier.is_render_needed(signature, r_path):
+            print('SKIP unchanged image %s' % r_path)
+        else:
+            img.save_render(r_path)
+            print('RENDER IMAGE to %s; rel path: %s' % (r_path, rel_path))
+            if copier:
+                copier.record_render(signature, r_path)
+        bpy.context.scene.render.image_settings.color_mode = old_color_mode
     #elif bool(img.packed_file):
     #    r_path = os.path.abspath(os.path.join(new_dir, old_f))
     #    img.filepath = r_path
@@ -48,8 +71,11 @@ def save_image(img, file_path, text_path):
     else:
         newf = os.path.join(new_dir, old_f)
         if oldpath != newf:
-            bpy_extras.io_utils.path_reference_copy(((oldpath.replace(r"\\", r"/"), newf),), report = print)
-            print('COPY IMAGE %s to %s; rel path %s' % (oldpath, newf, rel_path))
+            if copier:
+                copier.copy(oldpath.replace(r"\\", r"/"), newf)
+            else:
+                bpy_extras.io_utils.path_reference_copy(((oldpath.replace(r"\\", r"/"), newf),), report = print)
+                print('COPY IMAGE %s to %s; rel path %s' % (oldpath, newf, rel_path))
     return rel_path
 
 def get_active_uv(obj):
@@ -70,3 +96,402 @@ def eggSafeName(s):
       return '"' + s + '"'
     else:
       return s
+
+
+def foreach_get_array(collection, attr, dtype, size = 1):
+    """ Read the attribute of all items of the Blender's collection
+    into the contiguous numpy array by the single foreach_get call.
+
+    @param collection: Blender's collection (mesh.vertices, mesh.loops...).
+    @param attr: attribute name.
+    @param dtype: numpy type of the attribute.
+    @param size: number of values per item. Array has shape (N, size)
+    if size > 1.
+    """
+    num = len(collection)
+    if dtype == bool:
+        # Boolean flags haven't raw access, so read them through the list
+        data = [False] * (num * size)
+        if num:
+            collection.foreach_get(attr, data)
+        arr = np.array(data, dtype = bool)
+    else:
+        arr = np.empty(num * size, dtype = dtype)
+        if num:
+            collection.foreach_get(attr, arr)
+    if size > 1:
+        arr = arr.reshape((num, size))
+    return arr
+
+class FaceImageIndex:
+    """ Images, assigned to the faces in the all UV layers of the mesh.
+    Built by the one pass over the each layer, so the texture collection
+    and the polygon attributes don't rescan the faces.
+    """
+
+    def __init__(self, mesh):
+        """ @param mesh: Blender's mesh.
+        """
+        #: list of (uv layer name, list of images, array of the face
+        #: image indices in the list, -1 for the faces without image)
+        self.layers = []
+        for uv in mesh.uv_textures:
+            images = []
+            lookup = {}
+            face_image = np.full(len(uv.data), -1, dtype = np.int32)
+            for idx, face in enumerate(uv.data):
+                img = face.image
+                if img:
+                    if img.name not in lookup:
+                        lookup[img.name] = len(images)
+                        images.append(img)
+                    face_image[idx] = lookup[img.name]
+            self.layers.append((uv.name, images, face_image))
+
+    def iter_images(self):
+        """ Iterate (layer number, uv layer name, image) in order of
+        the first appearance.
+        """
+        for num, (uv_name, images, face_image) in enumerate(self.layers):
+            for img in images:
+                yield num, uv_name, img
+
+    def get_faces(self, uv_name, img):
+        """ Return the array of the faces indices with the given image.
+        """
+        for name, images, face_image in self.layers:
+            if name == uv_name and img in images:
+                return np.nonzero(face_image == images.index(img))[0]
+        return np.zeros(0, dtype = np.int64)
+
+    def get_face_images(self, face):
+        """ Return the list of (uv layer name, image or None) of the face.
+        """
+        result = []
+        for uv_name, images, face_image in self.layers:
+            idx = face_image[face]
+            result.append((uv_name, images[idx] if idx >= 0 else None))
+        return result
+
+FACE_IMAGE_INDEX = {}
+
+def get_face_image_index(mesh):
+    """ Return the FaceImageIndex of the mesh. The index is built once
+    per mesh and kept until clear_face_image_index() is called.
+    """
+    if mesh.name not in FACE_IMAGE_INDEX:
+        FACE_IMAGE_INDEX[mesh.name] = FaceImageIndex(mesh)
+    return FACE_IMAGE_INDEX[mesh.name]
+
+def clear_face_image_index():
+    FACE_IMAGE_INDEX.clear()
+
+def weld_rows(keys):
+    """ Find the identical rows of the 2D array.
+
+    @param keys: 2D array, one key per row.
+
+    @return: tuple of the two arrays. First maps the row to the
+    unique key index, second maps the unique key index to the first
+    row with this key. Unique keys are numbered in order of appearance.
+    """
+    num = len(keys)
+    if not num:
+        return np.zeros(0, dtype = np.int64), np.zeros(0, dtype = np.int64)
+    # lexsort is stable, so the first row of the each run is the first
+    # row with this key in the source array.
+    order = np.lexsort(keys.T[::-1])
+    sorted_keys = keys[order]
+    is_new = np.ones(num, dtype = bool)
+    is_new[1:] = np.any(sorted_keys[1:] != sorted_keys[:-1], axis = 1)
+    group = np.empty(num, dtype = np.int64)
+    group[order] = np.cumsum(is_new) - 1
+    first = order[is_new]
+    by_appearance = np.argsort(first)
+    rank = np.empty(len(first), dtype = np.int64)
+    rank[by_appearance] = np.arange(len(first))
+    return rank[group], first[by_appearance]
+
+def quantize_weights(vidx, weights, steps, num):
+    """ Quantize the normalized weights of the vertices to the integer
+    number of 1/steps, keeping the sum of the each vertex weights equal
+    to steps (largest remainder method).
+
+    @param vidx: vertex index of the each weight.
+    @param weights: array of weights.
+    @param steps: number of steps per the weight 1.0.
+    @param num: number of vertices.
+
+    @return: array of the quantized weights in the steps.
+    """
+    scaled = weights * steps
+    q = np.floor(scaled)
+    deficit = np.round(steps - np.bincount(vidx, weights = q, minlength = num))
+    # Give the remaining steps to the largest remainders
+    order = np.lexsort((q - scaled, vidx))
+    svidx = vidx[order]
+    rank = np.arange(len(svidx)) - np.searchsorted(svidx, svidx)
+    bump = order[rank < deficit[svidx]]
+    q[bump] += 1
+    return q
+
+def matrix_to_array(matrix):
+    """ Convert the mathutils Matrix to the numpy array
+    (rows of the matrix are rows of the array).
+    """
+    return np.array([row[:] for row in matrix], dtype = np.float64)
+
+def get_normal_matrix(matrix):
+    """ Return the 3x3 normal matrix (inverse transpose of the linear
+    part) of the 4x4 matrix array.
+    """
+    try:
+        return np.linalg.inv(matrix[:3, :3]).T
+    except np.linalg.LinAlgError:
+        # Degenerated (zero scaled) object
+        return np.linalg.pinv(matrix[:3, :3]).T
+
+def transform_points(matrix, points):
+    """ Apply the 4x4 matrix array to the (N, 3) array of points.
+    """
+    return np.dot(points, matrix[:3, :3].T) + matrix[:3, 3]
+
+def transform_normals(normal_matrix, normals):
+    """ Apply the 3x3 normal matrix to the (N, 3) array of normals
+    and normalize the result.
+    """
+    normals = np.dot(normals, normal_matrix.T)
+    length = np.sqrt((normals * normals).sum(axis = 1))
+    length[length == 0] = 1.0
+    return normals / length.reshape((len(length), 1))
+
+def decompose_matrices(matrices):
+    """ Decompose the array of the 4x4 matrices to the scale, Euler
+    angles (XYZ order, radians) and translation, the same way as the
+    mathutils Matrix to_scale(), to_euler() and to_translation() do.
+
+    @param matrices: (..., 4, 4) array of matrices.
+
+    @return: (..., 9) array of the (sx, sy, sz, rx, ry, rz, x, y, z).
+    """
+    mat = matrices[..., :3, :3]
+    scale = np.sqrt((mat * mat).sum(axis = -2))
+    norm = np.where(scale == 0, 1.0, scale)
+    mat = mat / norm[..., np.newaxis, :]
+    m = lambda row, col: mat[..., row, col]
+    cy = np.hypot(m(0, 0), m(1, 0))
+    regular = cy > 16.0 * np.finfo(np.float32).eps
+    # Two possible solutions, choose one with the smaller angles
+    eul1 = np.stack((np.arctan2(m(2, 1), m(2, 2)),
+                     np.arctan2(-m(2, 0), cy),
+                     np.arctan2(m(1, 0), m(0, 0))), axis = -1)
+    eul2 = np.stack((np.arctan2(-m(2, 1), -m(2, 2)),
+                     np.arctan2(-m(2, 0), -cy),
+                     np.arctan2(-m(1, 0), -m(0, 0))), axis = -1)
+    # Gimbal lock
+    eul_lock = np.stack((np.arctan2(-m(1, 2), m(1, 1)),
+                         np.arctan2(-m(2, 0), cy),
+                         np.zeros(cy.shape)), axis = -1)
+    use_eul2 = np.abs(eul1).sum(axis = -1) > np.abs(eul2).sum(axis = -1)
+    eul = np.where(use_eul2[..., np.newaxis], eul2, eul1)
+    eul = np.where(regular[..., np.newaxis], eul, eul_lock)
+    return np.concatenate((scale, eul, matrices[..., :3, 3]), axis = -1)
+
+def make_float_formatter(digits):
+    """ Return the function, which converts the float to the EGG
+    string with the given number of digits after the point. Trailing
+    zeros are stripped and values, which would be written as zero,
+    are snapped to "0" (no "-0.000" in the file).
+
+    @param digits: number of digits after the point.
+    """
+    fmt = '%%.%if' % digits
+    eps = 0.5 * 10 ** -digits
+    def strf(x):
+        if -eps < x < eps:
+            return '0'
+        s = fmt % x
+        if '.' in s:
+            s = s.rstrip('0').rstrip('.')
+        return s
+    return strf
+
+def format_rows(strf, rows):
+    """ Convert each row of the (N, M) array to the string of
+    space separated values.
+
+    @param strf: float formatter, see make_float_formatter().
+    @param rows: array or list of rows.
+    """
+    if hasattr(rows, 'tolist'):
+        rows = rows.tolist()
+    return [' '.join(map(strf, row)) for row in rows]
+
+def compress_channels(strf, values, defaults = None, tolerance = 0.0, keep = None):
+    """ Convert the animation channels to the lists of strings with
+    the constant channels collapsed to the one value and the channels,
+    which are equal to the default value for the whole clip, dropped.
+
+    @param strf: float formatter, see make_float_formatter().
+    @param values: (frames, channels) array.
+    @param defaults: default value of the each channel. Channels are
+    never dropped if None.
+    @param tolerance: if > 0, values are quantized to the multiple of
+    the tolerance.
+    @param keep: index of the channel, which is always written
+    full-length, or None.
+
+    @return: list of the lists of the strings, one per channel. The
+    dropped channel has the empty list.
+    """
+    values = np.asarray(values, dtype = np.float64)
+    if tolerance > 0:
+        values = np.round(values / tolerance) * tolerance
+    result = []
+    for ch, column in enumerate(values.T.tolist()):
+        strings = list(map(strf, column))
+        if ch == keep:
+            pass
+        elif strings and strings.count(strings[0]) == len(strings):
+            if defaults is not None and strings[0] == strf(defaults[ch]):
+                strings = []
+            else:
+                strings = strings[:1]
+        result.append(strings)
+    return result
+
+
+class EGGStream:
+    """ Write the EGG text straight to the output file object with
+    the tracking of the indent level. Nested structures are written by
+    the block() context, so text is indented once, when it's written,
+    instead of the re-indenting on the each hierarchy level.
+    """
+
+    def __init__(self, file, level = 0):
+        """ @param file: file-like object with write() method.
+        @param level: starting indent level.
+        """
+        self.file = file
+        self.level = 0
+        self.indent = ''
+        self.set_level(level)
+
+    def set_level(self, level):
+        self.level = max(level, 0)
+        self.indent = '  ' * self.level
+
+    def line(self, text):
+        """ Write the one line with the current indent.
+        """
+        if text:
+            self.file.write(self.indent + text + '\n')
+        else:
+            self.file.write('\n')
+
+    def write(self, text):
+        """ Write the text, which consists of the whole lines. Each
+        line is prefixed by the current indent.
+        """
+        if not text:
+            return
+        if self.indent:
+            if text[-1] == '\n':
+                text = text[:-1].replace('\n', '\n' + self.indent) + '\n'
+            else:
+                text = text.replace('\n', '\n' + self.indent)
+            text = self.indent + text
+        self.file.write(text)
+
+    @contextmanager
+    def block(self, header):
+        """ Write the "header {" line, the content written inside
+        the context with the increased indent, and the closing "}".
+        """
+        self.line(header + ' {')
+        self.set_level(self.level + 1)
+        yield self
+        self.set_level(self.level - 1)
+        self.line('}')
+
+def get_egg_str(write_func, level = 0, *args):
+    """ Call the write function with the EGGStream over the string
+    buffer and return the written text.
+
+    @param write_func: function, which takes the EGGStream as the first
+    argument.
+    @param level: starting indent level.
+    @param args: other arguments of the write_func.
+    """
+    buf = StringIO()
+    write_func(EGGStream(buf, level), *args)
+    return buf.getvalue()
+
+
+class PZFile:
+    """ Text file-like object, which compresses the written data by zlib
+    on the fly. The result is the same as the Panda's pzip produces
+    from the plain file, so Panda reads it as is.
+    """
+
+    BUFFER_SIZE = 1 << 16
+
+    def __init__(self, path, level = 6):
+        """ @param path: path of the file to write.
+        @param level: zlib compression level (1 - fastest, 9 - best).
+        """
+        self.file = open(path, 'wb')
+        self.compressor = zlib.compressobj(level)
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, text):
+        # Many small writes, so compress them by chunks
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.BUFFER_SIZE:
+            self.flush_buffer()
+
+    def flush_buffer(self):
+        if self.buffer:
+            data = ''.join(self.buffer).encode('utf-8')
+            self.file.write(self.compressor.compress(data))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush_buffer()
+        self.file.write(self.compressor.flush())
+        self.file.close()
+
+def open_egg_file(path, compress_level = 6):
+    """ Open the EGG file for writing. The file with the .pz
+    extension (file.egg.pz) is compressed while written.
+
+    @param path: path of the file.
+    @param compress_level: zlib compression level for the .pz file.
+    """
+    if path.lower().endswith('.pz'):
+        return PZFile(path, compress_level)
+    return open(path, 'w')
+
+@contextmanager
+def egg_output(path, compress_level = 6):
+    """ Open the EGG file by open_egg_file() for the with statement.
+    The file is closed on exit. If the writing failed, the partial
+    file is removed, so the broken output doesn't stay on disk.
+
+    @param path: path of the file.
+    @param compress_level: zlib compression level for the .pz file.
+    """
+    file = open_egg_file(path, compress_level)
+    try:
+        yield file
+    except:
+        file.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        raise
+    file.close()